@@ -0,0 +1,147 @@
+"""Runs an AI's searches in a background thread, so the game keeps animating
+and handling input while the AI thinks.
+
+The worker also ponders: while the opponent is choosing a move, it searches
+the AI's reply to each move the opponent could make and keeps the answers,
+so when the opponent plays one of them the reply is ready at once."""
+
+import threading
+import timeit
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import search
+
+
+class AIWorker(object):
+
+    """Owns an AI and a thread that searches with it.
+
+    Requests go to the thread through one queue and chosen moves come back
+    through another.  The AI object must only be used through the worker
+    once it has been handed over.  If a profiler.Profiler is given, every
+    search is reported to it."""
+
+    def __init__(self, ai, profiler=None):
+        self.ai = ai
+        self.profiler = profiler
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        # position hash -> the AI's move there, found by pondering
+        self.replies = {}
+        # hash of the position being pondered right now, if any.  The lock
+        # covers it, and the check for requests before a ponder search, so
+        # a request either stops the search or is seen before it starts.
+        self.pondering = None
+        self.lock = threading.Lock()
+        self.interrupted = threading.Event()
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request_move(self, state):
+        """Asks for the AI's move in the given engine.GameState, where the AI
+        is to move.  The move can be collected with poll()."""
+        with self.lock:
+            if self.pondering is not None and self.pondering != state.hash:
+                # the position being pondered wasn't reached; give up on it
+                self.interrupt()
+            self.requests.put(('move', state.clone()))
+
+    def ponder(self, state):
+        """Starts searching the AI's replies to each move the opponent could
+        make in the given engine.GameState, where the opponent is to
+        move."""
+        self.requests.put(('ponder', state.clone()))
+
+    def poll(self):
+        """Returns the move the AI chose, or None if it is still thinking."""
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def interrupt(self):
+        """Cuts the current ponder search short, if the AI allows it.  The
+        AI stays stopped until resume()."""
+        self.interrupted.set()
+        stop = getattr(self.ai, 'stop', None)
+        if stop is not None:
+            stop()
+
+    def resume(self):
+        """Lets the AI search normally again after interrupt()."""
+        self.interrupted.clear()
+        if getattr(self.ai, 'stopped', False):
+            self.ai.stopped = False
+
+    def close(self):
+        """Stops the thread once it has finished what it is doing."""
+        self.interrupt()
+        self.requests.put(('quit', None))
+
+    def work(self):
+        while True:
+            kind, state = self.requests.get()
+            if kind == 'quit':
+                return
+            # no ponder search is running, so nothing can be stopped now
+            self.resume()
+            if kind == 'move':
+                move = self.replies.get(state.hash)
+                if move is None:
+                    move = self.search(state, 'move')
+                self.results.put(move)
+            elif kind == 'ponder':
+                self.ponder_position(state)
+
+    def search(self, state, kind):
+        """Runs the AI's search, reporting it to the profiler as the given
+        kind of search."""
+        if self.profiler is None:
+            return self.ai.search(state)
+        start = timeit.default_timer()
+        move = self.ai.search(state)
+        seconds = timeit.default_timer() - start
+        # SearchAI counts nodes, MCTSAI playouts; the basic AI neither
+        nodes = getattr(self.ai, 'nodes', getattr(self.ai, 'playouts', 0))
+        depth = getattr(self.ai, 'depth_reached', 0)
+        self.profiler.record_search(kind, seconds, nodes, depth)
+        return move
+
+    def predicted_moves(self, state):
+        """Returns the opponent's moves, most likely first: the ones that
+        look best for the opponent after a quick evaluation."""
+        scores = {}
+        for x in state.legal_moves():
+            state.push(x)
+            # evaluate() scores for the player to move, which is the AI
+            scores[x] = -search.evaluate(state)
+            state.pop()
+        return sorted(scores, key=lambda x: -scores[x])
+
+    def ponder_position(self, state):
+        self.replies = {}
+        for x in self.predicted_moves(state):
+            state.push(x)
+            # after a rotation, different moves can reach the same position
+            if state.hash not in self.replies and not state.winners() and \
+                    state.legal_moves():
+                with self.lock:
+                    # stop as soon as there is a real request to answer
+                    if not self.requests.empty() or \
+                            self.interrupted.is_set():
+                        state.pop()
+                        break
+                    self.pondering = state.hash
+                move = self.search(state.clone(), 'ponder')
+                with self.lock:
+                    self.pondering = None
+                if self.interrupted.is_set():
+                    # the search was cut short, so its move isn't trusted
+                    state.pop()
+                    break
+                self.replies[state.hash] = move
+            state.pop()
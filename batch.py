@@ -0,0 +1,156 @@
+"""Vectorized engine for applying the same operation to many boards at once.
+
+A BoardBatch holds N positions as an (N, width, height) int8 array indexed
+like Board.grid, so cells[n, x, y] is the team at (x, y) of board n (y = 0
+is the top row).  Every operation works on all boards in a few NumPy calls.
+
+This module needs NumPy, which the rest of the game does not."""
+
+import numpy
+
+import engine
+
+# (dx, dy) for the line directions, in the order Board.check_victory reports
+# them: horizontal, vertical, diagonal \ and diagonal /
+DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+
+
+def window_starts(team_cells, dx, dy):
+    """Returns an (N, width, height) bool array that is True at the first
+    cell of every 4-cell window, going in direction (dx, dy), whose cells are
+    all True in team_cells."""
+    n, width, height = team_cells.shape
+    starts = numpy.zeros(team_cells.shape, dtype=bool)
+    # range of start positions whose whole window fits on the board
+    x0, x1 = (0, width - 3 * dx) if dx >= 0 else (3, width)
+    y1 = height - 3 * dy
+    window = team_cells[:, x0:x1, 0:y1].copy()
+    for d in range(1, 4):
+        window &= team_cells[:, x0 + d * dx:x1 + d * dx, d * dy:y1 + d * dy]
+    starts[:, x0:x1, 0:y1] = window
+    return starts
+
+
+class BoardBatch(object):
+
+    """N boards of the same size, stored as one int8 array."""
+
+    def __init__(self, cells):
+        self.cells = numpy.ascontiguousarray(cells, dtype=numpy.int8)
+
+    @classmethod
+    def empty(cls, n, width=engine.BOARD_WIDTH, height=engine.BOARD_HEIGHT):
+        return cls(numpy.zeros((n, width, height), dtype=numpy.int8))
+
+    @classmethod
+    def from_bitboards(cls, boards):
+        """Builds a batch from a sequence of engine.BitBoards."""
+        boards = list(boards)
+        width, height = boards[0].width, boards[0].height
+        column_bits = height + 1
+        bits = numpy.array([[b.bits[1], b.bits[2]] for b in boards],
+                           dtype=numpy.uint64)
+        # bit index of each (x, y) cell
+        x = numpy.arange(width).reshape(width, 1)
+        y = numpy.arange(height).reshape(1, height)
+        index = (x * column_bits + height - 1 - y).astype(numpy.uint64)
+        one = numpy.uint64(1)
+        team1 = (bits[:, 0, None, None] >> index) & one
+        team2 = (bits[:, 1, None, None] >> index) & one
+        return cls((team1 + 2 * team2).astype(numpy.int8))
+
+    def to_bitboards(self):
+        """Returns a list of engine.BitBoards holding the same positions."""
+        n, width, height = self.cells.shape
+        column_bits = height + 1
+        x = numpy.arange(width).reshape(width, 1)
+        y = numpy.arange(height).reshape(1, height)
+        weights = (numpy.uint64(1) << (x * column_bits + height - 1 - y)
+                   .astype(numpy.uint64))
+        bits1 = ((self.cells == 1) * weights).sum(axis=(1, 2),
+                                                   dtype=numpy.uint64)
+        bits2 = ((self.cells == 2) * weights).sum(axis=(1, 2),
+                                                   dtype=numpy.uint64)
+        boards = []
+        for b1, b2 in zip(bits1.tolist(), bits2.tolist()):
+            board = engine.BitBoard(width, height)
+            board.bits[1] = b1
+            board.bits[2] = b2
+            board._update_heights()
+            boards.append(board)
+        return boards
+
+    def __len__(self):
+        return self.cells.shape[0]
+
+    def lowest_in_column(self, columns):
+        """Returns, for every board, the y-coordinate of the lowest empty
+        position in the given column (one column per board), or -1 if the
+        column is full."""
+        n, width, height = self.cells.shape
+        column = self.cells[numpy.arange(n), columns]
+        # first empty cell counting up from the bottom
+        empty = column[:, ::-1] == 0
+        lowest = height - 1 - numpy.argmax(empty, axis=1)
+        lowest[~empty.any(axis=1)] = -1
+        return lowest
+
+    def drop(self, columns, teams):
+        """Drops a piece for teams[n] into columns[n] of every board n whose
+        column isn't full.  Returns the y-coordinates, as lowest_in_column
+        does."""
+        rows = self.lowest_in_column(columns)
+        ok = rows >= 0
+        boards = numpy.nonzero(ok)[0]
+        self.cells[boards, numpy.asarray(columns)[ok], rows[ok]] = \
+            numpy.broadcast_to(teams, rows.shape)[ok]
+        return rows
+
+    def rotate(self, where=None):
+        """Rotates the boards like Board.rotate.  If where (a bool array) is
+        given, only the boards where it is True are rotated."""
+        rotated = numpy.rot90(self.cells, -1, axes=(1, 2))
+        if where is None:
+            self.cells = numpy.ascontiguousarray(rotated)
+        else:
+            self.cells[where] = rotated[where]
+
+    def make_pieces_fall(self):
+        """Moves the pieces down like Board.make_pieces_fall: each column is
+        compacted towards the bottom, keeping its pieces in order."""
+        # a stable sort on "is occupied" moves the empty cells to the top
+        # without reordering the pieces
+        order = numpy.argsort(self.cells != 0, axis=2, kind='stable')
+        self.cells = numpy.take_along_axis(self.cells, order, axis=2)
+
+    def winners(self):
+        """Returns an (N, 3) bool array; [n, team] is True if that team has
+        a 4-in-a-row on board n (column 0 is unused)."""
+        result = numpy.zeros((len(self), 3), dtype=bool)
+        for team in (1, 2):
+            team_cells = self.cells == team
+            for dx, dy in DIRECTIONS:
+                result[:, team] |= window_starts(team_cells, dx, dy).any(
+                    axis=(1, 2))
+        return result
+
+    def check_victory(self):
+        """Returns the winners (as winners() does) and, for every board, the
+        list of (winning team, line) pairs Board.check_victory would give."""
+        found = [[] for n in range(len(self))]
+        result = numpy.zeros((len(self), 3), dtype=bool)
+        for team in (1, 2):
+            team_cells = self.cells == team
+            for direction, (dx, dy) in enumerate(DIRECTIONS):
+                starts = window_starts(team_cells, dx, dy)
+                result[:, team] |= starts.any(axis=(1, 2))
+                for n, x, y in zip(*numpy.nonzero(starts)):
+                    x, y = int(x), int(y)
+                    line = [(x + d * dx, y + d * dy) for d in range(4)]
+                    found[n].append(((x, y), direction, team, line))
+        lines = []
+        for board_lines in found:
+            board_lines.sort()
+            lines.append([(team, line)
+                          for (start, direction, team, line) in board_lines])
+        return result, lines
@@ -0,0 +1,408 @@
+#!/usr/bin/env python2
+"""Benchmarks for the engine, the AIs and rendering.
+
+    $ python benchmark.py --save baseline.json
+    $ python benchmark.py --baseline baseline.json --threshold 0.2
+
+Every benchmark times single operations on positions from games of random
+moves with a fixed seed, and reports operations per second and percentiles
+of the time per operation.  Results can be saved as a baseline; when a
+baseline is given, any benchmark whose median time per operation has grown
+by more than the threshold is reported and the run fails.
+
+engine.rotate_fall_victory and grid.rotate_fall_victory do the same work
+(rotate, let the pieces fall, find the lines) on the bitboard engine and on
+the list-of-lists board the game used before it; the engine is about seven
+times faster.  positiondb.ingest adds one game of random moves (about 17
+positions) per operation.  Rendering runs on pygame's dummy video driver,
+so no window is needed."""
+from __future__ import print_function
+
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+# render without a window, and keep pygame's banner out of the report
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame  # noqa: E402
+
+import engine  # noqa: E402
+import gamerecord  # noqa: E402
+import main  # noqa: E402
+import positiondb  # noqa: E402
+import search  # noqa: E402
+
+POSITION_SEED = 1
+NUM_POSITIONS = 32
+# games of random moves that positiondb.ingest cycles through
+NUM_GAMES = 200
+
+DEFAULT_THRESHOLD = 0.2
+
+PERCENTILES = (50, 90, 99)
+
+# depth of the alpha-beta searches, which get no time limit so they do the
+# same work every run
+SEARCH_DEPTH = 3
+
+
+def random_positions(count=NUM_POSITIONS, seed=POSITION_SEED):
+    """Returns engine.GameStates from games of random moves, with between 6
+    and 30 pieces on the board and the game not over."""
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        state = engine.GameState()
+        for ply in range(rng.randint(6, 30)):
+            moves = state.legal_moves()
+            if not moves:
+                break
+            state.push(rng.choice(moves))
+            if state.winners():
+                break
+        if not state.winners() and state.legal_moves():
+            state.history = []
+            positions.append(state)
+    return positions
+
+
+def init_display():
+    """Sets up a screen for the benchmarks that need pygame surfaces."""
+    screen = pygame.display.get_surface()
+    if screen is None:
+        pygame.init()
+        screen = pygame.display.set_mode((main.WINDOW_WIDTH,
+                                          main.WINDOW_HEIGHT))
+    return screen
+
+
+def load_board(board, bitboard):
+    """Makes the engine.Board hold the position of the engine.BitBoard."""
+    board.state = bitboard.copy()
+
+
+def cycle(items):
+    """Returns a setup function that hands out the items in turn."""
+    items = list(items)
+    counter = [0]
+
+    def setup():
+        item = items[counter[0] % len(items)]
+        counter[0] += 1
+        return item
+    return setup
+
+
+def board_rotate(positions):
+    boards = []
+    for state in positions:
+        board = engine.Board(state.board.width, state.board.height)
+        load_board(board, state.board)
+        boards.append(board)
+    return cycle(boards), engine.Board.rotate
+
+
+def board_make_pieces_fall(positions):
+    board = engine.Board(engine.BOARD_WIDTH, engine.BOARD_HEIGHT)
+    rotated = []
+    for state in positions:
+        bitboard = state.board.copy()
+        bitboard.rotate()
+        rotated.append(bitboard)
+    next_position = cycle(rotated)
+
+    def setup():
+        load_board(board, next_position())
+        return board
+    return setup, engine.Board.make_pieces_fall
+
+
+def board_check_victory(positions):
+    boards = []
+    for state in positions:
+        board = engine.Board(state.board.width, state.board.height)
+        load_board(board, state.board)
+        boards.append(board)
+    return cycle(boards), engine.Board.check_victory
+
+
+class GridBoard(object):
+
+    """The board as the game kept it before the engine: a list of columns,
+    rotated, dropped and scanned cell by cell.  Only here to measure the
+    engine against."""
+
+    def __init__(self, bitboard):
+        self.width = bitboard.width
+        self.height = bitboard.height
+        self.grid = [[bitboard.cell(x, y) for y in range(self.height)]
+                     for x in range(self.width)]
+
+    def rotate(self):
+        old_grid = self.grid
+        self.grid = [[old_grid[self.height - y - 1][x]
+                      for y in range(self.height)]
+                     for x in range(self.width)]
+
+    def make_pieces_fall(self):
+        grid = self.grid
+        for y in range(self.height - 2, -1, -1):
+            for x in range(self.width):
+                cy = y
+                while cy < self.height - 1 and not grid[x][cy + 1] \
+                        and grid[x][cy]:
+                    grid[x][cy + 1] = grid[x][cy]
+                    grid[x][cy] = 0
+                    cy += 1
+
+    def check_victory(self):
+        grid = self.grid
+        found = []
+        for x in range(self.width):
+            for y in range(self.height):
+                if grid[x][y] == 0:
+                    continue
+                lines = []
+                if x < self.width - 3:
+                    lines.append([(x1, y) for x1 in range(x, x + 4)])
+                if y < self.height - 3:
+                    lines.append([(x, y1) for y1 in range(y, y + 4)])
+                if x < self.width - 3 and y < self.height - 3:
+                    lines.append([(x + d, y + d) for d in range(4)])
+                if x >= 3 and y < self.height - 3:
+                    lines.append([(x - d, y + d) for d in range(4)])
+                for line in lines:
+                    if all(grid[x1][y1] == grid[x][y]
+                           for (x1, y1) in line[1:]):
+                        found.append((grid[x][y], line))
+        return found
+
+
+def grid_rotate_fall_victory(positions):
+    boards = [GridBoard(state.board) for state in positions]
+
+    def run(board):
+        board.rotate()
+        board.make_pieces_fall()
+        board.check_victory()
+    return cycle(boards), run
+
+
+def engine_rotate_fall_victory(positions):
+    boards = [state.board.copy() for state in positions]
+
+    def run(board):
+        board.rotate_and_fall()
+        board.check_victory()
+    return cycle(boards), run
+
+
+def get_move(make_ai, turns_til_rotation):
+    """Returns a benchmark of an AI's get_move, with the given number of
+    moves left until the board rotates."""
+    def benchmark(positions):
+        # the basic AI breaks ties with the module-level random generator
+        random.seed(POSITION_SEED)
+        boards = []
+        for state in positions:
+            board = engine.Board(state.board.width, state.board.height)
+            load_board(board, state.board)
+            boards.append(board)
+        next_board = cycle(boards)
+
+        def setup():
+            # a fresh AI, so no search reuses the last one's results
+            return make_ai(), next_board()
+
+        def run(args):
+            ai, board = args
+            ai.get_move(board, turns_til_rotation)
+        return setup, run
+    return benchmark
+
+
+def basic_ai():
+    return main.AI(2)
+
+
+def search_ai():
+    return search.SearchAI(2, budget_ms=10 ** 9, max_depth=SEARCH_DEPTH)
+
+
+def frame_render(positions):
+    screen = init_display()
+    game = main.Game(screen, ai=False)
+    load_board(game.board, positions[0].board)
+    game.board.update_image()
+
+    def run(game):
+        game.render_background()
+        game.render_board()
+    return (lambda: game), run
+
+
+def positiondb_ingest(positions):
+    """Adds one recorded game at a time to a position database that starts
+    out big enough not to grow during the run."""
+    rng = random.Random(POSITION_SEED)
+    records = []
+    for i in range(NUM_GAMES):
+        state = engine.GameState()
+        moves = []
+        while state.legal_moves() and not state.winners():
+            moves.append(rng.choice(state.legal_moves()))
+            state.push(moves[-1])
+        record = gamerecord.unpack_game(gamerecord.pack_game(
+            moves, winner=rng.randint(0, 2)))
+        record.moves
+        records.append(record)
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    db = positiondb.create(os.path.join(directory, 'positions.db'),
+                           capacity=1 << 18)
+
+    def run(record):
+        db.ingest([record])
+    return cycle(records), run
+
+
+# name, benchmark factory, operations to time
+BENCHMARKS = [
+    ('board.rotate', board_rotate, 5000),
+    ('board.make_pieces_fall', board_make_pieces_fall, 5000),
+    ('board.check_victory', board_check_victory, 5000),
+    ('engine.rotate_fall_victory', engine_rotate_fall_victory, 5000),
+    ('grid.rotate_fall_victory', grid_rotate_fall_victory, 5000),
+    ('basic.get_move', get_move(basic_ai, 2), 2000),
+    ('basic.get_move.rotating', get_move(basic_ai, 1), 2000),
+    ('alphabeta.get_move', get_move(search_ai, 2), 40),
+    ('alphabeta.get_move.rotating', get_move(search_ai, 1), 40),
+    ('render.frame', frame_render, 300),
+    ('positiondb.ingest', positiondb_ingest, 2000),
+]
+
+
+def percentile(sorted_values, p):
+    """Returns the p-th percentile of the sorted values, by the nearest
+    rank."""
+    k = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[k]
+
+
+def measure(setup, run, number, warmup=None):
+    """Times number calls of run(setup()), timing only run, and returns the
+    statistics as a dict.  Times are in microseconds."""
+    timer = timeit.default_timer
+    if warmup is None:
+        warmup = max(1, number // 10)
+    for i in range(warmup):
+        run(setup())
+    times = []
+    for i in range(number):
+        arg = setup()
+        start = timer()
+        run(arg)
+        times.append(timer() - start)
+    total = sum(times)
+    times.sort()
+    result = {
+        'n': number,
+        'ops_per_sec': number / total if total else float('inf'),
+        'mean_us': total / number * 1e6,
+    }
+    for p in PERCENTILES:
+        result['p%d_us' % p] = percentile(times, p) * 1e6
+    return result
+
+
+def run_benchmarks(names=None, scale=1.0, positions=None, progress=None):
+    """Runs the benchmarks (all of them, or the ones named) and returns
+    their results by name.  scale multiplies the number of operations
+    timed.  progress, if given, is called as progress(name, result)."""
+    if positions is None:
+        positions = random_positions()
+    results = {}
+    for name, factory, number in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        setup, run = factory(positions)
+        result = measure(setup, run, max(1, int(number * scale)))
+        results[name] = result
+        if progress:
+            progress(name, result)
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Returns (name, baseline median, new median) for every benchmark whose
+    median time per operation is more than threshold (a fraction) above the
+    baseline's."""
+    regressions = []
+    for name in sorted(results):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        new_median = results[name]['p50_us']
+        old_median = old['p50_us']
+        if new_median > old_median * (1 + threshold):
+            regressions.append((name, old_median, new_median))
+    return regressions
+
+
+def format_result(name, result):
+    return '%-28s %11.1f ops/s %9.1f us p50 %9.1f us p90 %9.1f us p99' % (
+        name, result['ops_per_sec'], result['p50_us'], result['p90_us'],
+        result['p99_us'])
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Grav-Twist engine, AIs and rendering.")
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="benchmarks to run (default: all of %s)" %
+                        ', '.join(name for name, f, n in BENCHMARKS))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiplies the number of operations timed")
+    parser.add_argument('--save', metavar='PATH',
+                        help="write the results to a baseline file")
+    parser.add_argument('--baseline', metavar='PATH',
+                        help="fail if a benchmark is slower than in this "
+                        "baseline file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown of the median, as a fraction")
+    args = parser.parse_args()
+    known = set(name for name, f, n in BENCHMARKS)
+    for name in args.names:
+        if name not in known:
+            parser.error("unknown benchmark %r" % name)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args.names or None, args.scale,
+                             progress=lambda name, result:
+                             print(format_result(name, result)))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print("REGRESSION %s: median %.1f us -> %.1f us (%+.0f%%)" % (
+                name, old, new, (new / old - 1) * 100), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
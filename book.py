@@ -0,0 +1,207 @@
+#!/usr/bin/env python2
+"""Opening book: the AI's moves for the first few plies, searched ahead of
+time.
+
+    $ python book.py --depth 4 --budget-ms 500 -o opening.book
+
+The builder expands every line of play from the starting position to the
+given depth, searches each position it reaches with the alpha-beta AI and
+writes the chosen moves to a file.  The file is a short header followed by
+fixed-size records sorted by position hash, so OpeningBook can mmap it and
+binary-search it at move time without reading it in.  Processes that open
+the same book share its pages."""
+from __future__ import print_function
+
+import argparse
+import mmap
+import multiprocessing
+import struct
+import sys
+import time
+
+import engine
+import mcts
+import search
+
+MAGIC = b'GTBOOK1\0'
+
+# magic, number of records, board width, board height, win length, rotate
+# time
+HEADER = struct.Struct('<8sIBBBB')
+
+# position hash, move, depth searched, score for the player to move
+RECORD = struct.Struct('<QBBxxi')
+
+DEFAULT_DEPTH = 4
+DEFAULT_BUDGET_MS = 500
+
+
+class OpeningBook(object):
+
+    """A book file, mapped into memory read-only."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError("%s is not an opening book" % path)
+        (magic, self.size, self.width, self.height, self.win_length,
+         self.rotate_time) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or \
+                len(self.map) != HEADER.size + self.size * RECORD.size:
+            raise ValueError("%s is not an opening book" % path)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.map.close()
+
+    def probe(self, key):
+        """Returns (move, depth, score) for the position hash, or None if
+        the book doesn't hold it."""
+        data = self.map
+        lo = 0
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = RECORD.unpack_from(data,
+                                        HEADER.size + mid * RECORD.size)
+            if record[0] < key:
+                lo = mid + 1
+            elif record[0] > key:
+                hi = mid
+            else:
+                return record[1:]
+        return None
+
+    def lookup(self, state):
+        """Returns the book move for the engine.GameState, or None if the
+        book has none."""
+        board = state.board
+        if (board.width, board.height, board.win_length,
+                state.rotate_time) != (self.width, self.height,
+                                       self.win_length, self.rotate_time):
+            self.misses += 1
+            return None
+        entry = self.probe(state.hash)
+        if entry is None or entry[0] not in state.legal_moves():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+
+def expand(state, depth):
+    """Returns the positions reachable from the state in fewer than depth
+    plies where the game isn't over, with no position twice."""
+    positions = {}
+    frontier = [state.clone()]
+    for ply in range(depth):
+        next_frontier = []
+        for position in frontier:
+            if position.hash in positions:
+                continue
+            positions[position.hash] = position
+            for x in position.legal_moves():
+                child = position.clone()
+                child.push(x)
+                if not child.winners() and child.legal_moves():
+                    next_frontier.append(child)
+        frontier = next_frontier
+    return list(positions.values())
+
+
+def search_position(args):
+    """Searches one position and returns its record as a tuple.  Takes a
+    single (mcts.state_to_args tuple, budget_ms) tuple so it can be mapped
+    over a pool."""
+    state_args, budget_ms = args
+    state = mcts.state_from_args(state_args)
+    ai = search.SearchAI(state.active_player, budget_ms)
+    move = ai.search(state)
+    score = max(-search.INFINITY, min(search.INFINITY, ai.score))
+    return state.hash, move, ai.depth_reached, score
+
+
+def build(output, depth=DEFAULT_DEPTH, budget_ms=DEFAULT_BUDGET_MS,
+          processes=None, state=None, progress=None):
+    """Searches every position in the first depth plies from the state (by
+    default the start of a game) and writes the book to the output file.
+
+    progress, if given, is called as progress(positions searched, total).
+    Returns the number of records written."""
+    if state is None:
+        state = engine.GameState()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    jobs = [(mcts.state_to_args(position), budget_ms)
+            for position in expand(state, depth)]
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(search_position, jobs)
+    else:
+        pool = None
+        results = (search_position(job) for job in jobs)
+    records = []
+    try:
+        for record in results:
+            records.append(record)
+            if progress:
+                progress(len(records), len(jobs))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    records.sort()
+    board = state.board
+    output.write(HEADER.pack(MAGIC, len(records), board.width, board.height,
+                             board.win_length, state.rotate_time))
+    for record in records:
+        output.write(RECORD.pack(*record))
+    return len(records)
+
+
+def main_book():
+    parser = argparse.ArgumentParser(
+        description="Build a Grav-Twist opening book.")
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH,
+                        help="plies from the start of the game to cover")
+    parser.add_argument('--budget-ms', type=int, default=DEFAULT_BUDGET_MS,
+                        help="search time per position")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--size', type=int, default=engine.BOARD_WIDTH,
+                        help="width and height of the board (at most %d)" %
+                        engine.MAX_BOARD_SIZE)
+    parser.add_argument('--win-length', type=int, default=engine.WIN_LENGTH,
+                        help="pieces in a row needed to win")
+    parser.add_argument('--rotate-time', type=int, default=engine.ROTATE_TIME,
+                        help="moves between board rotations")
+    parser.add_argument('-o', '--output', required=True)
+    args = parser.parse_args()
+    try:
+        engine.check_rules(args.size, args.win_length, args.rotate_time)
+    except ValueError as e:
+        parser.error(str(e))
+    state = engine.GameState(
+        engine.BitBoard(args.size, args.size, args.win_length), 1,
+        args.rotate_time, args.rotate_time)
+
+    def progress(finished, total):
+        if finished % 100 == 0 or finished == total:
+            print("%d/%d positions" % (finished, total), file=sys.stderr)
+
+    start = time.time()
+    with open(args.output, 'wb') as output:
+        size = build(output, args.depth, args.budget_ms, args.processes,
+                     state, progress)
+    print("%d positions in %.1f sec" % (size, time.time() - start),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main_book()
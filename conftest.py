@@ -0,0 +1,5 @@
+"""pytest settings."""
+import sys
+
+# the server tests use async syntax, which Python 2 can't parse
+collect_ignore = ['test_server.py'] if sys.version_info[0] < 3 else []
@@ -0,0 +1,98 @@
+"""The parts of the game that don't need a display: the basic AI, and the
+AI strategies by name.
+
+The rules live in engine and the searching AIs in search and mcts; none of
+them, nor this module, imports pygame.  Headless tools (self-play, the
+server, the opening book builder) and their pool workers only import these,
+so they start without loading or initializing pygame.  main re-exports AI,
+AI_STRATEGIES and DEFAULT_AI_STRATEGY."""
+
+import random
+
+import engine
+import mcts
+import search
+
+
+class AI(object):
+
+    def __init__(self, team, book=None, positions=None):
+        self.team = team
+        # a book.OpeningBook to play the first moves from, or None
+        self.book = book
+        # a positiondb.PositionDB to pick the moves that did best in
+        # recorded games, instead of random ones, or None
+        self.positions = positions
+
+    def check_victory(self, state, x):
+        """Drops a piece for each team into column x (rotating the board if
+        that move triggers a rotation), and checks if it would give victory.
+        Right afterwards, takes the piece back.
+
+        Returns a list of the teams that would have a 4-in-a-row."""
+        enemy_team = 3 - self.team
+        victory = []
+
+        if state.board.heights[x] < state.board.height:
+            for team in (self.team, enemy_team):
+                state.push(x, team)
+                victory.extend(state.winners())
+                state.pop()
+
+        return victory
+
+    def get_move(self, board, turns_til_rotation,
+                 rotate_time=engine.ROTATE_TIME):
+        """Returns the column # to drop the piece in, in a game where the
+        board rotates every rotate_time moves."""
+
+        # if the board is about to rotate, we want the AI to simulate that and
+        # catch 4-in-a-rows that result from this.
+        state = engine.GameState(board.state.copy(), self.team,
+                                 turns_til_rotation, rotate_time)
+        return self.search(state)
+
+    def search(self, state, budget_ms=None):
+        """Returns the column # to drop the piece in for the given
+        engine.GameState.  The basic AI doesn't need a time budget."""
+        if self.book is not None:
+            move = self.book.lookup(state)
+            if move is not None:
+                return move
+        board = state.board
+
+        # see if any team could win by dropping a piece into a column
+        line_completions = [self.check_victory(state, x)
+                            for x in range(board.width)]
+
+        # first of all, if we can make a 4-in-a-row, do it!
+        for x, c in enumerate(line_completions):
+            if self.team in c:
+                return x
+
+        # blocking an opponent's 4-in-a-row is the 2nd highest piority
+        for x, c in enumerate(line_completions):
+            if c:
+                return x
+
+        if self.positions is not None:
+            move = self.positions.best_move(state)
+            if move is not None:
+                return move
+
+        # otherwise, just go in a random spot that isn't full
+        moves = state.legal_moves()
+        if moves:
+            return random.choice(moves)
+        return random.randint(0, board.width - 1)
+
+
+# AI strategies that main.Game, self-play and the server can be told to
+# use, by name
+AI_STRATEGIES = {
+    'basic': AI,
+    'alphabeta': search.SearchAI,
+    'mcts': mcts.MCTSAI,
+}
+
+DEFAULT_AI_STRATEGY = 'basic'
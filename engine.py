@@ -0,0 +1,982 @@
+"""Display-free game engine for Grav-Twist Connect 4.
+
+Positions are stored as bitboards: one packed integer per player plus a
+per-column height index.  Column x occupies bits x * (H + 1) to
+x * (H + 1) + H - 1, where bit r within a column is the r-th row counted from
+the bottom (so grid row y is bit r = H - 1 - y).  The extra bit at the top of
+every column is always empty, which keeps horizontal and diagonal shifts from
+wrapping into the neighbouring column.
+"""
+
+import random
+
+BOARD_WIDTH = 7
+BOARD_HEIGHT = 7
+
+ROTATE_TIME = 3
+
+# pieces in a row needed to win
+WIN_LENGTH = 4
+
+# Zobrist keys are derived from this seed, so hashes stay the same from one
+# process (and one run) to the next
+ZOBRIST_SEED = 0x6752
+# longest rotation interval the Zobrist keys cover
+MAX_ROTATE_TIME = 64
+
+# widest and tallest board played on.  The fall tables have 4 ** height
+# entries (a third of a second to build at 10, four times that at 11), and
+# the transposition table stores moves in 4 bits.
+MAX_BOARD_SIZE = 10
+
+# (dx, dy) steps of the line directions, in the order check_victory reports
+# them: horizontal, vertical, diagonal \ and diagonal /
+LINE_STEPS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+
+
+class Geometry(object):
+
+    """Masks and lookup tables shared by every board of the same size and
+    win length."""
+
+    def __init__(self, width, height, win_length=WIN_LENGTH):
+        if not 1 <= width <= MAX_BOARD_SIZE or \
+                not 1 <= height <= MAX_BOARD_SIZE:
+            raise ValueError("boards can be at most %d by %d" %
+                             (MAX_BOARD_SIZE, MAX_BOARD_SIZE))
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.column_bits = height + 1
+        self.column_mask = (1 << height) - 1
+
+        self.bottom_mask = 0
+        for x in range(width):
+            self.bottom_mask |= 1 << (x * self.column_bits)
+        # every playable cell, excluding the sentinel bit of each column
+        self.board_mask = self.bottom_mask * self.column_mask
+        # rows_from[r]: every cell in row r (counted from the bottom) or
+        # above it
+        self.rows_from = [self.board_mask & ~((self.bottom_mask << r) -
+                                              self.bottom_mask)
+                          for r in range(height + 1)]
+
+        # shifts for the four line directions, in the order check_victory
+        # reports them: horizontal, vertical, diagonal \ and diagonal /
+        self.directions = (self.column_bits, 1, height, height + 2)
+        # shifts that narrow a bitboard down to the first cell of every
+        # line: each one ANDs in a copy shifted by that many steps, doubling
+        # the covered run until it is win_length long
+        self.line_shifts = []
+        run = 1
+        while run < win_length:
+            step = min(run, win_length - run)
+            self.line_shifts.append(step)
+            run += step
+        # the line tests for this win length; the general ones loop over
+        # line_shifts, so 4 in a row keeps its unrolled versions
+        if win_length == 4:
+            self.has_line = has_four
+            self.winning_cells = winning_cells
+        else:
+            self.has_line = has_line
+            self.winning_cells = line_completions
+
+        # rotation: an old column becomes a row of the new board, so for
+        # every possible column pattern precompute where its pieces land
+        # when that column is column 0; other columns are shifted up by x
+        self.rotate_spread = []
+        for pattern in range(1 << height):
+            spread = 0
+            for r in range(height):
+                if pattern >> r & 1:
+                    spread |= 1 << ((height - 1 - r) * self.column_bits)
+            self.rotate_spread.append(spread)
+
+        # number of filled cells before the first empty one, counted from
+        # the bottom, for every possible column occupancy pattern
+        self.stack_height = []
+        for pattern in range(1 << height):
+            self.stack_height.append((~pattern & (pattern + 1)).bit_length()
+                                     - 1)
+
+        # gravity: a column's contents are its occupancy pattern plus the
+        # pattern of team 1's pieces (a subset of it), so the 3 ** height
+        # possible columns are looked up by occupancy << height | team 1.
+        # For each, fall_team1 gives team 1's pattern once the column is
+        # compacted, and fall_moves the (from row, to row) of every piece
+        # that moves, counting rows from the bottom.
+        self.stack_count = [bin(pattern).count('1')
+                            for pattern in range(1 << height)]
+        self.fall_team1 = [0] * (1 << (2 * height))
+        self.fall_moves = [()] * (1 << (2 * height))
+        for occupancy in range(1 << height):
+            team1 = occupancy
+            while True:
+                compacted = 0
+                moves = []
+                for k, r in enumerate(r for r in range(height)
+                                      if occupancy >> r & 1):
+                    if team1 >> r & 1:
+                        compacted |= 1 << k
+                    if k != r:
+                        moves.append((r, k))
+                key = occupancy << height | team1
+                self.fall_team1[key] = compacted
+                self.fall_moves[key] = tuple(moves)
+                if not team1:
+                    break
+                team1 = (team1 - 1) & occupancy
+
+        # rotation followed by gravity: new column x is old row
+        # height - 1 - x, whose cells lie column_bits apart.  A row's
+        # occupancy plus team 1's pieces shifted up by one bit is looked up
+        # in rotate_fall, which gives the new column's team 1 and team 2
+        # patterns once compacted, and its height.  Only square boards
+        # rotate, so other boards don't get the table.
+        self.rotate_fall = None
+        if width == height:
+            spread = [0] * (1 << height)
+            for pattern in range(1 << height):
+                for k in range(height):
+                    if pattern >> k & 1:
+                        spread[pattern] |= 1 << (k * self.column_bits)
+            self.rotate_fall = {}
+            for key in range(1 << (2 * height)):
+                occupancy, team1 = key >> height, key & self.column_mask
+                if team1 & ~occupancy:
+                    continue
+                compacted = self.fall_team1[key]
+                count = self.stack_count[occupancy]
+                self.rotate_fall[spread[occupancy] | spread[team1] << 1] = (
+                    compacted, ((1 << count) - 1) ^ compacted, count)
+
+        # Zobrist keys: one per team per bit index, plus keys for the player
+        # to move and for the number of moves until the next rotation.
+        # mirror_keys hold the key of the left/right mirrored cell, so a
+        # position's mirror image can be hashed alongside it.
+        rng = random.Random(ZOBRIST_SEED + width * 256 + height)
+        size = width * self.column_bits
+        self.piece_keys = [None] + [[rng.getrandbits(64) for i in range(size)]
+                                    for team in (1, 2)]
+        self.mirror_keys = [None]
+        for team in (1, 2):
+            keys = self.piece_keys[team]
+            self.mirror_keys.append([keys[self.mirror_index(i)]
+                                     for i in range(size)])
+        self.side_key = rng.getrandbits(64)
+        self.turn_keys = [rng.getrandbits(64)
+                          for n in range(MAX_ROTATE_TIME + 1)]
+
+        # every win_length-cell window a line can occupy, numbered in the
+        # order check_victory reports lines (by first cell, then direction),
+        # and the windows through each cell
+        self.window_cells = []
+        self.window_masks = []
+        self.cell_windows = [[] for i in range(size)]
+        for x in range(width):
+            for y in range(height):
+                for dx, dy in LINE_STEPS:
+                    cells = [(x + d * dx, y + d * dy)
+                             for d in range(win_length)]
+                    if not all(0 <= cx < width and 0 <= cy < height
+                               for (cx, cy) in cells):
+                        continue
+                    w = len(self.window_cells)
+                    mask = 0
+                    for (cx, cy) in cells:
+                        mask |= self.bit(cx, cy)
+                        self.cell_windows[self.index(cx, cy)].append(w)
+                    self.window_cells.append(cells)
+                    self.window_masks.append(mask)
+
+        # the cells of the line starting at each bit index, by direction,
+        # as check_victory reports them: vertical and / lines from their
+        # top cell
+        self.line_cells = []
+        for direction, s in enumerate(self.directions):
+            starts = self.board_mask
+            for k in self.line_shifts:
+                starts &= starts >> (k * s)
+            lines = [None] * size
+            for i in iterate_bits(starts):
+                line = [self.position(i + d * s) for d in range(win_length)]
+                if direction in (1, 3):
+                    line.reverse()
+                lines[i] = tuple(line)
+            self.line_cells.append(lines)
+
+        # the window each window turns into when the board rotates
+        self.rotated_windows = None
+        if width == height:
+            windows_by_mask = dict((mask, w) for w, mask
+                                   in enumerate(self.window_masks))
+            self.rotated_windows = []
+            for mask in self.window_masks:
+                rotated = 0
+                for i in iterate_bits(mask):
+                    rotated |= 1 << self.rotated_index(i)
+                self.rotated_windows.append(windows_by_mask[rotated])
+
+    def index(self, x, y):
+        return x * self.column_bits + self.height - 1 - y
+
+    def bit(self, x, y):
+        return 1 << (x * self.column_bits + self.height - 1 - y)
+
+    def rotated_index(self, index):
+        """Returns the bit index a cell moves to when the board rotates."""
+        x, r = divmod(index, self.column_bits)
+        return (self.height - 1 - r) * self.column_bits + x
+
+    def mirror_index(self, index):
+        """Returns the bit index of the cell mirrored left to right."""
+        x, r = divmod(index, self.column_bits)
+        return (self.width - 1 - x) * self.column_bits + r
+
+    def position(self, index):
+        """Converts a bit index into (x, y) grid coordinates."""
+        x, r = divmod(index, self.column_bits)
+        return (x, self.height - 1 - r)
+
+
+def check_rules(size, win_length, rotate_time):
+    """Raises ValueError unless a game can be played on a size by size
+    board, with win_length in a row to win and a rotation every rotate_time
+    moves."""
+    if not 2 <= size <= MAX_BOARD_SIZE:
+        raise ValueError("the board size must be between 2 and %d" %
+                         MAX_BOARD_SIZE)
+    if not 2 <= win_length <= size:
+        raise ValueError("the win length must be between 2 and the board "
+                         "size")
+    if not 1 <= rotate_time <= MAX_ROTATE_TIME:
+        raise ValueError("the rotate time must be between 1 and %d" %
+                         MAX_ROTATE_TIME)
+
+
+_geometries = {}
+
+
+def get_geometry(width, height, win_length=WIN_LENGTH):
+    """Returns the (cached) Geometry for boards of the given size and win
+    length."""
+    key = (width, height, win_length)
+    geometry = _geometries.get(key)
+    if geometry is None:
+        geometry = _geometries[key] = Geometry(width, height, win_length)
+    return geometry
+
+
+def iterate_bits(bits):
+    """Yields the index of every set bit, lowest first."""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def has_four(bits, geometry):
+    """Returns True if the given player bitboard contains a 4-in-a-row."""
+    for s in geometry.directions:
+        m = bits & (bits >> s)
+        if m & (m >> (2 * s)):
+            return True
+    return False
+
+
+def winning_cells(bits, empty, geometry):
+    """Returns a bitboard of the empty cells that would complete a 4-in-a-row
+    for the given player bitboard."""
+    found = 0
+    for s in geometry.directions:
+        pair = (bits << s) & (bits << (2 * s))
+        found |= pair & (bits << (3 * s))
+        found |= pair & (bits >> s)
+        pair = (bits >> s) & (bits >> (2 * s))
+        found |= pair & (bits << s)
+        found |= pair & (bits >> (3 * s))
+    return found & empty
+
+
+def has_line(bits, geometry):
+    """Returns True if the given player bitboard contains a line of
+    geometry.win_length pieces."""
+    shifts = geometry.line_shifts
+    for s in geometry.directions:
+        m = bits
+        for k in shifts:
+            m &= m >> (k * s)
+        if m:
+            return True
+    return False
+
+
+def line_completions(bits, empty, geometry):
+    """Returns a bitboard of the empty cells that would complete a line of
+    geometry.win_length pieces for the given player bitboard."""
+    n = geometry.win_length
+    found = 0
+    for s in geometry.directions:
+        # the empty cell is the k-th of the line
+        for k in range(n):
+            cells = geometry.board_mask
+            for d in range(-k, n - k):
+                if d > 0:
+                    cells &= bits >> (d * s)
+                elif d < 0:
+                    cells &= bits << (-d * s)
+            found |= cells
+    return found & empty
+
+
+def zobrist_hash(bits, keys):
+    """Hashes a pair of player bitboards (bits[1] and bits[2]) with the given
+    per-team Zobrist keys."""
+    h = 0
+    for team in (1, 2):
+        team_keys = keys[team]
+        for i in iterate_bits(bits[team]):
+            h ^= team_keys[i]
+    return h
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+class BitBoard(object):
+
+    """Two-dimensional Connect 4 board stored as one bitboard per player."""
+
+    __slots__ = ('width', 'height', 'geometry', 'bits', 'heights')
+
+    def __init__(self, width=BOARD_WIDTH, height=BOARD_HEIGHT,
+                 win_length=WIN_LENGTH):
+        self.width = width
+        self.height = height
+        self.geometry = get_geometry(width, height, win_length)
+        # bits[0] is unused so that bits[team] works for teams 1 and 2
+        self.bits = [0, 0, 0]
+        # number of pieces stacked from the bottom of each column
+        self.heights = [0] * width
+
+    def occupied(self):
+        return self.bits[1] | self.bits[2]
+
+    def empty(self):
+        return self.geometry.board_mask & ~(self.bits[1] | self.bits[2])
+
+    def cell(self, x, y):
+        """Returns the team occupying (x, y), or 0 if it is empty."""
+        b = self.geometry.bit(x, y)
+        if self.bits[1] & b:
+            return 1
+        if self.bits[2] & b:
+            return 2
+        return 0
+
+    def set_cell(self, x, y, team):
+        """Places a piece (or 0 for empty) at (x, y), ignoring gravity."""
+        b = self.geometry.bit(x, y)
+        self.bits[1] &= ~b
+        self.bits[2] &= ~b
+        if team:
+            self.bits[team] |= b
+        self._update_height(x)
+
+    def _update_height(self, x):
+        g = self.geometry
+        column = (self.occupied() >> (x * g.column_bits)) & g.column_mask
+        self.heights[x] = g.stack_height[column]
+
+    def _update_heights(self):
+        g = self.geometry
+        stack_height = g.stack_height
+        column_mask = g.column_mask
+        column_bits = g.column_bits
+        occupied = self.bits[1] | self.bits[2]
+        heights = self.heights
+        for x in range(self.width):
+            heights[x] = stack_height[occupied & column_mask]
+            occupied >>= column_bits
+
+    def lowest_in_column(self, column):
+        """Returns the y-coordinate for the lowest empty position in the given
+        column.
+        Returns -1 if the column is full"""
+        return self.height - 1 - self.heights[column]
+
+    def column_blocked(self, column):
+        return self.cell(column, 0) != 0
+
+    def drop(self, column, team):
+        """Drops a piece for the team into the column and returns its y."""
+        r = self.heights[column]
+        self.bits[team] |= 1 << (column * self.geometry.column_bits + r)
+        self.heights[column] = r + 1
+        if r + 1 < self.height and self.occupied() >> (
+                column * self.geometry.column_bits + r + 1) & 1:
+            # the piece plugged a gap below floating pieces
+            self._update_height(column)
+        return self.height - 1 - r
+
+    def rotate(self):
+        """Rotates the board 90 degrees counter-clockwise, without gravity."""
+        if self.width != self.height:
+            raise ValueError("only square boards can be rotated")
+        g = self.geometry
+        spread = g.rotate_spread
+        column_mask = g.column_mask
+        column_bits = g.column_bits
+        b1, b2 = self.bits[1], self.bits[2]
+        n1 = n2 = 0
+        for x in range(self.width):
+            n1 |= spread[b1 & column_mask] << x
+            n2 |= spread[b2 & column_mask] << x
+            b1 >>= column_bits
+            b2 >>= column_bits
+        self.bits[1], self.bits[2] = n1, n2
+        self._update_heights()
+
+    def make_pieces_fall(self):
+        """Moves every piece down until it rests on another piece or on the
+        bottom of the board.
+
+        Adding one to the bottom of every column carries through the pieces
+        that are already resting, so whatever is left of the occupancy is
+        floating; each pass moves all floating pieces down by one cell."""
+        bottom_mask = self.geometry.bottom_mask
+        b1, b2 = self.bits[1], self.bits[2]
+        while True:
+            occupied = b1 | b2
+            floating = occupied & (occupied + bottom_mask)
+            if not floating:
+                break
+            b1 = (b1 & ~floating) | ((b1 & floating) >> 1)
+            b2 = (b2 & ~floating) | ((b2 & floating) >> 1)
+        self.bits[1], self.bits[2] = b1, b2
+        self._update_heights()
+
+    def rotate_and_fall(self):
+        """Rotates the board and makes the pieces fall, in one table-driven
+        pass: each new column is one rotate_fall lookup of a row of the old
+        board.  Rows are taken from the bottom up, and the pass stops at the
+        first empty row with nothing above it."""
+        g = self.geometry
+        rotate_fall = g.rotate_fall
+        if rotate_fall is None:
+            raise ValueError("only square boards can be rotated")
+        column_bits = g.column_bits
+        bottom_mask = g.bottom_mask
+        rows_from = g.rows_from
+        b1 = self.bits[1]
+        occupied = b1 | self.bits[2]
+        heights = self.heights
+        heights[:] = [0] * self.width
+        n1 = n2 = 0
+        # old row r becomes new column x = height - 1 - r
+        x = self.width - 1
+        base = x * column_bits
+        for r in range(self.height):
+            row = (occupied >> r) & bottom_mask
+            if row:
+                team1, team2, heights[x] = rotate_fall[
+                    row | ((b1 >> r) & bottom_mask) << 1]
+                n1 |= team1 << base
+                n2 |= team2 << base
+            elif not occupied & rows_from[r]:
+                break
+            x -= 1
+            base -= column_bits
+        self.bits[1], self.bits[2] = n1, n2
+
+    def falling_moves(self):
+        """Returns (from index, to index, team) for every piece that
+        make_pieces_fall would move."""
+        g = self.geometry
+        height = self.height
+        b1 = self.bits[1]
+        occupied = b1 | self.bits[2]
+        moves = []
+        for x in range(self.width):
+            base = x * g.column_bits
+            column = (occupied >> base) & g.column_mask
+            if column & (column + 1) == 0:
+                # nothing floats in this column
+                continue
+            team1 = (b1 >> base) & g.column_mask
+            for source, destination in g.fall_moves[column << height |
+                                                    team1]:
+                moves.append((base + source, base + destination,
+                              1 if team1 >> source & 1 else 2))
+        return moves
+
+    @property
+    def win_length(self):
+        return self.geometry.win_length
+
+    def winners(self):
+        """Returns the list of teams that have at least one winning line."""
+        g = self.geometry
+        has_line = g.has_line
+        if has_line(self.bits[1], g):
+            return [1, 2] if has_line(self.bits[2], g) else [1]
+        return [2] if has_line(self.bits[2], g) else []
+
+    def winner(self):
+        """Returns the team that wins if the game ends here, scored as
+        Match does (the team with more lines, or DRAW if they have the
+        same number), or None if neither team has a line."""
+        winners = self.winners()
+        if not winners:
+            return None
+        if len(winners) == 1:
+            return winners[0]
+        return score_lines(self.check_victory(), [0, 0, 0])
+
+    def check_victory(self):
+        """
+        Returns a list of (winning team, list of positions in the line)
+        list of positions is in the form [(x1, y1), (x2, y2), ...]
+
+        Lines are ordered and oriented the same way as the cell-by-cell scan
+        in Board.check_victory did.
+        """
+        g = self.geometry
+        b1, b2 = self.bits[1], self.bits[2]
+        if not g.has_line(b1, g) and not g.has_line(b2, g):
+            # the usual case, answered without finding where the lines are
+            return []
+        shifts = g.line_shifts
+        found = []
+        for team, bits in ((1, b1), (2, b2)):
+            for direction, s in enumerate(g.directions):
+                m = bits
+                for k in shifts:
+                    m &= m >> (k * s)
+                lines = g.line_cells[direction]
+                while m:
+                    low = m & -m
+                    line = lines[low.bit_length() - 1]
+                    found.append((line[0], direction, team, list(line)))
+                    m ^= low
+        found.sort()
+        return [(team, line) for (start, direction, team, line) in found]
+
+    def copy(self):
+        other = BitBoard.__new__(BitBoard)
+        other.width = self.width
+        other.height = self.height
+        other.geometry = self.geometry
+        other.bits = list(self.bits)
+        other.heights = list(self.heights)
+        return other
+
+    def get_string(self):
+        return '\n'.join(
+            ''.join(str(self.cell(x, y)) for x in range(self.width))
+            for y in range(self.height))
+
+
+class WindowCounts(object):
+
+    """How many pieces each team has in every window a line can occupy.
+
+    The counts are kept up to date piece by piece, so after a drop only the
+    windows through the new piece are looked at, and after a rotation the
+    counts are carried over to the rotated windows and only the windows
+    touching pieces that fell are updated.  Completed windows, and the
+    number of windows each team could still complete, are then available
+    without scanning the board."""
+
+    def __init__(self, geometry, board=None):
+        self.geometry = geometry
+        n = len(geometry.window_masks)
+        self.counts = [None, [0] * n, [0] * n]
+        # open[team][k]: windows holding k of team's pieces and none of the
+        # other team's
+        length = geometry.win_length
+        self.open = [None, [n] + [0] * length, [n] + [0] * length]
+        # count that fills a window, and the one a piece short of it
+        self.full = length
+        self.almost = length - 1
+        self.complete = set()
+        if board is not None:
+            for team in (1, 2):
+                for i in iterate_bits(board.bits[team]):
+                    self.add(i, team)
+
+    def add(self, index, team):
+        """Records a piece of the team at the bit index."""
+        mine = self.counts[team]
+        theirs = self.counts[3 - team]
+        my_open = self.open[team]
+        their_open = self.open[3 - team]
+        almost = self.almost
+        for w in self.geometry.cell_windows[index]:
+            k = mine[w]
+            if not theirs[w]:
+                my_open[k] -= 1
+                my_open[k + 1] += 1
+                if not k:
+                    # the window was empty, and open to both teams
+                    their_open[0] -= 1
+                elif k == almost:
+                    self.complete.add(w)
+            elif not k:
+                their_open[theirs[w]] -= 1
+            mine[w] = k + 1
+
+    def remove(self, index, team):
+        """Records that the team's piece at the bit index is gone."""
+        mine = self.counts[team]
+        theirs = self.counts[3 - team]
+        my_open = self.open[team]
+        their_open = self.open[3 - team]
+        almost = self.almost
+        for w in self.geometry.cell_windows[index]:
+            k = mine[w] - 1
+            mine[w] = k
+            if not theirs[w]:
+                my_open[k + 1] -= 1
+                my_open[k] += 1
+                if not k:
+                    their_open[0] += 1
+                elif k == almost:
+                    self.complete.discard(w)
+            elif not k:
+                their_open[theirs[w]] += 1
+
+    def rotate(self):
+        """Carries the counts over to the windows of the rotated board."""
+        rotated = self.geometry.rotated_windows
+        for team in (1, 2):
+            old = self.counts[team]
+            new = [0] * len(old)
+            for w, count in enumerate(old):
+                new[rotated[w]] = count
+            self.counts[team] = new
+        self.complete = set(rotated[w] for w in self.complete)
+
+    def move(self, moves):
+        """Applies (from index, to index, team) piece moves, such as the
+        ones BitBoard.falling_moves returns."""
+        for source, destination, team in moves:
+            self.remove(source, team)
+        for source, destination, team in moves:
+            self.add(destination, team)
+
+    def lines(self):
+        """Returns the completed windows as check_victory does: a list of
+        (winning team, list of positions in 4-in-a-row)."""
+        counts = self.counts[1]
+        cells = self.geometry.window_cells
+        full = self.full
+        return [(1 if counts[w] == full else 2, list(cells[w]))
+                for w in sorted(self.complete)]
+
+    def threats(self, team):
+        """Returns the number of windows where the team is one piece short of
+        a line and the other team has none."""
+        return self.open[team][self.almost]
+
+
+class GridColumn(object):
+
+    """One column of a Grid, indexed by y."""
+
+    __slots__ = ('board', 'x')
+
+    def __init__(self, board, x):
+        self.board = board
+        self.x = x
+
+    def __getitem__(self, y):
+        return self.board.state.cell(self.x, y)
+
+    def __setitem__(self, y, team):
+        self.board.set_cell(self.x, y, team)
+
+    def __len__(self):
+        return self.board.height
+
+    def __iter__(self):
+        for y in range(self.board.height):
+            yield self.board.state.cell(self.x, y)
+
+
+class Grid(object):
+
+    """List-of-lists style view of a Board's BitBoard, so grid[x][y] reads
+    and writes go straight to the bitboards."""
+
+    __slots__ = ('board',)
+
+    def __init__(self, board):
+        self.board = board
+
+    def __getitem__(self, x):
+        return GridColumn(self.board, x)
+
+    def __len__(self):
+        return self.board.width
+
+    def __iter__(self):
+        for x in range(self.board.width):
+            yield GridColumn(self.board, x)
+
+
+class Board(object):
+
+    """Two-dimensional Connect 4 board, played by the window's rules.
+
+    The position lives in a BitBoard, and grid gives grid[x][y] access to
+    the cells.  windows counts the pieces in every window; nothing in a
+    move needs it, so it is only built when read."""
+
+    def __init__(self, width, height, win_length=WIN_LENGTH):
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.state = BitBoard(width, height, win_length)
+        self.grid = Grid(self)
+        # the last WindowCounts built, and the team bitboards it counts
+        self._windows = None
+        self._windows_bits = None
+
+    @property
+    def windows(self):
+        """WindowCounts for the current position."""
+        bits = (self.state.bits[1], self.state.bits[2])
+        if self._windows is None or self._windows_bits != bits:
+            self._windows = WindowCounts(self.state.geometry, self.state)
+            self._windows_bits = bits
+        return self._windows
+
+    def set_cell(self, x, y, team):
+        """Places a piece (or 0 for empty) at (x, y), ignoring gravity."""
+        self.state.set_cell(x, y, team)
+
+    def rotate(self):
+        self.state.rotate()
+
+    def make_pieces_fall(self):
+        self.state.make_pieces_fall()
+
+    def iterate_pieces_falling(self):
+        """Yields the position and destination of each piece falling, from
+        the bottom row up.  Each piece has already been moved when it is
+        yielded."""
+        g = self.state.geometry
+        # the gravity tables give every move at once; sort them by starting
+        # row, lowest first, then by column
+        moves = sorted(self.state.falling_moves(),
+                       key=lambda move: (move[0] % g.column_bits, move[0]))
+        for source, destination, team in moves:
+            pos = g.position(source)
+            pos2 = g.position(destination)
+            self.set_cell(pos[0], pos[1], 0)
+            self.set_cell(pos2[0], pos2[1], team)
+            yield (pos, pos2)
+
+    def get_string(self):
+        return self.state.get_string()
+
+    def lowest_in_column(self, column):
+        """Returns the y-coordinate for the lowest empty position in the given
+        column.
+        Returns -1 if the column is full"""
+        return self.state.lowest_in_column(column)
+
+    def drop_piece(self, column, player):
+        self.state.drop(column, player)
+
+    def column_blocked(self, column):
+        return self.state.column_blocked(column)
+
+    def check_victory(self):
+        """
+        Returns a list of (winning team, list of positions in 4-in-a-row)
+        list of positions is in the form [(x1, y1), (x2, y2), ...]
+        """
+        return self.state.check_victory()
+
+
+class GameState(object):
+
+    """A position plus whose turn it is and how many moves remain until the
+    next rotation.
+
+    Moves are made with push() and taken back with pop(), so searches can
+    walk the game tree on a single object.  Nothing here refers to
+    rendering, so clone() only has to copy a few integers.
+
+    The state also keeps a Zobrist hash of the position, including the
+    player to move and the moves-until-rotation counter, together with the
+    hash of its left/right mirror image.  Drops update both incrementally;
+    a rotation moves every piece, so they are recomputed then."""
+
+    __slots__ = ('board', 'active_player', 'turns_til_rotation',
+                 'rotate_time', 'history', 'hash', 'mirror_hash')
+
+    def __init__(self, board=None, active_player=1,
+                 turns_til_rotation=ROTATE_TIME, rotate_time=ROTATE_TIME):
+        if board is None:
+            board = BitBoard()
+        self.board = board
+        self.active_player = active_player
+        self.turns_til_rotation = turns_til_rotation
+        self.rotate_time = rotate_time
+        # one (bits1, bits2, heights, active_player, turns_til_rotation,
+        # hash, mirror_hash) snapshot per pushed move
+        self.history = []
+        self.rehash()
+
+    def rehash(self):
+        """Recomputes the Zobrist hashes from scratch."""
+        g = self.board.geometry
+        extra = g.turn_keys[self.turns_til_rotation]
+        if self.active_player == 2:
+            extra ^= g.side_key
+        self.hash = zobrist_hash(self.board.bits, g.piece_keys) ^ extra
+        self.mirror_hash = zobrist_hash(self.board.bits, g.mirror_keys) ^ extra
+
+    def key(self, fold_mirror=False):
+        """Returns the position's hash.  With fold_mirror, a position and its
+        mirror image get the same (smaller) of their two hashes."""
+        if fold_mirror and self.mirror_hash < self.hash:
+            return self.mirror_hash
+        return self.hash
+
+    def is_mirrored(self):
+        """Returns True if key(fold_mirror=True) is the mirror image's."""
+        return self.mirror_hash < self.hash
+
+    def clone(self):
+        """Returns a copy of the position, without the undo history."""
+        other = GameState.__new__(GameState)
+        other.board = self.board.copy()
+        other.active_player = self.active_player
+        other.turns_til_rotation = self.turns_til_rotation
+        other.rotate_time = self.rotate_time
+        other.history = []
+        other.hash = self.hash
+        other.mirror_hash = self.mirror_hash
+        return other
+
+    def legal_moves(self):
+        """Returns the columns that still have room for a piece."""
+        height = self.board.height
+        return [x for x, h in enumerate(self.board.heights) if h < height]
+
+    def will_rotate(self):
+        """Returns True if the next move is followed by a rotation."""
+        return self.turns_til_rotation == 1
+
+    def push(self, column, team=None):
+        """Drops a piece into the column for the given team (by default the
+        active player), then rotates the board and makes the pieces fall if
+        the rotation is due.  The move can be taken back with pop()."""
+        board = self.board
+        bits = board.bits
+        g = board.geometry
+        self.history.append((bits[1], bits[2], board.heights[:],
+                             self.active_player, self.turns_til_rotation,
+                             self.hash, self.mirror_hash))
+        if team is None:
+            team = self.active_player
+        index = column * g.column_bits + board.heights[column]
+        board.drop(column, team)
+
+        turns = self.turns_til_rotation - 1
+        if turns == 0:
+            board.rotate_and_fall()
+            self.turns_til_rotation = self.rotate_time
+            self.active_player = 3 - team
+            self.rehash()
+            return
+
+        extra = g.turn_keys[self.turns_til_rotation] ^ g.turn_keys[turns]
+        if self.active_player == 2:
+            extra ^= g.side_key
+        if team == 1:
+            # the new active player is 2
+            extra ^= g.side_key
+        self.hash ^= g.piece_keys[team][index] ^ extra
+        self.mirror_hash ^= g.mirror_keys[team][index] ^ extra
+        self.active_player = 3 - team
+        self.turns_til_rotation = turns
+
+    def pop(self):
+        """Takes back the last move made with push()."""
+        board = self.board
+        (board.bits[1], board.bits[2], board.heights,
+         self.active_player, self.turns_til_rotation,
+         self.hash, self.mirror_hash) = self.history.pop()
+
+    def winners(self):
+        return self.board.winners()
+
+    def winner(self):
+        return self.board.winner()
+
+
+DRAW = 0
+
+
+def score_lines(lines, points):
+    """Adds a point to points[team] for every (team, line) in lines, as
+    check_victory returns them, and returns the team with more points, or
+    DRAW if they have the same."""
+    for team, line in lines:
+        points[team] += 1
+    if points[1] > points[2]:
+        return 1
+    if points[2] > points[1]:
+        return 2
+    return DRAW
+
+
+class Match(object):
+
+    """One game, played by the same rules as the window: a rotation every
+    rotate_time moves, and the game ends as soon as a line appears, won by
+    the team with more lines (one point each), or drawn if the board fills
+    up first."""
+
+    def __init__(self, width=BOARD_WIDTH, height=BOARD_HEIGHT,
+                 win_length=WIN_LENGTH, rotate_time=ROTATE_TIME):
+        self.state = GameState(BitBoard(width, height, win_length), 1,
+                               rotate_time, rotate_time)
+        self.points = [0, 0, 0]
+        # the winning team or DRAW once the game is over, None until then
+        self.winner = None
+        self.moves = []
+
+    def active_player(self):
+        return self.state.active_player
+
+    def legal_moves(self):
+        if self.winner is not None:
+            return []
+        return self.state.legal_moves()
+
+    def play(self, column):
+        """Drops a piece for the active player.  Returns True if the board
+        rotated afterwards.  Raises ValueError if the move isn't allowed."""
+        state = self.state
+        if self.winner is not None:
+            raise ValueError("the game is over")
+        if not 0 <= column < state.board.width or \
+                state.board.heights[column] >= state.board.height:
+            raise ValueError("column %r is full or off the board" % column)
+        rotating = state.will_rotate()
+        state.push(column)
+        self.moves.append(column)
+        if state.winners():
+            self.winner = score_lines(state.board.check_victory(),
+                                      self.points)
+        elif not state.legal_moves():
+            self.winner = DRAW
+        return rotating
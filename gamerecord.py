@@ -0,0 +1,361 @@
+#!/usr/bin/env python2
+"""Compact game records, with checkpoints for seeking.
+
+    $ python gamerecord.py games.rec
+    $ python gamerecord.py games.rec --game 12 --ply 30
+
+A record file is a sequence of games, one after another.  Each game is a
+fixed header (GAME_HEADER) followed by its moves, packed a few bits each
+(3 bits per move on the 7 column board), and by a full-board checkpoint
+every interval plies.  Rotations aren't stored: they happen every
+rotate_time moves.  Replay.seek() starts from the checkpoint nearest to the
+ply it wants, so it plays at most interval moves, wherever in the game it
+goes.
+
+Every game's size follows from its header, so read_games() streams through
+an archive one game at a time, and can skip the moves of games it only needs
+the headers of.  Archives of any size can be scanned this way; nothing is
+kept from one game to the next."""
+from __future__ import print_function
+
+import argparse
+import collections
+import io
+import struct
+
+import engine
+
+# start of every game, to catch files that aren't records
+GAME_MAGIC = b'GR'
+
+# magic, game number, board width, board height, win length, rotate time,
+# winner, team 1 and team 2 player codes, checkpoint interval, number of
+# moves
+GAME_HEADER = struct.Struct('<2sIBBBBBBBBH')
+
+# strategy codes (indices into PLAYER_CODES); only ever append to this, or
+# old files will read back wrong
+PLAYER_CODES = ('basic', 'alphabeta', 'mcts')
+HUMAN = 0xff
+
+# winner of a game that was drawn, or that stopped before it was over
+DRAW = engine.DRAW
+UNFINISHED = 0xff
+
+DEFAULT_INTERVAL = 16
+
+
+def move_bits(width):
+    """Returns the number of bits a move takes on a board of the width."""
+    return max(1, (width - 1).bit_length())
+
+
+def board_bytes(width, height):
+    """Returns the number of bytes a bitboard of the size takes."""
+    return (width * (height + 1) + 7) // 8
+
+
+def int_to_bytes(value, size):
+    return bytes(bytearray((value >> (8 * i)) & 0xff for i in range(size)))
+
+
+def int_from_bytes(data):
+    value = 0
+    for byte in reversed(bytearray(data)):
+        value = value << 8 | byte
+    return value
+
+
+def body_size(width, height, interval, num_moves):
+    """Returns the number of bytes after the header of a game."""
+    moves = (num_moves * move_bits(width) + 7) // 8
+    return moves + (num_moves // interval) * 2 * board_bytes(width, height)
+
+
+def pack_game(moves, rules=(engine.BOARD_WIDTH, engine.BOARD_HEIGHT,
+                            engine.WIN_LENGTH, engine.ROTATE_TIME),
+              winner=UNFINISHED, players=(HUMAN, HUMAN), number=0,
+              interval=DEFAULT_INTERVAL):
+    """Returns the record of a game as a string of bytes.
+
+    moves are the columns played, from the start of the game; rules are
+    (width, height, win length, rotate time); players are the player codes
+    of teams 1 and 2.  The game is replayed to make the checkpoints, so
+    the moves must all be legal."""
+    width, height, win_length, rotate_time = rules
+    if not 1 <= interval <= 0xff:
+        raise ValueError("checkpoint interval must be between 1 and 255")
+    bits = move_bits(width)
+    size = board_bytes(width, height)
+    packed = 0
+    checkpoints = []
+    state = engine.GameState(engine.BitBoard(width, height, win_length), 1,
+                             rotate_time, rotate_time)
+    for ply, move in enumerate(moves, 1):
+        if move not in state.legal_moves():
+            raise ValueError("move %d (column %r) isn't legal" % (ply, move))
+        state.push(move)
+        state.history = []
+        packed |= move << ((ply - 1) * bits)
+        if ply % interval == 0:
+            checkpoints.append(int_to_bytes(state.board.bits[1], size))
+            checkpoints.append(int_to_bytes(state.board.bits[2], size))
+    header = GAME_HEADER.pack(GAME_MAGIC, number, width, height, win_length,
+                              rotate_time, winner, players[0], players[1],
+                              interval, len(moves))
+    return b''.join([header,
+                     int_to_bytes(packed, (len(moves) * bits + 7) // 8)] +
+                    checkpoints)
+
+
+def write_game(f, moves, rules=(engine.BOARD_WIDTH, engine.BOARD_HEIGHT,
+                                engine.WIN_LENGTH, engine.ROTATE_TIME),
+               winner=UNFINISHED, players=(HUMAN, HUMAN), number=0,
+               interval=DEFAULT_INTERVAL):
+    """Appends a game to a record file; see pack_game()."""
+    f.write(pack_game(moves, rules, winner, players, number, interval))
+
+
+class GameRecord(object):
+
+    """One game read from a record file.  The moves are only unpacked when
+    they are first asked for."""
+
+    __slots__ = ('number', 'width', 'height', 'win_length', 'rotate_time',
+                 'winner', 'players', 'interval', 'num_moves', 'data',
+                 '_moves')
+
+    def __init__(self, header, data=None):
+        (magic, self.number, self.width, self.height, self.win_length,
+         self.rotate_time, self.winner, player1, player2, self.interval,
+         self.num_moves) = header
+        self.players = (player1, player2)
+        # the packed moves and checkpoints, or None if only the header was
+        # read
+        self.data = data
+        self._moves = None
+
+    def __len__(self):
+        return self.num_moves
+
+    @property
+    def rules(self):
+        return self.width, self.height, self.win_length, self.rotate_time
+
+    @property
+    def moves(self):
+        if self._moves is None:
+            if self.data is None:
+                raise ValueError("only the header of game %d was read" %
+                                 self.number)
+            bits = move_bits(self.width)
+            mask = (1 << bits) - 1
+            packed = int_from_bytes(
+                self.data[:(self.num_moves * bits + 7) // 8])
+            self._moves = [(packed >> (i * bits)) & mask
+                           for i in range(self.num_moves)]
+        return self._moves
+
+    def checkpoint_ply(self, ply):
+        """Returns the ply of the last checkpoint at or before the ply, or 0
+        for the start of the game."""
+        return ply - ply % self.interval
+
+    def checkpoint_state(self, ply):
+        """Returns the engine.GameState at a checkpoint ply."""
+        if ply % self.interval or not 0 <= ply <= self.num_moves:
+            raise ValueError("there is no checkpoint at ply %d" % ply)
+        board = engine.BitBoard(self.width, self.height, self.win_length)
+        if ply:
+            size = board_bytes(self.width, self.height)
+            start = ((self.num_moves * move_bits(self.width) + 7) // 8 +
+                     (ply // self.interval - 1) * 2 * size)
+            board.bits[1] = int_from_bytes(self.data[start:start + size])
+            board.bits[2] = int_from_bytes(
+                self.data[start + size:start + 2 * size])
+            board._update_heights()
+        # team 1 always moves first, and the turns alternate
+        return engine.GameState(board, 1 + ply % 2,
+                                self.rotate_time - ply % self.rotate_time,
+                                self.rotate_time)
+
+    def state_at(self, ply):
+        """Returns the engine.GameState after the first ply moves."""
+        return Replay(self).seek(ply).clone()
+
+    def pack(self):
+        """Returns the record as bytes, as it is stored in a file."""
+        if self.data is None:
+            raise ValueError("only the header of game %d was read" %
+                             self.number)
+        return GAME_HEADER.pack(GAME_MAGIC, self.number, self.width,
+                                self.height, self.win_length,
+                                self.rotate_time, self.winner,
+                                self.players[0], self.players[1],
+                                self.interval, self.num_moves) + self.data
+
+
+def unpack_game(data):
+    """Returns the GameRecord of a game packed by pack_game()."""
+    for record in read_games(io.BytesIO(data)):
+        return record
+    raise ValueError("no game in the data")
+
+
+class Replay(object):
+
+    """Steps through a recorded game.  state is the position after the
+    first ply moves."""
+
+    def __init__(self, record):
+        self.record = record
+        self.state = record.checkpoint_state(0)
+        self.ply = 0
+
+    def seek(self, ply):
+        """Moves to the position after the first ply moves and returns it.
+        Goes back with pop() when it can, and otherwise plays forward from
+        the current position or the nearest checkpoint, whichever is
+        closer."""
+        record = self.record
+        if not 0 <= ply <= record.num_moves:
+            raise IndexError("ply %d is outside the game" % ply)
+        state = self.state
+        if ply < self.ply <= ply + len(state.history):
+            while self.ply > ply:
+                state.pop()
+                self.ply -= 1
+            return state
+        start = record.checkpoint_ply(ply)
+        if not start <= self.ply <= ply:
+            state = self.state = record.checkpoint_state(start)
+            self.ply = start
+        moves = record.moves
+        while self.ply < ply:
+            state.push(moves[self.ply])
+            self.ply += 1
+        return state
+
+    def step(self):
+        return self.seek(self.ply + 1)
+
+    def back(self):
+        return self.seek(self.ply - 1)
+
+
+def read_games(f, headers_only=False):
+    """Yields the GameRecords of a record file, one at a time, reading only
+    one game at a time.  With headers_only, the moves and checkpoints are
+    skipped over (the file must be seekable) and left out of the records."""
+    while True:
+        header = f.read(GAME_HEADER.size)
+        if not header:
+            return
+        if len(header) < GAME_HEADER.size:
+            raise ValueError("the record file ends in the middle of a game")
+        fields = GAME_HEADER.unpack(header)
+        if fields[0] != GAME_MAGIC:
+            raise ValueError("not a game record at offset %d" %
+                             (f.tell() - GAME_HEADER.size))
+        size = body_size(fields[2], fields[3], fields[9], fields[10])
+        if headers_only:
+            f.seek(size, 1)
+            yield GameRecord(fields)
+            continue
+        data = f.read(size)
+        if len(data) < size:
+            raise ValueError("the record file ends in the middle of a game")
+        yield GameRecord(fields, data)
+
+
+def index_games(f):
+    """Returns the file offset of every game in a record file, for
+    read_game_at()."""
+    offsets = []
+    f.seek(0)
+    offset = 0
+    for record in read_games(f, headers_only=True):
+        offsets.append(offset)
+        offset = f.tell()
+    return offsets
+
+
+def read_game_at(f, offset):
+    """Reads the game that starts at the offset of a record file."""
+    f.seek(offset)
+    for record in read_games(f):
+        return record
+    raise ValueError("there is no game at offset %d" % offset)
+
+
+def summarize(f):
+    """Scans a record file and returns a dict of totals: games, moves, wins
+    per team, draws, unfinished games and games per pair of players."""
+    totals = {
+        'games': 0,
+        'moves': 0,
+        'wins': [0, 0],
+        'draws': 0,
+        'unfinished': 0,
+        'players': collections.Counter(),
+    }
+    for record in read_games(f, headers_only=True):
+        totals['games'] += 1
+        totals['moves'] += record.num_moves
+        if record.winner in (1, 2):
+            totals['wins'][record.winner - 1] += 1
+        elif record.winner == DRAW:
+            totals['draws'] += 1
+        else:
+            totals['unfinished'] += 1
+        totals['players'][tuple(player_name(code)
+                                for code in record.players)] += 1
+    return totals
+
+
+def player_name(code):
+    if code == HUMAN:
+        return 'human'
+    if code < len(PLAYER_CODES):
+        return PLAYER_CODES[code]
+    return 'unknown'
+
+
+def main_gamerecord():
+    parser = argparse.ArgumentParser(
+        description="Summarize Grav-Twist game records, or show a position "
+        "from one.")
+    parser.add_argument('path')
+    parser.add_argument('--game', type=int, default=None, metavar='N',
+                        help="show the N-th game (counting from 0)")
+    parser.add_argument('--ply', type=int, default=None,
+                        help="show the board after this many moves (default: "
+                        "the end of the game)")
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        if args.game is None:
+            totals = summarize(f)
+            print("%d games, %d moves" % (totals['games'], totals['moves']))
+            print("team 1 won %d, team 2 won %d, %d drawn, %d unfinished" % (
+                totals['wins'][0], totals['wins'][1], totals['draws'],
+                totals['unfinished']))
+            for players, count in sorted(totals['players'].items()):
+                print("%s vs %s: %d" % (players[0], players[1], count))
+            return
+        offsets = index_games(f)
+        if not 0 <= args.game < len(offsets):
+            parser.error("the file has %d games" % len(offsets))
+        record = read_game_at(f, offsets[args.game])
+    ply = record.num_moves if args.ply is None else args.ply
+    try:
+        state = Replay(record).seek(ply)
+    except IndexError as e:
+        parser.error(str(e))
+    print("game %d, ply %d of %d, team %d to move" % (
+        record.number, ply, record.num_moves, state.active_player))
+    print(state.board.get_string())
+
+
+if __name__ == '__main__':
+    main_gamerecord()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Load generator for server.py: opens many connections and plays random
+moves as fast as the server answers.
+
+    $ python3 loadgen.py --games 200 --idle 10000
+
+Idle clients join games against each other and never move, to measure how
+many open games the server holds; active clients play games of random
+moves, one after another, and the moves per second they get through are
+reported.  Like the server, this needs Python 3."""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+import engine
+import selfplay
+import server
+
+DEFAULT_SECONDS = 10.0
+
+DEFAULT_RULES = (engine.BOARD_WIDTH, engine.BOARD_HEIGHT, engine.WIN_LENGTH,
+                 engine.ROTATE_TIME)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.moves = 0
+        self.games = 0
+        self.errors = 0
+
+
+async def connect(host, port, opponent):
+    """Connects and joins a game.  Returns (reader, writer, team)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(server.encode(server.JOIN, opponent))
+    kind, (number, team) = await server.read_message(reader)
+    return reader, writer, team
+
+
+async def idle_client(host, port, opened):
+    """Joins a game and then waits, keeping the connection open."""
+    reader, writer, team = await connect(host, port, server.HUMAN)
+    opened.append(writer)
+    try:
+        while True:
+            await server.read_message(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+async def play_games(host, port, opponent, stats, rng, rules=DEFAULT_RULES):
+    """Plays games of random moves until cancelled, keeping its own copy of
+    each game to know whose turn it is and which moves are legal.  rules
+    are the server's (width, height, win length, rotate time)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            writer.write(server.encode(server.JOIN, opponent))
+            match = engine.Match(*rules)
+            team = None
+            while True:
+                kind, fields = await server.read_message(reader)
+                if kind == server.JOINED:
+                    team = fields[1]
+                elif kind == server.MOVED:
+                    match.play(fields[1])
+                    # both players of a game hear about every move
+                    if fields[0] == team or opponent != server.HUMAN:
+                        stats.moves += 1
+                elif kind == server.RESULT:
+                    stats.games += 1
+                    break
+                elif kind == server.ERROR:
+                    stats.errors += 1
+                if kind in (server.START, server.MOVED) and \
+                        match.winner is None and \
+                        match.active_player() == team:
+                    writer.write(server.encode(
+                        server.MOVE, rng.choice(match.legal_moves())))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(host, port, games, idle, opponent, seconds, seed=0,
+              rules=DEFAULT_RULES):
+    """Opens idle connections, then plays games on the given number of
+    active connections for the given number of seconds, by the server's
+    rules.  Returns the Stats of the active games."""
+    opened = []
+    idle_tasks = []
+    # idle clients connect first, so they are paired with each other
+    for i in range(idle - idle % 2):
+        idle_tasks.append(asyncio.ensure_future(
+            idle_client(host, port, opened)))
+        if i % 500 == 499:
+            await asyncio.sleep(0)
+    while len(opened) < len(idle_tasks):
+        await asyncio.sleep(0.01)
+
+    stats = Stats()
+    rng = random.Random(seed)
+    start = time.time()
+    tasks = [asyncio.ensure_future(
+        play_games(host, port, opponent, stats,
+                   random.Random(rng.getrandbits(32)), rules))
+             for i in range(games)]
+    await asyncio.wait(tasks, timeout=seconds)
+    stats.seconds = time.time() - start
+    # games still going are abandoned
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    for writer in opened:
+        writer.close()
+    for task in idle_tasks:
+        task.cancel()
+    return stats
+
+
+def main_loadgen():
+    parser = argparse.ArgumentParser(
+        description="Put load on a Grav-Twist server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=server.DEFAULT_PORT)
+    parser.add_argument('--games', type=int, default=100,
+                        help="connections playing games")
+    parser.add_argument('--idle', type=int, default=0,
+                        help="connections sitting in idle games")
+    parser.add_argument('--ai', choices=selfplay.PLAYER_CODES, default=None,
+                        help="play against this AI instead of each other")
+    parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=engine.BOARD_WIDTH,
+                        help="the server's board size")
+    parser.add_argument('--win-length', type=int, default=engine.WIN_LENGTH,
+                        help="the server's win length")
+    parser.add_argument('--rotate-time', type=int, default=engine.ROTATE_TIME,
+                        help="the server's rotate time")
+    args = parser.parse_args()
+    try:
+        engine.check_rules(args.size, args.win_length, args.rotate_time)
+    except ValueError as e:
+        parser.error(str(e))
+    opponent = server.HUMAN
+    if args.ai:
+        opponent = 1 + selfplay.PLAYER_CODES.index(args.ai)
+    elif args.games % 2:
+        parser.error("--games must be even without --ai")
+
+    stats = asyncio.run(run(args.host, args.port, args.games, args.idle,
+                            opponent, args.seconds, args.seed,
+                            (args.size, args.size, args.win_length,
+                             args.rotate_time)))
+    print("%d idle connections, %d games, %d moves, %.0f moves/sec, "
+          "%d errors" % (args.idle - args.idle % 2, stats.games, stats.moves,
+                         stats.moves / stats.seconds, stats.errors),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main_loadgen()
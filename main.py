@@ -3,16 +3,26 @@ from __future__ import print_function
 import pygame
 from pygame.locals import *
 import sys
+import argparse
+import collections
+import functools
 import random
-import copy
+
+# the tool modules (aiworker, book, gamerecord, positiondb and profiler) are
+# imported where they're used, so the rules and drawing code load without
+# them
+import engine
+from core import AI, AI_STRATEGIES, DEFAULT_AI_STRATEGY  # noqa: F401
 
 WINDOW_WIDTH = 640
 WINDOW_HEIGHT = 480
 
-BOARD_WIDTH = 7
-BOARD_HEIGHT = 7
+BOARD_WIDTH = engine.BOARD_WIDTH
+BOARD_HEIGHT = engine.BOARD_HEIGHT
+
+ROTATE_TIME = engine.ROTATE_TIME
 
-ROTATE_TIME = 3
+WIN_LENGTH = engine.WIN_LENGTH
 
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -32,240 +42,291 @@ BG_COLOR = BLUE
 
 MAX_FPS = 30
 
-
-class AI(object):
-
-    def __init__(self, team):
-        self.team = team
-
-    def check_victory(self, board, x, rotate):
-        """Add a piece to the board at column x, and check if it would give
-        victory.  Right afterwards, remove the piece.
-
-        Returns a list of the form (winning team, line)
-        where line is of the form [(x1, y1), (x2, y2), ...]."""
-        # TODO: detect the enemy team instead of assuming it's 1
-        enemy_team = 1
-        y = board.lowest_in_column(x)
-        victory = []
-
-        if y != -1:
-            if rotate:
-                # rotation isn't reversible, so we need to make copies of the
-                # board to preserve the original
-                for team in (self.team, enemy_team):
-                    tmp_board = copy.deepcopy(board)
-                    tmp_board.grid[x][y] = team
-                    tmp_board.rotate()
-                    tmp_board.make_pieces_fall()
-                    victory.extend(tmp_board.check_victory())
-
-            else:
-                # not rotating
-                board.grid[x][y] = self.team
-                victory.extend(board.check_victory())
-
-                board.grid[x][y] = enemy_team
-                victory.extend(board.check_victory())
-
-                board.grid[x][y] = 0
-
-        return victory
-
-    def get_move(self, board, turns_til_rotation):
-        """Returns the column # to drop the piece in."""
-
-        # if the board is about to rotate, we want the AI to simulate that and
-        # catch 4-in-a-rows that result from this.
-        rotate = turns_til_rotation == 1
-        board = copy.deepcopy(board)
-
-        # see if any team could win by dropping a piece into a column
-        line_completions = [self.check_victory(board, x, rotate)
-                            for x in range(board.width)]
-
-        # first of all, if we can make a 4-in-a-row, do it!
-        for x, c in enumerate(line_completions):
-            if self.team in c:
-                return x
-
-        # blocking an opponent's 4-in-a-row is the 2nd highest piority
-        for x, c in enumerate(line_completions):
-            if c:
-                return x
-
-        # otherwise, just go in a random spot
-        return random.randint(0, board.width - 1)
-
-
-class Board(object):
-
-    """Two-dimensional Connect 4 board."""
-
-    def __init__(self, width, height):
-        self.width = width
-        self.height = height
-        self.grid = [[0 for y in range(BOARD_HEIGHT)]
-                     for x in range(BOARD_WIDTH)]
+# while nothing is animating, the game sleeps until an event arrives, waking
+# at least this often to refresh the profile overlay (the AI's pondering
+# keeps adding to it)
+IDLE_TIMEOUT_MS = 1000
+
+# where F4 writes the frame-time histograms (as CSV if it ends in .csv)
+PROFILE_PATH = 'gravtwist-profile.json'
+
+# The rotation animation turns the board image from the first angle to the
+# last one (in degrees) over a number of frames; the rest of the quarter turn
+# happens when the rotated board is drawn.  The easing function maps the
+# animation's progress (0 to 1) to the fraction of the turn made.
+ROTATION_FIRST_ANGLE = 1
+ROTATION_LAST_ANGLE = 81
+ROTATION_STEPS = 9
+ROTATION_EASING = 'linear'
+EASINGS = {
+    'linear': lambda t: t,
+    'ease-in': lambda t: t * t,
+    'ease-out': lambda t: t * (2 - t),
+    'ease-in-out': lambda t: t * t * (3 - 2 * t),
+}
+
+
+class Board(engine.Board):
+
+    """engine.Board with the screen geometry and image used for
+    rendering."""
+
+    def __init__(self, width, height, win_length=WIN_LENGTH):
+        engine.Board.__init__(self, width, height, win_length)
         board_size = min(WINDOW_WIDTH, WINDOW_HEIGHT) * 14 / 16
         x = (WINDOW_WIDTH - board_size) / 2
         y = (WINDOW_HEIGHT - board_size) / 2
         self.rect = Rect((x, y), (board_size, board_size))
-        self.image = pygame.Surface(
-            (board_size, board_size)).convert()
-        self.image.set_colorkey(BG_COLOR)
-
-    def rotate(self):
-        old_grid = self.grid
-        self.grid = [[old_grid[self.height - y - 1][x]
-                      for y in range(BOARD_HEIGHT)]
-                     for x in range(BOARD_WIDTH)]
-
-    def make_pieces_fall(self):
-        for y in range(self.height - 2, -1, -1):
-            for x in range(self.width):
-                cy = y
-                while cy < self.height - 1 and not self.grid[x][cy + 1] \
-                        and self.grid[x][cy]:
-                    self.grid[x][cy + 1] = self.grid[x][cy]
-                    self.grid[x][cy] = 0
-                    cy += 1
-
-    def iterate_pieces_falling(self):
-        """Yields the position and destination of each piece falling"""
-        for y in range(self.height - 2, -1, -1):
-            for x in range(self.width):
-                cy = y
-                while cy < self.height - 1 and not self.grid[x][cy + 1] \
-                        and self.grid[x][cy]:
-                    self.grid[x][cy + 1] = self.grid[x][cy]
-                    self.grid[x][cy] = 0
-                    cy += 1
-                if cy != y:
-                    yield ((x, y), (x, cy))
-
-    def get_string(self):
-        printboard = [''] * len(self.grid[0])
-        for x in range(self.width):
-            for y in range(self.height):
-                printboard[y] += str(self.grid[x][y])
-        return '\n'.join(printboard)
-
-    def lowest_in_column(self, column):
-        """Returns the y-coordinate for the lowest empty position in the given
-        column.
-        Returns -1 if the column is full"""
-        for y in range(self.height - 1, -1, -1):
-            if self.grid[column][y] == 0:
-                return y
-        return -1
-
-    def drop_piece(self, column, player):
-        y = self.lowest_in_column(column)
-        self.grid[column][y] = player
-
-    def column_blocked(self, column):
-        if self.grid[column][0] != 0:
-            return True
-        return False
+        # the board's image, made when it is first drawn, so boards can be
+        # used without a display
+        self._image = None
+        # disc sprites by (sub-pixel offset, team), and the team bitboards
+        # the image currently shows (None until it is first drawn)
+        self.sprites = {}
+        self.drawn = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = pygame.Surface(self.rect.size).convert()
+            self._image.set_colorkey(BG_COLOR)
+        return self._image
 
     def get_column_relative_x(self, column_number):
         radius = self.get_circle_radius()
-        return column_number * self.rect.width / BOARD_WIDTH + radius + 4
+        return column_number * self.rect.width / self.width + radius + 4
 
     def get_row_relative_y(self, row_number):
         radius = self.get_circle_radius()
-        return row_number * self.rect.height / BOARD_HEIGHT + radius + 2
+        return row_number * self.rect.height / self.height + radius + 2
 
     def get_circle_radius(self):
-        return self.rect.height / BOARD_HEIGHT / 2 - 5
+        return self.rect.height / self.height / 2 - 5
 
-    def clear_image(self):
-        self.image.fill(YELLOW)
+    def get_cell_sprite(self, x, y, team):
+        """Returns (sprite, position) for drawing the given team's disc (or
+        an empty hole) at (x, y) on the board image.
+
+        A sprite covers the disc and the yellow around it, so blitting it
+        looks the same as drawing the circle onto the filled board.  Sprites
+        are drawn once and shared by every cell whose center has the same
+        sub-pixel offset."""
         radius = self.get_circle_radius()
-        for x in range(self.width):
-            for y in range(self.height):
-                pygame.draw.circle(
-                    self.image, BG_COLOR, (
-                        self.get_column_relative_x(x),
-                        self.get_row_relative_y(y)),
-                    radius)
+        pad = int(radius) + 2
+        centerx = self.get_column_relative_x(x)
+        centery = self.get_row_relative_y(y)
+        left = int(centerx) - pad
+        top = int(centery) - pad
+        key = (centerx - left, centery - top, team)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = pygame.Surface((2 * pad + 1, 2 * pad + 1)).convert()
+            sprite.fill(YELLOW)
+            color = PLAYER_COLORS[team] if team else BG_COLOR
+            pygame.draw.circle(sprite, color, key[:2], radius)
+            self.sprites[key] = sprite
+        return sprite, (left, top)
+
+    def draw_cells(self, bits1, bits2):
+        """Brings the image up to date with the given team bitboards,
+        redrawing only the cells that differ from what it shows."""
+        g = self.state.geometry
+        if self.drawn is None:
+            self.image.fill(YELLOW)
+            changed = g.board_mask
+        else:
+            drawn1, drawn2 = self.drawn
+            changed = (drawn1 ^ bits1) | (drawn2 ^ bits2)
+        for index in engine.iterate_bits(changed):
+            bit = 1 << index
+            team = 1 if bits1 & bit else 2 if bits2 & bit else 0
+            x, y = g.position(index)
+            sprite, pos = self.get_cell_sprite(x, y, team)
+            self.image.blit(sprite, pos)
+        self.drawn = (bits1, bits2)
+
+    def clear_image(self):
+        self.draw_cells(0, 0)
 
     def update_image(self):
-        self.image.fill(YELLOW)
-        radius = self.get_circle_radius()
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.grid[x][y] == 0:  # empty spot
-                    color = BG_COLOR
-                elif self.grid[x][y] == 1:
-                    color = BLACK
-                elif self.grid[x][y] == 2:
-                    color = RED
-                pygame.draw.circle(
-                    self.image, color, (
-                        self.get_column_relative_x(x),
-                        self.get_row_relative_y(y)),
-                    radius)
-
-    def check_victory(self):
-        """
-        Yields (winning team, list of positions in 4-in-a-row)
-        list of positions is in the form [(x1, y1), (x2, y2), ...]
-        """
-        # for each position in the grid, checks lines extending from it
-        # pointing right, down, down-right, and down-left
-        for x in range(self.width):
-            for y in range(self.height):
-                # ignore positions that are empty
-                if self.grid[x][y] == 0:
-                    continue
-
-                # based on where the position is, determine which lines can be
-                # drawn that fit inside the grid
-                lines = []
-                if x < self.width - 3:
-                    # check horizontal line
-                    lines.append([(x1, y) for x1 in range(x, x + 4)])
-                if y < self.height - 3:
-                    # check vertical line
-                    lines.append([(x, y1) for y1 in range(y, y + 4)])
-                if x < self.width - 3 and y < self.height - 3:
-                    # check diagonal \ line
-                    lines.append([(x + d, y + d) for d in range(4)])
-                if x >= 3 and y < self.height - 3:
-                    # check diagonal / line
-                    lines.append([(x - d, y + d) for d in range(4)])
-
-                # go through each line, and, if all pieces in the line match,
-                # yield the team who won the line and the line itself
-                for line in lines:
-                    match = True
-                    for (x1, y1) in line[1:]:
-                        if self.grid[x][y] != self.grid[x1][y1]:
-                            match = False
-                            break
-                    if match:
-                        yield (self.grid[x][y], line)
+        self.draw_cells(self.state.bits[1], self.state.bits[2])
+
+
+class DirtyRegions(object):
+
+    """Collects the parts of the screen that changed during a frame, so only
+    those are pushed to the display."""
+
+    def __init__(self):
+        self.rects = []
+        # start with a full update, as nothing has been shown yet
+        self.everything = True
+
+    def add(self, rect):
+        self.rects.append(Rect(rect))
+
+    def add_all(self):
+        self.everything = True
+
+    def update(self):
+        """Pushes the changed regions to the display."""
+        if self.everything:
+            pygame.display.flip()
+        elif self.rects:
+            pygame.display.update(self.rects)
+        self.rects = []
+        self.everything = False
+
+
+class Timeline(object):
+
+    """Plays animations, and runs the game logic between them, one after
+    another, a frame at a time, so the main loop keeps handling input while
+    they play.
+
+    A task is either a function, which is called once when its turn comes,
+    or a generator, which draws a frame every time it is advanced and is
+    done when it stops.  Tasks added while a task runs go ahead of the ones
+    that were already waiting.  Animations should measure time with clock()
+    rather than count frames, so they last as long when frames are
+    dropped."""
+
+    def __init__(self):
+        self.tasks = collections.deque()
+        self.current = None
+        # seconds the timeline has been advanced by, in total
+        self.time = 0.0
+
+    def add(self, task):
+        self.tasks.append(task)
+
+    def busy(self):
+        return self.current is not None or bool(self.tasks)
+
+    def clock(self):
+        """Returns a function that gives the number of seconds the timeline
+        has been advanced by since clock() was called."""
+        start = self.time
+        return lambda: self.time - start
+
+    def update(self, seconds):
+        """Advances the timeline by the given number of seconds, running
+        tasks until one of them draws a frame or none are left.
+
+        Returns True if a frame was drawn."""
+        self.time += seconds
+        while self.current is not None or self.tasks:
+            task = self.current
+            if task is None:
+                task = self.tasks.popleft()
+            self.current = None
+            waiting = self.tasks
+            self.tasks = collections.deque()
+            try:
+                if callable(task):
+                    task()
+                else:
+                    next(task)
+                    self.current = task
+            except StopIteration:
+                pass
+            finally:
+                self.tasks.extend(waiting)
+            if self.current is not None:
+                return True
+        return False
+
+    def finish(self):
+        """Runs every task to the end, skipping to the last frame of each
+        animation."""
+        while self.update(3600.0):
+            pass
+
+
+def rotation_angles(steps=ROTATION_STEPS, easing=ROTATION_EASING):
+    """Returns the angle of the board image in every frame of the rotation
+    animation."""
+    if steps == 1:
+        return [ROTATION_FIRST_ANGLE]
+    ease = EASINGS[easing]
+    span = ROTATION_LAST_ANGLE - ROTATION_FIRST_ANGLE
+    return [ROTATION_FIRST_ANGLE + span * ease(i / (steps - 1.0))
+            for i in range(steps)]
+
+
+def build_rotation_frames(image, angles, smooth=False):
+    """Rotates the image to each of the angles.
+
+    Returns a list of (surface, offset), where offset is the position of the
+    surface's top-left corner relative to the image's center.  With smooth,
+    the frames are antialiased with rotozoom; the image's colorkey becomes
+    per-pixel alpha so its holes stay see-through."""
+    if smooth:
+        source = image.convert_alpha()
+    frames = []
+    for angle in angles:
+        if smooth:
+            frame = pygame.transform.rotozoom(source, angle, 1)
+        else:
+            frame = pygame.transform.rotate(image, angle)
+        width, height = frame.get_size()
+        frames.append((frame, (-width / 2, -height / 2)))
+    return frames
 
 
 class Game(object):
 
     """Singleton that manages input, rendering, and game logic."""
 
-    def __init__(self, screen, ai=True):
+    # attributes set after the game is made (from the command line) that
+    # are kept when the space bar starts a new game
+    SETTINGS = ('record_path', 'rotation_steps', 'rotation_easing',
+                'smooth_rotation', 'show_profile', 'profile_path')
+
+    def __init__(self, screen, ai=True, book=None, size=BOARD_WIDTH,
+                 win_length=WIN_LENGTH, rotate_time=ROTATE_TIME,
+                 positions=None):
+        """ai is the name of an entry in AI_STRATEGIES to play against, True
+        for the default strategy, or False for a two-player game.  book is a
+        book.OpeningBook for the AI to open from.  The board is size by size
+        cells, win_length pieces in a row win, and the board rotates every
+        rotate_time moves.  positions is a positiondb.PositionDB for the
+        basic AI to consult."""
+        import profiler
         self.screen = screen
+        self.book = book
+        self.positions = positions
+        self.rotate_time = rotate_time
+        # frame and AI search timings; F3 shows them, F4 exports them
+        self.profiler = profiler.Profiler()
+        self.show_profile = False
+        self.profile_path = PROFILE_PATH
+        self.profile_font = pygame.font.Font(None, 22)
+        if ai is True:
+            ai = DEFAULT_AI_STRATEGY
+        self.ai_strategy = ai
         if ai:
-            self.ai = AI(2)
+            if positions is not None:
+                self.ai = AI_STRATEGIES[ai](2, book=book, positions=positions)
+            else:
+                self.ai = AI_STRATEGIES[ai](2, book=book)
+            # the AI thinks in the background while the game goes on
+            import aiworker
+            self.ai_worker = aiworker.AIWorker(self.ai, self.profiler)
         else:
             self.ai = None
+            self.ai_worker = None
         self.timer = pygame.time.Clock()
-        self.board = Board(BOARD_WIDTH, BOARD_HEIGHT)
+        self.board = Board(size, size, win_length)
         self.bg = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT))
         self.bg.convert()
         self.bg.fill(BG_COLOR)
         self.board.update_image()
         self.num_pieces_dropped = 0
+        # the columns played so far, and the file finished games are
+        # appended to, if any
+        self.moves = []
+        self.record_path = None
         self.winner = None
         self.player_points = [0, 0, 0]
         self.victory_lines = []
@@ -281,102 +342,184 @@ class Game(object):
             pygame.draw.rect(
                 self.table_image, (0, c, c * 2), (x, y, 100, 100), 0)
 
+        # the pre-rendered background, built on first use
+        self.background = None
+        # screen regions that changed this frame, and the regions covered by
+        # things drawn over the background and board (the selected piece,
+        # text, moving pieces) that have to be erased next frame
+        self.dirty = DirtyRegions()
+        self.overlay_rects = []
+        # whether the screen may differ from the last frame drawn; while it
+        # doesn't and nothing animates, run() draws no frames
+        self.changed = True
+
+        # rotation animation settings, and the frames of the last rotation
+        # as ((board bits, angles, smooth), frames)
+        self.rotation_steps = ROTATION_STEPS
+        self.rotation_easing = ROTATION_EASING
+        self.smooth_rotation = False
+        self.rotation_frames = None
+
+        # animations, and the game logic waiting for them to finish
+        self.timeline = Timeline()
+
         self.column_selected = 0
 
         self.active_player = 1  # player 1 and 2 alternate turns
         draw_circle_window_icon(BLACK)
+        if self.ai:
+            self.ai_worker.ponder(self.get_game_state())
 
     def run(self):
         """Runs the game.
-        Limits FPS, handles input, and renders, in a loop."""
+        Limits FPS, handles input, and renders, in a loop.  Frames are only
+        drawn while something changes; otherwise the loop sleeps until the
+        next event."""
         while True:
-            self.timer.tick(MAX_FPS)
-            self.handle_input()
-            self.render_all()
+            if self.needs_frame():
+                seconds = self.timer.tick(MAX_FPS) / 1000.0
+                events = pygame.event.get()
+            else:
+                events = self.wait_for_events()
+                # the time spent waiting isn't part of any frame
+                self.timer.tick()
+                self.profiler.pause()
+                seconds = 0.0
+            with self.profiler.span('input'):
+                self.handle_input(events)
+            if self.needs_frame():
+                self.render_all(seconds)
+                self.profiler.end_frame()
+
+    def needs_frame(self):
+        """Returns True if the next frame could look different from the
+        last one drawn."""
+        return self.changed or self.timeline.busy()
+
+    def wait_for_events(self, timeout_ms=IDLE_TIMEOUT_MS):
+        """Sleeps until an event arrives, or for timeout_ms, and returns the
+        events waiting."""
+        event = pygame.event.wait(timeout_ms)
+        if event.type == NOEVENT:
+            if self.show_profile:
+                self.changed = True
+            return []
+        return [event] + pygame.event.get()
 
     def get_column_clicked(self, position):
         """Takes a mouse position and returns the column of the board that it
         was in."""
         x = position[0]
-        width_per_row = self.board.rect.width / BOARD_WIDTH
+        width_per_row = self.board.rect.width / self.board.width
         x_relative_to_board = x - self.board.rect.left
 
         return int(round(x_relative_to_board) / width_per_row - 1 / 2)
 
     def animate_circle_movement(self, x1, y1, x2, y2, num_seconds=1,
                                 color=BLACK):
-        """Animates a circle smoothly moving from one position to another."""
-        g = self.iterate_circle_movement(x1, y1, x2, y2, num_seconds, color)
-        for d in range(int(MAX_FPS * num_seconds)):
-            pygame.event.get()
-            self.render_background()
-            g.next()
-            self.render_board()
-            pygame.display.flip()
-            self.timer.tick(MAX_FPS)
+        """Animates a circle smoothly moving from one position to another.
+        A timeline task."""
+        for rect in self.iterate_circle_movement(x1, y1, x2, y2, num_seconds,
+                                                 color):
+            # the board is drawn over the circle, which shows through holes
+            self.render_board_part(rect)
+            self.add_overlay(rect)
+            yield
 
     def iterate_circle_movement(self, x1, y1, x2, y2, num_seconds=1,
                                 color=BLACK):
         """Animates a circle smoothly moving from one position to another, one
         iteration at a time."""
         # to be called once per frame
-        for d in range(int(MAX_FPS * num_seconds)):
-            x = x1 + (x2 - x1) * d / int(MAX_FPS * num_seconds)
-            y = y1 + (y2 - y1) * d / int(MAX_FPS * num_seconds)
-            pygame.draw.circle(self.screen, color,
-                               (x, y), self.board.get_circle_radius())
-            yield
-
-    def animate_drop_piece(self):
-        """Animates a piece in the selected column falling to the lowest empty
-        board position in that column."""
+        elapsed = self.timeline.clock()
+        while elapsed() < num_seconds:
+            d = elapsed() / num_seconds
+            x = x1 + (x2 - x1) * d
+            y = y1 + (y2 - y1) * d
+            yield pygame.draw.circle(self.screen, color, (x, y),
+                                     self.board.get_circle_radius())
+
+    def animate_drop_piece(self, column):
+        """Animates a piece falling into the given column, to its lowest empty
+        board position.  A timeline task."""
         starting_y = self.board.rect.top - 4
         x = self.board.rect.left + \
-            self.board.get_column_relative_x(self.column_selected)
+            self.board.get_column_relative_x(column)
         end_y = self.board.rect.top + \
             self.board.get_row_relative_y(
-                self.board.lowest_in_column(self.column_selected))
+                self.board.lowest_in_column(column))
 
         time = (end_y - starting_y) / self.board.get_circle_radius() / 50.0
-        self.animate_circle_movement(x, starting_y, x, end_y, time,
-                                     PLAYER_COLORS[self.active_player])
+        return self.animate_circle_movement(x, starting_y, x, end_y, time,
+                                            PLAYER_COLORS[self.active_player])
+
+    def get_game_state(self):
+        """Returns the position, with the active player to move, as an
+        engine.GameState."""
+        rotate_time = self.rotate_time
+        time_til_rotation = rotate_time - self.num_pieces_dropped % rotate_time
+        return engine.GameState(self.board.state.copy(), self.active_player,
+                                time_til_rotation, rotate_time)
 
     def do_ai_turn(self):
-        """Gets a move from the AI, and drops its piece."""
-        time_til_rotation = ROTATE_TIME - self.num_pieces_dropped % ROTATE_TIME
-        self.column_selected = self.ai.get_move(self.board, time_til_rotation)
+        """Asks the AI for a move, and drops its piece once it has chosen
+        one."""
+        self.ai_worker.request_move(self.get_game_state())
+        self.timeline.add(self.wait_for_ai())
+
+    def wait_for_ai(self):
+        """Waits for the AI's move, then drops its piece.  A timeline
+        task."""
+        while True:
+            move = self.ai_worker.poll()
+            if move is not None:
+                break
+            self.add_overlay(self.draw_moves_until_rotate())
+            yield
+        self.column_selected = move
         self.drop_piece()
 
     def drop_piece(self):
         """Drops a game piece for the active team into the currently-selected
-        column, animates it, handles game logic, and immediately does the AI
-        turn if needed."""
-        if not self.board.column_blocked(self.column_selected):
-            self.animate_drop_piece()
-            # drop piece
-            self.board.drop_piece(
-                self.column_selected, self.active_player)
-            self.board.update_image()
-
-            # toggle players 1 and 2
-            if self.active_player == 1:
-                self.active_player = 2
-            else:
-                self.active_player = 1
+        column, animates it, handles game logic, and then does the AI turn if
+        needed.  All of this happens on the timeline, over the next frames."""
+        column = self.column_selected
+        if not self.board.column_blocked(column):
+            self.timeline.add(self.animate_drop_piece(column))
+            self.timeline.add(functools.partial(self.finish_drop, column))
+
+    def finish_drop(self, column):
+        """Puts the dropped piece on the board once its animation is done."""
+        self.board.drop_piece(column, self.active_player)
+        self.moves.append(column)
+        self.board.update_image()
+        self.restore(self.board.rect)
+
+        # toggle players 1 and 2
+        if self.active_player == 1:
+            self.active_player = 2
+        else:
+            self.active_player = 1
 
-            draw_circle_window_icon(
-                PLAYER_COLORS[self.active_player])
-            self.num_pieces_dropped += 1
-            if self.num_pieces_dropped % ROTATE_TIME == 0:
-                self.rotate()
+        draw_circle_window_icon(
+            PLAYER_COLORS[self.active_player])
+        self.num_pieces_dropped += 1
+        if self.num_pieces_dropped % self.rotate_time == 0:
+            self.timeline.add(self.rotate())
+        self.timeline.add(self.finish_turn)
 
-            # player could move mouse during animations
-            self.update_column_selected()
+    def finish_turn(self):
+        # player could move mouse during animations
+        self.update_column_selected()
 
-            self.handle_victory()
+        self.handle_victory()
 
-            if not self.winner and self.active_player == 2 and self.ai:
+        if not self.winner and self.ai:
+            if self.active_player == 2:
                 self.do_ai_turn()
+            else:
+                # think about the replies while the player decides
+                self.ai_worker.ponder(self.get_game_state())
 
     def handle_victory(self):
         """Checks for victory, selects the winner, and draws victory lines."""
@@ -386,94 +529,129 @@ class Game(object):
                 pos1 = self.board_to_screen_pos(positions[0])
                 pos2 = self.board_to_screen_pos(positions[-1])
                 self.victory_lines.append((pos1, pos2))
-                self.player_points[winner] += 1
-            if self.player_points[1] > self.player_points[2]:
-                winning_player = 1
-            elif self.player_points[1] < self.player_points[2]:
-                winning_player = 2
-            else:
+            winning_player = engine.score_lines(v, self.player_points)
+            if winning_player == engine.DRAW:
                 # TIE...
                 winning_player = 3
 
-            self.slowly_draw_lines(self.victory_lines)
+            self.timeline.add(self.slowly_draw_lines(self.victory_lines))
 
             self.winner = winning_player
+            self.save_record()
+
+    def save_record(self):
+        """Appends the game to the record file, if there is one."""
+        if not self.record_path or not self.moves:
+            return
+        import gamerecord
+        winner = self.winner
+        if winner is None:
+            winner = gamerecord.UNFINISHED
+        elif winner == 3:
+            winner = gamerecord.DRAW
+        ai = gamerecord.HUMAN
+        if self.ai_strategy:
+            ai = gamerecord.PLAYER_CODES.index(self.ai_strategy)
+        with open(self.record_path, 'ab') as f:
+            gamerecord.write_game(
+                f, self.moves, (self.board.width, self.board.height,
+                                self.board.win_length, self.rotate_time),
+                winner, (gamerecord.HUMAN, ai))
 
     def slowly_draw_lines(self, lines):
-        """Slowly draws multiple lines at the same time."""
+        """Slowly draws multiple lines at the same time.  A timeline task."""
         generators = []
         for (p1, p2) in lines:
             generators.append(self.iterate_slowly_draw_line(p1, p2))
-        for d in range(MAX_FPS):
-            pygame.event.get()
-            self.render_background()
-            self.render_board()
-            for generator in generators:
-                generator.next()
-            pygame.display.flip()
-            self.timer.tick(MAX_FPS)
+        while True:
+            for generator in list(generators):
+                try:
+                    self.add_overlay(next(generator))
+                except StopIteration:
+                    generators.remove(generator)
+            if not generators:
+                return
+            yield
 
     def slowly_draw_line(self, p1, p2):
-        """Slowly draws a line."""
-        generator = self.iterate_slowly_draw_line(p1, p2)
-        for d in range(MAX_FPS):
-            pygame.event.get()
-            self.render_background()
-            self.render_board()
-            generator.next()
-            pygame.display.flip()
-            self.timer.tick(MAX_FPS)
+        """Slowly draws a line.  A timeline task."""
+        return self.slowly_draw_lines([(p1, p2)])
 
-    def iterate_slowly_draw_line(self, p1, p2):
+    def iterate_slowly_draw_line(self, p1, p2, num_seconds=1):
         """Slowly draws a line, one iteration at a time."""
         (x1, y1) = p1
         (x2, y2) = p2
-        for d in range(MAX_FPS):
-            x = x1 + (x2 - x1) * d / MAX_FPS
-            y = y1 + (y2 - y1) * d / MAX_FPS
-            pygame.draw.line(self.screen, VICTORY_LINE_COLOR, (x1, y1), (x, y),
-                             VICTORY_LINE_SIZE)
-            yield
+        elapsed = self.timeline.clock()
+        while elapsed() < num_seconds:
+            d = elapsed() / num_seconds
+            x = x1 + (x2 - x1) * d
+            y = y1 + (y2 - y1) * d
+            yield pygame.draw.line(self.screen, VICTORY_LINE_COLOR,
+                                   (x1, y1), (x, y), VICTORY_LINE_SIZE)
+
+    def get_rotation_frames(self):
+        """Returns the frames of the rotation animation for the board as it
+        is drawn now, rendering them only if the board or the animation
+        settings changed since they were last rendered."""
+        angles = tuple(rotation_angles(self.rotation_steps,
+                                       self.rotation_easing))
+        key = (self.board.drawn, angles, self.smooth_rotation)
+        if self.rotation_frames is None or self.rotation_frames[0] != key:
+            frames = build_rotation_frames(self.board.image, angles,
+                                           self.smooth_rotation)
+            self.rotation_frames = (key, frames)
+        return self.rotation_frames[1]
 
     def rotate(self):
         """Rotates the board and makes the pieces fall. Each part is
-        animated as well."""
+        animated as well.  A timeline task."""
         centerx = self.board.rect.centerx
         centery = self.board.rect.centery
-        for degree in range(1, 90, 10):
-            pygame.event.get()
+        frames = self.get_rotation_frames()
+        # one frame of the turn is shown every 1 / MAX_FPS seconds, skipping
+        # any that fall between two drawn frames
+        elapsed = self.timeline.clock()
+        while int(elapsed() * MAX_FPS) < len(frames):
+            image, (dx, dy) = frames[int(elapsed() * MAX_FPS)]
             self.render_background()
-            image = pygame.transform.rotate(self.board.image, degree)
-            width, height = image.get_size()
-            self.screen.blit(pygame.transform.rotate(self.board.image, degree),
-                             (centerx - width / 2, centery - height / 2))
-            pygame.display.flip()
-            self.timer.tick(MAX_FPS)
+            self.screen.blit(image, (centerx + dx, centery + dy))
+            self.dirty.add_all()
+            yield
         self.board.rotate()
         self.board.clear_image()
+        # the turning board reached past its rect, so redraw everything
+        self.render_background()
+        self.render_board()
+        self.overlay_rects = []
+        self.dirty.add_all()
         positions = self.board.iterate_pieces_falling()
         generators = []
         for (pos, pos2) in positions:
             x1, y1 = self.board_to_screen_pos(pos)
             x2, y2 = self.board_to_screen_pos(pos2)
-            (x, y) = pos
+            # the piece has already moved to its destination
+            (x, y) = pos2
             player = self.board.grid[x][y]
             color = PLAYER_COLORS[player]
             generators.append(
                 self.iterate_circle_movement(x1, y1, x2, y2, .1, color))
         while generators:
-            pygame.event.get()
-            self.render_background()
-            for g in generators:
+            # the falling pieces stay behind the board, so only its area
+            # changes
+            self.screen.blit(self.get_background(), self.board.rect,
+                             self.board.rect)
+            for g in list(generators):
                 try:
-                    g.next()
+                    next(g)
                 except StopIteration:
                     generators.remove(g)
                     self.board.update_image()
             self.render_board()
-            pygame.display.flip()
-            self.timer.tick(MAX_FPS)
+            self.dirty.add(self.board.rect)
+            if generators:
+                yield
         self.board.update_image()
+        self.restore(self.board.rect)
 
     def update_column_selected(self):
         """Updates the selected column based on the current mouse position."""
@@ -481,65 +659,135 @@ class Game(object):
         self.column_selected = self.get_column_clicked(pos)
         if self.column_selected < 0:
             self.column_selected = 0
-        elif self.column_selected > BOARD_WIDTH - 1:
-            self.column_selected = BOARD_WIDTH - 1
+        elif self.column_selected > self.board.width - 1:
+            self.column_selected = self.board.width - 1
 
-    def handle_input(self):
-        for e in pygame.event.get():
+    def restart(self):
+        """Starts a new game with the same rules and settings."""
+        if self.ai_worker:
+            self.ai_worker.close()
+        if not self.winner:
+            self.save_record()
+        settings = [(name, getattr(self, name)) for name in self.SETTINGS]
+        self.__init__(self.screen, self.ai_strategy, self.book,
+                      self.board.width, self.board.win_length,
+                      self.rotate_time, self.positions)
+        for name, value in settings:
+            setattr(self, name, value)
+
+    def handle_input(self, events=None):
+        """Handles the events, or the ones waiting if not given."""
+        if events is None:
+            events = pygame.event.get()
+        column = self.column_selected
+        for e in events:
+            if e.type != MOUSEMOTION:
+                self.changed = True
             if e.type == MOUSEMOTION:
                 self.update_column_selected()
+            elif e.type == VIDEOEXPOSE:
+                # the window was covered or resized, and has to be drawn
+                # again in full
+                self.dirty.add_all()
             elif e.type == MOUSEBUTTONDOWN:
-                if e.button == 1 and not self.winner:
+                if e.button == 1 and not self.winner and \
+                        not self.timeline.busy():
                     # MOUSE CLICK
                     self.drop_piece()
             elif e.type == KEYDOWN:
                 if e.key == K_SPACE:
-                    # restart game
-                    self.__init__(self.screen)
+                    self.restart()
                 elif e.key == K_LEFT:
                     self.column_selected -= 1
                     if self.column_selected < 0:
                         self.column_selected = 0
                 elif e.key == K_RIGHT:
                     self.column_selected += 1
-                    if self.column_selected > BOARD_WIDTH - 1:
-                        self.column_selected = BOARD_WIDTH - 1
+                    if self.column_selected > self.board.width - 1:
+                        self.column_selected = self.board.width - 1
                 elif e.key == K_RETURN:
                     if not self.board.column_blocked(self.column_selected):
-                        if not self.winner:
+                        if not self.winner and not self.timeline.busy():
                             self.drop_piece()
+                elif e.key == K_F3:
+                    self.show_profile = not self.show_profile
+                elif e.key == K_F4:
+                    self.profiler.export(self.profile_path)
                 elif e.key == K_ESCAPE:
                     pygame.quit()
                     sys.exit()
             elif e.type == QUIT:
                 pygame.quit()
                 sys.exit()
+        if self.column_selected != column:
+            self.changed = True
 
-    def render_background(self):
-        """Renders the background, including a mode 7 effect for the table."""
+    def build_background(self):
+        """Renders the background, including a mode 7 effect for the table,
+        into a surface the size of the screen."""
+        background = pygame.Surface(self.screen.get_size()).convert()
         # draw background
-        self.screen.blit(self.bg, (0, 0))
+        background.blit(self.bg, (0, 0))
         # draw table, mode 7 effect-ish
         stretch_factor = 75.0
+        line = pygame.surface.Surface((800, 1))
         for y in range(300, 600):
             # Take a line from the original & stretch it.
             img_y = (y + 0 - 300) * 2
-            line = pygame.surface.Surface((800, 1))
             line.blit(self.table_image, (0, 0), (0, img_y, 800, 1))
             w = 800 * (1.0 + ((y - 300) / stretch_factor))
             x = -(w - 800) / 2  # Draw wide line left of screen's edge
-            line = pygame.transform.scale(line, (int(w), 1))
-            self.screen.blit(line, (x, y))
+            background.blit(pygame.transform.scale(line, (int(w), 1)), (x, y))
+        return background
+
+    def get_background(self):
+        """Returns the pre-rendered background.  The table never changes, so
+        it is only rendered again when the screen changes size."""
+        if self.background is None or \
+                self.background.get_size() != self.screen.get_size():
+            self.background = self.build_background()
+        return self.background
+
+    def render_background(self):
+        """Draws the background."""
+        self.screen.blit(self.get_background(), (0, 0))
 
     def render_board(self):
         """Draws the board."""
         self.screen.blit(
             self.board.image, (self.board.rect.x, self.board.rect.y))
 
+    def render_board_part(self, rect):
+        """Draws the part of the board inside the given screen rect."""
+        area = self.board.rect.clip(rect)
+        if area:
+            self.screen.blit(self.board.image, area.topleft,
+                             area.move(-self.board.rect.x,
+                                       -self.board.rect.y))
+
+    def restore(self, rect):
+        """Redraws the background and board inside the given screen rect,
+        covering anything drawn over them there, and marks it as changed."""
+        rect = Rect(rect)
+        self.screen.blit(self.get_background(), rect, rect)
+        self.render_board_part(rect)
+        self.dirty.add(rect)
+
+    def add_overlay(self, rect):
+        """Marks a region drawn over the background and board, to be erased
+        next frame."""
+        self.overlay_rects.append(rect)
+        self.dirty.add(rect)
+
+    def erase_overlays(self):
+        for rect in self.overlay_rects:
+            self.restore(rect)
+        self.overlay_rects = []
+
     def draw_current_piece(self):
         """Draws a piece over the currently-selected column."""
         radius = self.board.get_circle_radius()
-        pygame.draw.circle(
+        return pygame.draw.circle(
             self.screen, PLAYER_COLORS[self.active_player], (
                 self.board.rect.left +
                 self.board.get_column_relative_x(self.column_selected),
@@ -548,28 +796,72 @@ class Game(object):
 
     def draw_victory_lines(self):
         """Draws lines over 4-in-a-rows."""
-        for (p1, p2) in self.victory_lines:
-            pygame.draw.line(
-                self.screen, VICTORY_LINE_COLOR, p1, p2, VICTORY_LINE_SIZE)
+        return [pygame.draw.line(self.screen, VICTORY_LINE_COLOR, p1, p2,
+                                 VICTORY_LINE_SIZE)
+                for (p1, p2) in self.victory_lines]
 
     def draw_moves_until_rotate(self):
         """Draws the number of moves until the next board rotation to the
         top-left of the screen."""
-        moves = ROTATE_TIME - self.num_pieces_dropped % ROTATE_TIME
-        if moves == 0:
-            moves = ROTATE_TIME
-        draw_text(str(moves), self.font, self.screen, 10, 10)
-
-    def render_all(self):
-        """Renders everything and updates the display."""
-        self.render_background()
-        self.render_board()
-        if not self.winner:
-            self.draw_current_piece()
-            self.draw_moves_until_rotate()
+        moves = self.rotate_time - self.num_pieces_dropped % self.rotate_time
+        return draw_text(str(moves), self.font, self.screen, 10, 10)
+
+    def render_all(self, seconds=0.0):
+        """Advances the animations by the given number of seconds, renders
+        everything that changed and updates the display.
+
+        The background and board are only drawn in full when the whole
+        screen needs it; otherwise the overlays of the last frame are erased
+        and drawn again, and only their regions are updated.  While an
+        animation plays, it draws the frame instead of the usual overlays."""
+        span = self.profiler.span
+        if self.dirty.everything:
+            with span('background'):
+                self.render_background()
+            with span('board'):
+                self.render_board()
+            self.overlay_rects = []
         else:
-            self.draw_victory_lines()
-        pygame.display.flip()
+            with span('background'):
+                self.erase_overlays()
+        # animation frames count as overlay time
+        with span('overlay'):
+            if not self.timeline.update(seconds):
+                if not self.winner:
+                    self.add_overlay(self.draw_current_piece())
+                    self.add_overlay(self.draw_moves_until_rotate())
+                else:
+                    for rect in self.draw_victory_lines():
+                        self.add_overlay(rect)
+            if self.show_profile:
+                self.add_overlay(self.draw_profile())
+        with span('flip'):
+            self.dirty.update()
+        # once the animations are over, this frame stays up to date until
+        # something happens
+        self.changed = self.timeline.busy()
+
+    def draw_profile(self):
+        """Draws the frame rate, frame times, slowest span and AI search
+        speed to the top-right of the screen."""
+        summary = self.profiler.summary()
+        lines = ["%.1f fps  p50 %.1f ms  p99 %.1f ms" % (
+            summary['fps'], summary['frame_p50_ms'],
+            summary['frame_p99_ms'])]
+        slowest = summary['slowest_span']
+        if slowest:
+            lines.append("slowest: %s %.2f ms" % (
+                slowest, summary['spans'][slowest]['mean_ms']))
+        search = summary['search']
+        if search:
+            lines.append("AI: %.0f ms, %.0f nodes/s, depth %d" % (
+                search['mean_ms'], search['nodes_per_sec'],
+                search['last_depth']))
+        rects = [draw_text(line, self.profile_font, self.screen,
+                           WINDOW_WIDTH - 10, 10 + 18 * i,
+                           position='topright')
+                 for i, line in enumerate(lines)]
+        return rects[0].unionall(rects[1:])
 
     def board_to_screen_pos(self, pos):
         """Converts the given position in board coordinates into screen
@@ -609,11 +901,67 @@ def draw_circle_window_icon(color):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Grav-Twist Connect 4")
+    parser.add_argument('--ai', default=DEFAULT_AI_STRATEGY,
+                        choices=sorted(AI_STRATEGIES) + ['none'],
+                        help="computer opponent to play against")
+    parser.add_argument('--rotation-steps', type=int, default=ROTATION_STEPS,
+                        help="frames in the board rotation animation")
+    parser.add_argument('--rotation-easing', default=ROTATION_EASING,
+                        choices=sorted(EASINGS))
+    parser.add_argument('--smooth-rotation', action='store_true',
+                        help="antialias the rotating board")
+    parser.add_argument('--book', default=None,
+                        help="opening book for the AI, made by book.py")
+    parser.add_argument('--size', type=int, default=BOARD_WIDTH,
+                        help="width and height of the board (at most %d)" %
+                        engine.MAX_BOARD_SIZE)
+    parser.add_argument('--win-length', type=int, default=WIN_LENGTH,
+                        help="pieces in a row needed to win")
+    parser.add_argument('--rotate-time', type=int, default=ROTATE_TIME,
+                        help="moves between board rotations")
+    parser.add_argument('--show-profile', action='store_true',
+                        help="start with the frame-time overlay shown (F3)")
+    parser.add_argument('--profile-export', default=PROFILE_PATH,
+                        metavar='PATH',
+                        help="file F4 writes frame-time histograms to")
+    parser.add_argument('--positions', default=None, metavar='PATH',
+                        help="position database for the basic AI, made by "
+                        "positiondb.py")
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help="append every game played to this record file "
+                        "(see gamerecord.py)")
+    args = parser.parse_args()
+    if args.rotation_steps < 1:
+        parser.error("--rotation-steps must be at least 1")
+    try:
+        engine.check_rules(args.size, args.win_length, args.rotate_time)
+    except ValueError as e:
+        parser.error(str(e))
+    ai = args.ai if args.ai != 'none' else False
+    if args.positions and args.ai != 'basic':
+        parser.error("--positions only works with --ai basic")
+    opening_book = None
+    if args.book:
+        import book
+        opening_book = book.OpeningBook(args.book)
+    positions = None
+    if args.positions:
+        import positiondb
+        positions = positiondb.PositionDB(args.positions)
+
     pygame.init()
     screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
     pygame.display.set_caption("Grav-Twist Connect 4")
     draw_circle_window_icon(YELLOW)
-    game = Game(screen)
+    game = Game(screen, ai, opening_book, args.size, args.win_length,
+                args.rotate_time, positions)
+    game.rotation_steps = args.rotation_steps
+    game.rotation_easing = args.rotation_easing
+    game.smooth_rotation = args.smooth_rotation
+    game.show_profile = args.show_profile
+    game.profile_path = args.profile_export
+    game.record_path = args.record
     game.run()
 
 
@@ -0,0 +1,325 @@
+"""Monte Carlo tree search AI for Grav-Twist Connect 4.
+
+Positions are scored by random playouts that include the rotations and the
+gravity that follows them, so no static evaluation is needed.  Several
+processes can search the same position independently (root parallelism);
+their root visit counts are added up to pick the move."""
+
+import itertools
+import math
+import multiprocessing
+import random
+import time
+
+import engine
+
+DEFAULT_BUDGET_MS = 500
+
+# exploration constant for UCT
+EXPLORATION = math.sqrt(2)
+
+# how many iterations to run between looking at the clock
+ITERATIONS_PER_TIME_CHECK = 16
+
+# seconds between checks for stop() while the process pool searches
+STOP_CHECK_SECONDS = 0.01
+
+DRAW = 0
+
+
+def playout(board, active_player, turns_til_rotation, rotate_time, rng):
+    """Plays random moves on the board until the game ends.
+
+    Returns the winning team, or DRAW if both teams get the same number of
+    lines at once or the board fills up.  The board is modified."""
+    g = board.geometry
+    heights = board.heights
+    height = board.height
+    bits = board.bits
+    width = board.width
+    has_line = g.has_line
+    while True:
+        moves = [x for x in range(width) if heights[x] < height]
+        if not moves:
+            return DRAW
+        board.drop(moves[int(rng.random() * len(moves))], active_player)
+        turns_til_rotation -= 1
+        if turns_til_rotation == 0:
+            board.rotate_and_fall()
+            turns_til_rotation = rotate_time
+            winner = board.winner()
+            if winner is not None:
+                return winner
+        elif has_line(bits[active_player], g):
+            # without a rotation only the new piece can complete a line
+            return active_player
+        active_player = 3 - active_player
+
+
+def terminal_result(state):
+    """Returns the result of the game if it is over, or None."""
+    winner = state.winner()
+    if winner is not None:
+        return winner
+    if not state.legal_moves():
+        return DRAW
+    return None
+
+
+class Node(object):
+
+    """A position in the search tree, reached by playing move."""
+
+    __slots__ = ('move', 'team', 'children', 'untried', 'visits', 'wins',
+                 'result')
+
+    def __init__(self, move, team, state):
+        self.move = move
+        # the team that played move; wins are counted for this team
+        self.team = team
+        self.children = []
+        self.result = terminal_result(state) if move is not None else None
+        self.untried = [] if self.result is not None else state.legal_moves()
+        self.visits = 0
+        self.wins = 0.0
+
+    def select_child(self):
+        """Returns the child with the highest UCT score."""
+        log_visits = math.log(self.visits)
+        best = None
+        best_score = -1.0
+        for child in self.children:
+            score = (child.wins / child.visits +
+                     EXPLORATION * math.sqrt(log_visits / child.visits))
+            if score > best_score:
+                best_score = score
+                best = child
+        return best
+
+
+class Tree(object):
+
+    """A single-threaded UCT search rooted at one position."""
+
+    def __init__(self, state, rng):
+        self.state = state.clone()
+        self.rng = rng
+        self.root = Node(None, 3 - state.active_player, self.state)
+        self.iterations = 0
+
+    def iterate(self):
+        """Runs one selection, expansion, playout and backup step."""
+        state = self.state
+        node = self.root
+        path = [node]
+
+        # selection
+        while not node.untried and node.children:
+            node = node.select_child()
+            state.push(node.move)
+            path.append(node)
+
+        # expansion
+        if node.untried:
+            move = node.untried.pop(int(self.rng.random() *
+                                        len(node.untried)))
+            team = state.active_player
+            state.push(move)
+            node.children.append(Node(move, team, state))
+            node = node.children[-1]
+            path.append(node)
+
+        # simulation
+        if node.result is not None:
+            result = node.result
+        else:
+            result = playout(state.board.copy(), state.active_player,
+                             state.turns_til_rotation, state.rotate_time,
+                             self.rng)
+
+        # backup
+        for node in path:
+            node.visits += 1
+            if result == node.team:
+                node.wins += 1.0
+            elif result == DRAW:
+                node.wins += 0.5
+        for i in range(len(path) - 1):
+            state.pop()
+        self.iterations += 1
+
+    def run(self, deadline, stopped=None):
+        """Iterates until the deadline (a time.time() value) passes, or
+        until stopped(), if given, returns True."""
+        while True:
+            for i in range(ITERATIONS_PER_TIME_CHECK):
+                self.iterate()
+            if time.time() >= deadline or (stopped is not None and
+                                           stopped()):
+                return
+
+    def root_statistics(self):
+        """Returns {move: (visits, wins)} for the root's children."""
+        return dict((child.move, (child.visits, child.wins))
+                    for child in self.root.children)
+
+
+def state_to_args(state):
+    """Packs a GameState into a tuple that can be sent to a worker."""
+    board = state.board
+    return (board.width, board.height, board.win_length, board.bits[1],
+            board.bits[2], list(board.heights), state.active_player,
+            state.turns_til_rotation, state.rotate_time)
+
+
+def state_from_args(args):
+    (width, height, win_length, bits1, bits2, heights, active, turns,
+     rotate_time) = args
+    board = engine.BitBoard(width, height, win_length)
+    board.bits[1] = bits1
+    board.bits[2] = bits2
+    board.heights = list(heights)
+    return engine.GameState(board, active, turns, rotate_time)
+
+
+# in a pool process, the pool's shared count of stopped searches: every
+# search numbered below it stops
+_stopped_below = None
+
+
+def init_worker(stopped_below):
+    global _stopped_below
+    _stopped_below = stopped_below
+
+
+def search_worker(args):
+    """Runs one independent search in a pool process, until the budget runs
+    out or the search is stopped.
+
+    Returns (root statistics, number of iterations)."""
+    state_args, budget_ms, seed, number = args
+    deadline = time.time() + budget_ms / 1000.0
+    tree = Tree(state_from_args(state_args), random.Random(seed))
+    tree.run(deadline, lambda: _stopped_below.value > number)
+    return tree.root_statistics(), tree.iterations
+
+
+_pools = {}
+
+# numbers the pooled searches, so stop_search can stop one by its number
+_search_numbers = itertools.count()
+
+
+def get_pool(processes):
+    """Returns a process pool of the given size, shared by every MCTSAI, and
+    the shared value that stops its searches (see stop_search)."""
+    pool = _pools.get(processes)
+    if pool is None:
+        stopped_below = multiprocessing.Value('l', 0)
+        pool = _pools[processes] = (
+            multiprocessing.Pool(processes, init_worker, (stopped_below,)),
+            stopped_below)
+    return pool
+
+
+def stop_search(stopped_below, number):
+    """Makes the pool's workers stop the search with the given number, and
+    any that came before it."""
+    with stopped_below.get_lock():
+        if stopped_below.value <= number:
+            stopped_below.value = number + 1
+
+
+class MCTSAI(object):
+
+    """Monte Carlo tree search with UCT selection.
+
+    With processes > 1 every process grows its own tree from the current
+    position for the whole budget, and the root visit counts are merged.
+    The search is anytime: the most visited move when the budget runs out
+    is played."""
+
+    def __init__(self, team, budget_ms=DEFAULT_BUDGET_MS, processes=None,
+                 seed=None, book=None):
+        self.team = team
+        self.budget_ms = budget_ms
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.rng = random.Random(seed)
+        # a book.OpeningBook to play the first moves from, or None
+        self.book = book
+        # set by stop(), and left set until the caller clears it
+        self.stopped = False
+        # statistics about the last call to get_move
+        self.playouts = 0
+        self.visits = {}
+
+    def get_move(self, board, turns_til_rotation, budget_ms=None,
+                 rotate_time=engine.ROTATE_TIME):
+        """Returns the column # to drop the piece in, in a game where the
+        board rotates every rotate_time moves."""
+        state = engine.GameState(board.state.copy(), self.team,
+                                 turns_til_rotation, rotate_time)
+        return self.search(state, budget_ms)
+
+    def search(self, state, budget_ms=None):
+        """Searches the given position and returns the best column for the
+        player to move."""
+        self.playouts = 0
+        if self.book is not None:
+            move = self.book.lookup(state)
+            if move is not None:
+                return move
+        if budget_ms is None:
+            budget_ms = self.budget_ms
+        moves = state.legal_moves()
+        if not moves:
+            return self.rng.randint(0, state.board.width - 1)
+
+        # always take an immediate win
+        team = state.active_player
+        for x in moves:
+            state.push(x)
+            winner = state.winner()
+            state.pop()
+            if winner == team:
+                return x
+
+        if self.processes > 1:
+            pool, stopped_below = get_pool(self.processes)
+            number = next(_search_numbers)
+            args = state_to_args(state)
+            jobs = [(args, budget_ms, self.rng.getrandbits(32), number)
+                    for i in range(self.processes)]
+            pending = pool.map_async(search_worker, jobs)
+            while not pending.ready():
+                if self.stopped:
+                    # the workers notice within ITERATIONS_PER_TIME_CHECK
+                    # iterations and return what they have
+                    stop_search(stopped_below, number)
+                    pending.wait()
+                    break
+                pending.wait(STOP_CHECK_SECONDS)
+            results = pending.get()
+        else:
+            deadline = time.time() + budget_ms / 1000.0
+            tree = Tree(state, random.Random(self.rng.getrandbits(32)))
+            tree.run(deadline, lambda: self.stopped)
+            results = [(tree.root_statistics(), tree.iterations)]
+
+        visits = {}
+        for statistics, iterations in results:
+            self.playouts += iterations
+            for move, (move_visits, wins) in statistics.items():
+                visits[move] = visits.get(move, 0) + move_visits
+        self.visits = visits
+        if not visits:
+            return moves[0]
+        return max(sorted(visits), key=lambda move: visits[move])
+
+    def stop(self):
+        """Makes a search running in another thread return soon, with the
+        most visited move so far.  A search that hasn't started yet returns
+        just as soon, until stopped is set back to False."""
+        self.stopped = True
@@ -0,0 +1,410 @@
+#!/usr/bin/env python2
+"""Position database: how recorded games went from every position in them.
+
+    $ python positiondb.py build games.rec -o positions.db
+    $ python positiondb.py query positions.db 3 3 4
+
+The database counts, for every position reached in a set of games, how
+many of those games the player to move went on to win, draw and lose.  A
+position is its two bitboards plus the moves until the next rotation (whose
+turn it is follows from the number of pieces).  The board always turns the
+same way, so a position and its mirror image usually play out differently;
+they are only stored once, as whichever sorts first, when the board fills up
+before it can rotate again.
+
+The file is a header followed by an open-addressing hash table of
+fixed-size slots, with linear probing.  It is memory-mapped, so a lookup
+only touches the few slots it probes, and processes that open the same
+file share its pages.  Building counts a few thousand positions at a time
+in a dict and then merges them into the table, doubling the table first if
+it would get too full; doubling moves the slots from one mapping to the
+other."""
+from __future__ import print_function
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+import engine
+import gamerecord
+
+MAGIC = b'GTPOS1\0\0'
+
+# magic, number of slots (a power of two), slots in use, board width, board
+# height, win length, rotate time
+HEADER = struct.Struct('<8sIIBBBB12x')
+
+# team 1's bitboard, team 2's, moves until the next rotation (0 marks an
+# empty slot), and the games the player to move won, drew and lost from here
+SLOT = struct.Struct('<QQB3xIII')
+
+DEFAULT_CAPACITY = 1 << 16
+# fraction of the slots in use before the table is doubled
+MAX_LOAD = 0.7
+
+# distinct positions counted in memory before they are merged into the
+# file; enough to add up the openings every game shares, and small enough
+# that the table stays the only big thing in memory
+BATCH_POSITIONS = 1 << 12
+
+# games a position needs before the AI trusts its statistics
+MIN_GAMES = 10
+
+MASK64 = (1 << 64) - 1
+
+
+def slot_hash(bits1, bits2, turns):
+    h = (bits1 * 0x9e3779b97f4a7c15 ^ bits2 * 0xc2b2ae3d27d4eb4f ^
+         turns * 0x165667b19e3779f9) & MASK64
+    return h ^ (h >> 31)
+
+
+def mirror_bits(bits, geometry):
+    """Returns the bitboard mirrored left to right."""
+    column_bits = geometry.column_bits
+    column_mask = geometry.column_mask
+    shift = (geometry.width - 1) * column_bits
+    mirrored = 0
+    while bits:
+        mirrored |= (bits & column_mask) << shift
+        bits >>= column_bits
+        shift -= column_bits
+    return mirrored
+
+
+def canonical(bits1, bits2, turns, geometry):
+    """Returns the key of a position: (bits1, bits2, turns).  If the game
+    has to end before the next rotation (there are fewer empty cells than
+    moves until it), the position plays out like its mirror image, and the
+    smaller of the two is used."""
+    empty = geometry.width * geometry.height - bin(bits1 | bits2).count('1')
+    if empty >= turns:
+        return bits1, bits2, turns
+    mirrored = (mirror_bits(bits1, geometry), mirror_bits(bits2, geometry))
+    if mirrored < (bits1, bits2):
+        return mirrored + (turns,)
+    return bits1, bits2, turns
+
+
+def create(path, rules=(engine.BOARD_WIDTH, engine.BOARD_HEIGHT,
+                        engine.WIN_LENGTH, engine.ROTATE_TIME),
+           capacity=DEFAULT_CAPACITY):
+    """Creates an empty database file for games played by the rules (width,
+    height, win length, rotate time) and returns it opened for writing."""
+    width, height, win_length, rotate_time = rules
+    if width * (height + 1) > 64:
+        raise ValueError("positions on boards bigger than 7x7 don't fit in "
+                         "a slot")
+    if capacity & (capacity - 1) or capacity < 1:
+        raise ValueError("capacity must be a power of two")
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, capacity, 0, width, height, win_length,
+                            rotate_time))
+        # the slots start out as zeros, which most filesystems don't store
+        f.truncate(HEADER.size + capacity * SLOT.size)
+    return PositionDB(path, writable=True)
+
+
+class PositionDB(object):
+
+    """A position database file, mapped into memory."""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self.open()
+
+    def open(self):
+        with open(self.path, 'r+b' if self.writable else 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE
+                                 if self.writable else mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError("%s is not a position database" % self.path)
+        (magic, self.capacity, self.count, self.width, self.height,
+         self.win_length, self.rotate_time) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or \
+                len(self.map) != HEADER.size + self.capacity * SLOT.size:
+            raise ValueError("%s is not a position database" % self.path)
+        self.mask = self.capacity - 1
+        self.geometry = engine.get_geometry(self.width, self.height,
+                                            self.win_length)
+
+    def close(self):
+        if self.writable:
+            self.map.flush()
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def rules(self):
+        return self.width, self.height, self.win_length, self.rotate_time
+
+    def find(self, key):
+        """Returns the slot of the key, or the empty slot it would go in."""
+        data = self.map
+        mask = self.mask
+        i = slot_hash(*key) & mask
+        while True:
+            offset = HEADER.size + i * SLOT.size
+            bits1, bits2, turns = SLOT.unpack_from(data, offset)[:3]
+            if not turns or (bits1, bits2, turns) == key:
+                return i
+            i = (i + 1) & mask
+
+    def probe(self, key):
+        """Returns (wins, draws, losses) for a canonical key, or None if no
+        game reached the position."""
+        slot = SLOT.unpack_from(self.map,
+                                HEADER.size + self.find(key) * SLOT.size)
+        if not slot[2]:
+            return None
+        return slot[3:]
+
+    def lookup(self, state):
+        """Returns (wins, draws, losses) of the player to move for the
+        engine.GameState, or None if no game reached it."""
+        board = state.board
+        if (board.width, board.height, board.win_length,
+                state.rotate_time) != self.rules:
+            return None
+        return self.probe(canonical(board.bits[1], board.bits[2],
+                                    state.turns_til_rotation,
+                                    self.geometry))
+
+    def move_scores(self, state, min_games=MIN_GAMES):
+        """Returns {move: (score, games)} for the legal moves whose position
+        was reached in at least min_games games, where score is the fraction
+        of them the player to move went on to win, counting draws as half."""
+        scores = {}
+        for x in state.legal_moves():
+            state.push(x)
+            counts = self.lookup(state)
+            state.pop()
+            if counts is None:
+                continue
+            # the counts are for the opponent, who moves next
+            losses, draws, wins = counts
+            games = wins + draws + losses
+            if games >= min_games:
+                scores[x] = ((wins + draws * 0.5) / games, games)
+        return scores
+
+    def best_move(self, state, min_games=MIN_GAMES):
+        """Returns the move that scored best in the recorded games, or None
+        if no move was played in enough of them."""
+        scores = self.move_scores(state, min_games)
+        if not scores:
+            return None
+        return max(sorted(scores), key=lambda x: scores[x])
+
+    def add_counts(self, counts):
+        """Adds {key: [wins, draws, losses]} to the table."""
+        if not self.writable:
+            raise ValueError("the database was opened read-only")
+        needed = self.count + len(counts)
+        if needed > self.capacity * MAX_LOAD:
+            capacity = self.capacity
+            while needed > capacity * MAX_LOAD:
+                capacity *= 2
+            self.resize(capacity)
+        data = self.map
+        mask = self.mask
+        unpack_from = SLOT.unpack_from
+        pack_into = SLOT.pack_into
+        added = 0
+        for key, (wins, draws, losses) in counts.items():
+            i = slot_hash(*key) & mask
+            while True:
+                offset = HEADER.size + i * SLOT.size
+                slot = unpack_from(data, offset)
+                if not slot[2]:
+                    added += 1
+                    break
+                if slot[:3] == key:
+                    wins += slot[3]
+                    draws += slot[4]
+                    losses += slot[5]
+                    break
+                i = (i + 1) & mask
+            pack_into(data, offset, key[0], key[1], key[2], wins, draws,
+                      losses)
+        self.count += added
+        HEADER.pack_into(data, 0, MAGIC, self.capacity, self.count,
+                         self.width, self.height, self.win_length,
+                         self.rotate_time)
+
+    def resize(self, capacity):
+        """Rewrites the table with the given number of slots, copying each
+        slot from the old mapping straight into its place in the new one."""
+        temporary = self.path + '.tmp'
+        table = create(temporary, self.rules, capacity)
+        old = self.map
+        new = table.map
+        mask = table.mask
+        unpack_from = SLOT.unpack_from
+        size = SLOT.size
+        for offset in range(HEADER.size, len(old), size):
+            key = unpack_from(old, offset)[:3]
+            if not key[2]:
+                continue
+            # every key is new to the table, so it goes in the first empty
+            # slot
+            i = slot_hash(*key) & mask
+            while unpack_from(new, HEADER.size + i * size)[2]:
+                i = (i + 1) & mask
+            target = HEADER.size + i * size
+            new[target:target + size] = old[offset:offset + size]
+        table.count = self.count
+        HEADER.pack_into(new, 0, MAGIC, capacity, self.count, self.width,
+                         self.height, self.win_length, self.rotate_time)
+        table.close()
+        self.close()
+        os.rename(temporary, self.path)
+        self.open()
+
+    def ingest(self, records, progress=None):
+        """Adds the positions of gamerecord.GameRecords with the database's
+        rules, and returns (games added, positions added).  Unfinished games
+        and games played by other rules are skipped.  progress, if given,
+        is called as progress(games added, positions added) after every
+        batch."""
+        geometry = self.geometry
+        rules = self.rules
+        rotate_time = self.rotate_time
+        counts = {}
+        games = positions = 0
+        for record in records:
+            winner = record.winner
+            if record.rules != rules or winner == gamerecord.UNFINISHED:
+                continue
+            # outcome for team 1 to move and for team 2 to move, as indices
+            # into [wins, draws, losses]
+            if winner == gamerecord.DRAW:
+                outcomes = (None, 1, 1)
+            else:
+                outcomes = (None, 0 if winner == 1 else 2,
+                            0 if winner == 2 else 2)
+            board = engine.BitBoard(self.width, self.height, self.win_length)
+            bits = board.bits
+            turns = rotate_time
+            team = 1
+            moves = record.moves
+            for ply in range(len(moves) + 1):
+                key = canonical(bits[1], bits[2], turns, geometry)
+                entry = counts.get(key)
+                if entry is None:
+                    entry = counts[key] = [0, 0, 0]
+                entry[outcomes[team]] += 1
+                if ply == len(moves):
+                    break
+                board.drop(moves[ply], team)
+                team = 3 - team
+                turns -= 1
+                if not turns:
+                    board.rotate_and_fall()
+                    turns = rotate_time
+            games += 1
+            positions += len(moves) + 1
+            if len(counts) >= BATCH_POSITIONS:
+                self.add_counts(counts)
+                counts = {}
+                if progress:
+                    progress(games, positions)
+        self.add_counts(counts)
+        if progress:
+            progress(games, positions)
+        return games, positions
+
+
+def main_build(args):
+    if os.path.exists(args.output):
+        db = PositionDB(args.output, writable=True)
+    else:
+        db = create(args.output, (args.size, args.size, args.win_length,
+                                  args.rotate_time))
+
+    def progress(games, positions):
+        print("%d games, %d positions, %d distinct" % (games, positions,
+                                                       len(db)),
+              file=sys.stderr)
+
+    start = time.time()
+    games = positions = 0
+    try:
+        for path in args.records:
+            with open(path, 'rb') as f:
+                added = db.ingest(gamerecord.read_games(f), progress)
+            games += added[0]
+            positions += added[1]
+    finally:
+        db.close()
+    elapsed = time.time() - start
+    print("%d games, %d positions in %.1f sec (%.0f positions/sec)" % (
+        games, positions, elapsed, positions / elapsed if elapsed else 0),
+        file=sys.stderr)
+
+
+def main_query(args):
+    db = PositionDB(args.database)
+    state = engine.GameState(engine.BitBoard(db.width, db.height,
+                                             db.win_length), 1,
+                             db.rotate_time, db.rotate_time)
+    for x in args.moves:
+        if x not in state.legal_moves():
+            sys.exit("column %d isn't a legal move" % x)
+        state.push(x)
+    print(state.board.get_string())
+    counts = db.lookup(state)
+    if counts is None:
+        print("no recorded game reached this position")
+        return
+    print("team %d to move: %d won, %d drawn, %d lost" % (
+        (state.active_player,) + tuple(counts)))
+    if state.will_rotate():
+        print("the board rotates after the next move")
+    scores = db.move_scores(state, min_games=1)
+    for x in sorted(scores):
+        score, games = scores[x]
+        print("column %d: %.1f%% in %d games" % (x, score * 100, games))
+
+
+def main_positiondb():
+    parser = argparse.ArgumentParser(
+        description="Build or query a Grav-Twist position database.")
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help="add games to a database")
+    build.add_argument('records', nargs='+', metavar='RECORDS',
+                       help="game record files (see gamerecord.py)")
+    build.add_argument('-o', '--output', required=True,
+                       help="database to create or add to")
+    build.add_argument('--size', type=int, default=engine.BOARD_WIDTH,
+                       help="width and height of the board, for a new "
+                       "database")
+    build.add_argument('--win-length', type=int, default=engine.WIN_LENGTH)
+    build.add_argument('--rotate-time', type=int,
+                       default=engine.ROTATE_TIME)
+    query = commands.add_parser('query', help="show the statistics of a "
+                                "position and of the moves from it")
+    query.add_argument('database')
+    query.add_argument('moves', type=int, nargs='*', metavar='COLUMN',
+                       help="moves from the start of the game")
+    args = parser.parse_args()
+    if args.command == 'build':
+        try:
+            engine.check_rules(args.size, args.win_length, args.rotate_time)
+        except ValueError as e:
+            parser.error(str(e))
+        main_build(args)
+    elif args.command == 'query':
+        main_query(args)
+    else:
+        parser.error("give a command: build or query")
+
+
+if __name__ == '__main__':
+    main_positiondb()
@@ -0,0 +1,178 @@
+"""Frame-time and AI search instrumentation.
+
+The game wraps each part of a frame (input, background, board, overlay,
+flip) in a named span, and the AI worker reports every search it runs.  The
+last few hundred frames and searches are kept, for the on-screen overlay and
+for exporting histograms to CSV or JSON for offline analysis."""
+
+import collections
+import csv
+import json
+import timeit
+
+# frames and searches kept for the statistics
+DEFAULT_WINDOW = 300
+
+# width of the histogram buckets, in milliseconds
+DEFAULT_BUCKET_MS = 1.0
+
+FRAME = 'frame'
+SEARCH = 'ai.search'
+
+timer = timeit.default_timer
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of the values, by the nearest rank, or
+    0.0 if there are none."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+class Span(object):
+
+    """Times the code in a with block and adds it to a span of the frame in
+    progress."""
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, timer() - self.start)
+
+
+class Profiler(object):
+
+    """Rolling frame-time, span and AI search statistics.
+
+    A frame lasts from one end_frame() call to the next, so its time
+    includes waiting for the frame rate limit; spans only count the work
+    done inside them.  record_search() may be called from another thread."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.frames = collections.deque(maxlen=window)
+        # span name -> seconds spent in it, one entry per frame
+        self.spans = collections.OrderedDict()
+        # (kind, seconds, nodes, depth) per search
+        self.searches = collections.deque(maxlen=window)
+        self.current = {}
+        self.last_frame = None
+
+    def span(self, name):
+        return Span(self, name)
+
+    def add(self, name, seconds):
+        """Adds time to a span of the frame in progress."""
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def end_frame(self):
+        """Finishes the frame in progress and starts the next one."""
+        now = timer()
+        if self.last_frame is not None:
+            self.frames.append(now - self.last_frame)
+        self.last_frame = now
+        for name in self.current:
+            if name not in self.spans:
+                self.spans[name] = collections.deque(maxlen=self.window)
+        for name, times in self.spans.items():
+            times.append(self.current.get(name, 0.0))
+        self.current = {}
+
+    def pause(self):
+        """Drops the frame in progress, so the time until the next
+        end_frame() isn't counted as a frame.  For when the game sleeps."""
+        self.last_frame = None
+
+    def record_search(self, kind, seconds, nodes=0, depth=0):
+        """Records an AI search of the given kind ('move' or 'ponder') that
+        visited nodes positions and completed the given depth."""
+        self.searches.append((kind, seconds, nodes, depth))
+
+    def summary(self):
+        """Returns the statistics of the kept frames and searches as a dict.
+        Times are in milliseconds."""
+        frames = list(self.frames)
+        mean = sum(frames) / len(frames) if frames else 0.0
+        spans = {}
+        for name, times in self.spans.items():
+            times = list(times)
+            spans[name] = {
+                'mean_ms': sum(times) / len(times) * 1000.0,
+                'p99_ms': percentile(times, 99) * 1000.0,
+            }
+        slowest = None
+        if spans:
+            slowest = max(spans, key=lambda name: spans[name]['mean_ms'])
+        searches = [s for s in list(self.searches) if s[0] == 'move']
+        search = None
+        if searches:
+            seconds = sum(s[1] for s in searches)
+            nodes = sum(s[2] for s in searches)
+            search = {
+                'count': len(searches),
+                'mean_ms': seconds / len(searches) * 1000.0,
+                'nodes_per_sec': nodes / seconds if seconds else 0.0,
+                'last_depth': searches[-1][3],
+            }
+        return {
+            'frames': len(frames),
+            'fps': 1.0 / mean if mean else 0.0,
+            'frame_p50_ms': percentile(frames, 50) * 1000.0,
+            'frame_p99_ms': percentile(frames, 99) * 1000.0,
+            'spans': spans,
+            'slowest_span': slowest,
+            'search': search,
+        }
+
+    def histograms(self, bucket_ms=DEFAULT_BUCKET_MS):
+        """Returns {series: [(bucket start in ms, count), ...]} for the frame
+        times, every span and the AI's move searches."""
+        series = [(FRAME, list(self.frames))]
+        series.extend((name, list(times))
+                      for name, times in self.spans.items())
+        series.append((SEARCH, [s[1] for s in list(self.searches)
+                                if s[0] == 'move']))
+        result = collections.OrderedDict()
+        for name, times in series:
+            counts = collections.Counter(int(t * 1000.0 / bucket_ms)
+                                         for t in times)
+            result[name] = [(bucket * bucket_ms, counts[bucket])
+                            for bucket in sorted(counts)]
+        return result
+
+    def export_json(self, f, bucket_ms=DEFAULT_BUCKET_MS):
+        json.dump({
+            'bucket_ms': bucket_ms,
+            'summary': self.summary(),
+            'histograms': self.histograms(bucket_ms),
+            'searches': [{'kind': kind, 'ms': seconds * 1000.0,
+                          'nodes': nodes, 'depth': depth}
+                         for kind, seconds, nodes, depth
+                         in list(self.searches)],
+        }, f, indent=2)
+
+    def export_csv(self, f, bucket_ms=DEFAULT_BUCKET_MS):
+        writer = csv.writer(f)
+        writer.writerow(['series', 'bucket_ms', 'count'])
+        for name, buckets in self.histograms(bucket_ms).items():
+            for start, count in buckets:
+                writer.writerow([name, start, count])
+
+    def export(self, path, bucket_ms=DEFAULT_BUCKET_MS):
+        """Writes the histograms to a file, as CSV if its name ends in .csv
+        and as JSON otherwise."""
+        with open(path, 'w') as f:
+            if path.endswith('.csv'):
+                self.export_csv(f, bucket_ms)
+            else:
+                self.export_json(f, bucket_ms)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python2
+"""Renders recorded games to PNG frames, without a window.
+
+    $ python render.py games.rec -o frames --games 0 5 -j 8
+
+Each game is played back through main.Game, so the frames look just like
+the window: the same background, board, falling pieces, rotations and
+victory lines.  Instead of waiting for the frame rate, the animations are
+advanced by exactly one frame's worth of time per frame, so frames are
+written as fast as they can be drawn.
+
+Games are cut into runs of a few moves, and the runs are spread over a
+process pool; a run starts from the recorded position before its first
+move (see gamerecord.Replay), so every run can be drawn independently.
+The frames of game N end up in DIRECTORY/gameNNNNN/frame00000.png and on.
+Rendering uses pygame's dummy video driver."""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+# render without a window, and keep pygame's banner out of the output
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+# SDL would otherwise catch SIGTERM in the pool workers, and the pool could
+# never stop them
+os.environ.setdefault('SDL_NO_SIGNAL_HANDLERS', '1')
+import pygame  # noqa: E402
+
+import gamerecord  # noqa: E402
+import main  # noqa: E402
+
+DEFAULT_FPS = main.MAX_FPS
+
+# moves in each job given to the pool
+DEFAULT_MOVES_PER_JOB = 8
+
+# seconds the piece waits over its column before each move, and that the
+# end of the game is shown for
+HOVER_SECONDS = 0.5
+END_SECONDS = 2.0
+
+# the table under the board is drawn at random; every process has to draw
+# the same one
+TABLE_SEED = 0
+
+FRAME_NAME = 'frame%05d.png'
+
+
+class ReplayGame(main.Game):
+
+    """A Game that plays the moves of a record instead of reading input."""
+
+    def update_column_selected(self):
+        # there's no mouse; play_move() picks the column
+        pass
+
+    def load(self, record, ply):
+        """Sets up the position after the first ply moves of the
+        gamerecord.GameRecord."""
+        state = record.state_at(ply)
+        board = self.board
+        board.state = state.board.copy()
+        board.update_image()
+        self.num_pieces_dropped = ply
+        self.active_player = state.active_player
+        self.moves = record.moves[:ply]
+
+    def play_move(self, column, seconds):
+        """Shows the piece over the column, then drops it.  Yields after
+        every frame."""
+        self.column_selected = column
+        # nothing is animating, so the timeline's clock can start over; the
+        # frames of a move then come out the same wherever the run started
+        self.timeline.time = 0.0
+        for i in range(int(round(HOVER_SECONDS / seconds))):
+            self.render_all(seconds)
+            yield
+        self.drop_piece()
+        while self.timeline.busy():
+            self.render_all(seconds)
+            yield
+
+    def play_end(self, seconds):
+        """Shows the end of the game.  Yields after every frame."""
+        while self.timeline.busy():
+            self.render_all(seconds)
+            yield
+        for i in range(int(round(END_SECONDS / seconds))):
+            self.render_all(seconds)
+            yield
+
+
+def init_display():
+    """Sets up the dummy display main.Game needs to convert its surfaces."""
+    if pygame.display.get_surface() is None:
+        pygame.init()
+        pygame.display.set_mode((main.WINDOW_WIDTH, main.WINDOW_HEIGHT))
+
+
+def render_moves(args):
+    """Renders the frames of some of the moves of a game, and returns the
+    paths of the files written, in order.
+
+    Takes a single (packed game record, first move, end move, directory,
+    frames per second) tuple so it can be mapped over a pool.  Frames are
+    written to the directory under temporary names; the last run of a game
+    also shows the end of the game."""
+    data, first, end, directory, fps = args
+    init_display()
+    record = gamerecord.unpack_game(data)
+    random.seed(TABLE_SEED)
+    screen = pygame.Surface((main.WINDOW_WIDTH, main.WINDOW_HEIGHT))
+    game = ReplayGame(screen, ai=False, size=record.width,
+                      win_length=record.win_length,
+                      rotate_time=record.rotate_time)
+    game.load(record, first)
+    seconds = 1.0 / fps
+    paths = []
+    frames = [game.play_move(column, seconds)
+              for column in record.moves[first:end]]
+    if end == record.num_moves:
+        frames.append(game.play_end(seconds))
+    last = None
+    for frame in frames:
+        for _ in frame:
+            path = os.path.join(directory, 'moves%03d-%05d.png' % (
+                first, len(paths)))
+            # encoding the PNG takes most of the time, and many frames
+            # (the piece waiting over a column, the end of the game) are
+            # the same as the one before
+            pixels = pygame.image.tostring(screen, 'RGB')
+            if pixels == last:
+                shutil.copyfile(paths[-1], path)
+            else:
+                pygame.image.save(screen, path)
+                last = pixels
+            paths.append(path)
+    return paths
+
+
+def make_jobs(records, directory, fps=DEFAULT_FPS,
+              moves_per_job=DEFAULT_MOVES_PER_JOB):
+    """Yields (game directory, render_moves() arguments) for every run of
+    moves of the (index, gamerecord.GameRecord) pairs."""
+    for index, record in records:
+        game_directory = os.path.join(directory, 'game%05d' % index)
+        if not os.path.isdir(game_directory):
+            os.makedirs(game_directory)
+        data = record.pack()
+        first = 0
+        while True:
+            end = min(first + moves_per_job, record.num_moves)
+            yield game_directory, (data, first, end, game_directory, fps)
+            if end == record.num_moves:
+                break
+            first = end
+
+
+def render(records, directory, fps=DEFAULT_FPS, processes=None,
+           moves_per_job=DEFAULT_MOVES_PER_JOB, progress=None):
+    """Renders the frames of the (index, gamerecord.GameRecord) pairs into
+    the directory, and returns the number of frames written.
+
+    progress, if given, is called as progress(frames written, elapsed
+    seconds) after every job."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    jobs = make_jobs(records, directory, fps, moves_per_job)
+    directories = []
+
+    def arguments():
+        for game_directory, args in jobs:
+            directories.append(game_directory)
+            yield args
+
+    start = time.time()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(render_moves, arguments())
+    else:
+        pool = None
+        results = (render_moves(args) for args in arguments())
+    total = 0
+    counts = {}
+    try:
+        # jobs finish in order, so the frames of a game can be numbered as
+        # they come in
+        for number, paths in enumerate(results):
+            game_directory = directories[number]
+            count = counts.get(game_directory, 0)
+            for path in paths:
+                os.rename(path, os.path.join(game_directory,
+                                             FRAME_NAME % count))
+                count += 1
+            counts[game_directory] = count
+            total += len(paths)
+            if progress:
+                progress(total, time.time() - start)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return total
+
+
+def main_render():
+    parser = argparse.ArgumentParser(
+        description="Render recorded Grav-Twist games to PNG frames.")
+    parser.add_argument('records', help="game record file (see "
+                        "gamerecord.py)")
+    parser.add_argument('-o', '--output', required=True,
+                        help="directory to write the frames to")
+    parser.add_argument('--games', type=int, nargs='+', default=None,
+                        metavar='N', help="games to render, counting from 0 "
+                        "(default: all of them)")
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS,
+                        help="frames per second of the animations")
+    parser.add_argument('--moves-per-job', type=int,
+                        default=DEFAULT_MOVES_PER_JOB,
+                        help="moves rendered by each job in the pool")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    args = parser.parse_args()
+    if args.fps < 1 or args.moves_per_job < 1:
+        parser.error("--fps and --moves-per-job must be at least 1")
+    wanted = set(args.games) if args.games is not None else None
+
+    def progress(frames, elapsed):
+        print("%d frames, %.1f frames/sec" % (frames, frames / elapsed),
+              file=sys.stderr)
+
+    with open(args.records, 'rb') as f:
+        records = ((index, record)
+                   for index, record in enumerate(gamerecord.read_games(f))
+                   if wanted is None or index in wanted)
+        start = time.time()
+        frames = render(records, args.output, args.fps, args.processes,
+                        args.moves_per_job, progress)
+    elapsed = time.time() - start
+    print("%d frames in %.1f sec (%.1f frames/sec)" % (
+        frames, elapsed, frames / elapsed if elapsed else 0),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main_render()
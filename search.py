@@ -0,0 +1,271 @@
+"""Alpha-beta search AI for Grav-Twist Connect 4.
+
+The search walks the game tree on a single engine.GameState with push() and
+pop(), so rotations and the gravity that follows them happen at exactly the
+plies where the real game applies them."""
+
+import random
+import time
+
+import engine
+import transposition
+from transposition import EXACT, LOWER, UPPER
+
+WIN_SCORE = 1000000
+INFINITY = WIN_SCORE + 1
+# scores this close to WIN_SCORE are wins a number of plies away
+WIN_THRESHOLD = WIN_SCORE - 1000
+
+# score for every empty cell that would complete a line
+THREAT_WEIGHT = 16
+# score for every piece in the middle column
+CENTER_WEIGHT = 3
+
+DEFAULT_BUDGET_MS = 200
+MAX_DEPTH = 42
+
+# how many nodes to search between looking at the clock
+NODES_PER_TIME_CHECK = 256
+
+# Mirror images only play out the same way until the next rotation (the
+# board always turns the same way), so nodes whose remaining depth ends
+# before it are stored under the mirror-folded key, marked with this value
+# to keep them apart from entries that are only valid for one orientation.
+FOLDED_KEY = 0x5bd1e9955bd1e995
+
+
+class SearchTimeout(Exception):
+
+    """Raised inside the search when the time budget runs out."""
+
+
+def center_first(width):
+    """Returns the columns of a board ordered from the middle outwards."""
+    middle = (width - 1) / 2.0
+    return sorted(range(width), key=lambda x: abs(x - middle))
+
+
+def evaluate(state):
+    """Scores the position from the point of view of the player to move."""
+    board = state.board
+    g = board.geometry
+    me = state.active_player
+    mine = board.bits[me]
+    theirs = board.bits[3 - me]
+    empty = board.empty()
+    score = THREAT_WEIGHT * (
+        engine.popcount(g.winning_cells(mine, empty, g)) -
+        engine.popcount(g.winning_cells(theirs, empty, g)))
+    # the middle column, or the middle two on even-width boards
+    center = (g.column_mask << (board.width // 2 * g.column_bits) |
+              g.column_mask << ((board.width - 1) // 2 * g.column_bits))
+    score += CENTER_WEIGHT * (
+        engine.popcount(mine & center) - engine.popcount(theirs & center))
+    return score
+
+
+def score_to_table(score, ply):
+    """Makes win scores relative to the node being stored rather than to the
+    root, so a table entry stays valid wherever the position is reached."""
+    if score > WIN_THRESHOLD:
+        return score + ply
+    if score < -WIN_THRESHOLD:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score > WIN_THRESHOLD:
+        return score - ply
+    if score < -WIN_THRESHOLD:
+        return score + ply
+    return score
+
+
+class SearchAI(object):
+
+    """Negamax search with alpha-beta pruning and iterative deepening.
+
+    Each move gets a fixed time budget; when it runs out the best move of
+    the deepest completed iteration is played.  Results are kept in a
+    transposition table, which persists from one move to the next."""
+
+    def __init__(self, team, budget_ms=DEFAULT_BUDGET_MS,
+                 max_depth=MAX_DEPTH, table=None, book=None):
+        self.team = team
+        self.budget_ms = budget_ms
+        self.max_depth = max_depth
+        if table is None:
+            table = transposition.TranspositionTable()
+        self.table = table
+        # a book.OpeningBook to play the first moves from, or None
+        self.book = book
+        self.deadline = None
+        # set by stop(), and left set until the caller clears it
+        self.stopped = False
+        self.order = None
+        # statistics about the last call to get_move
+        self.nodes = 0
+        self.depth_reached = 0
+        self.score = 0
+
+    def get_move(self, board, turns_til_rotation, budget_ms=None,
+                 rotate_time=engine.ROTATE_TIME):
+        """Returns the column # to drop the piece in, in a game where the
+        board rotates every rotate_time moves."""
+        state = engine.GameState(board.state.copy(), self.team,
+                                 turns_til_rotation, rotate_time)
+        return self.search(state, budget_ms)
+
+    def search(self, state, budget_ms=None):
+        """Searches the given position and returns the best column for the
+        player to move."""
+        self.nodes = 0
+        self.depth_reached = 0
+        self.score = 0
+        if self.book is not None:
+            move = self.book.lookup(state)
+            if move is not None:
+                return move
+        if budget_ms is None:
+            budget_ms = self.budget_ms
+        self.deadline = time.time() + budget_ms / 1000.0
+        self.order = center_first(state.board.width)
+        self.table.new_generation()
+        # a timeout abandons the search halfway down the tree, so search a
+        # copy rather than leave pushed moves on the caller's state
+        state = state.clone()
+
+        moves = [x for x in self.order if x in state.legal_moves()]
+        if not moves:
+            return random.randint(0, state.board.width - 1)
+        best_move = moves[0]
+        if len(moves) == 1:
+            return best_move
+
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self.search_root(state, depth, best_move)
+            except SearchTimeout:
+                break
+            best_move = move
+            self.score = score
+            self.depth_reached = depth
+            if abs(score) >= WIN_SCORE - self.max_depth:
+                # forced win or loss found; searching deeper won't change it
+                break
+        return best_move
+
+    def stop(self):
+        """Makes a search running in another thread return soon, with the
+        best move of the deepest iteration it completed.  A search that
+        hasn't started yet returns just as soon, until stopped is set back
+        to False."""
+        self.stopped = True
+        self.deadline = 0
+
+    def search_root(self, state, depth, first):
+        """Runs one iteration of the search, trying the best move of the
+        previous iteration first."""
+        moves = self.ordered_moves(state, first)
+        alpha = -INFINITY
+        best_move = moves[0]
+        for x in moves:
+            score = self.search_move(state, x, depth, -INFINITY, -alpha, 0)
+            if score > alpha:
+                alpha = score
+                best_move = x
+        return alpha, best_move
+
+    def ordered_moves(self, state, first=None):
+        heights = state.board.heights
+        height = state.board.height
+        moves = [x for x in self.order if heights[x] < height]
+        if first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def search_move(self, state, x, depth, alpha, beta, ply):
+        """Plays column x and returns its score for the player who made it.
+        alpha and beta are given from the opponent's point of view."""
+        team = state.active_player
+        state.push(x)
+        winner = state.winner()
+        if winner is not None:
+            if winner == engine.DRAW:
+                score = 0
+            elif winner == team:
+                score = WIN_SCORE - ply
+            else:
+                score = -(WIN_SCORE - ply)
+        else:
+            score = -self.negamax(state, depth - 1, alpha, beta, ply + 1)
+        state.pop()
+        return score
+
+    def negamax(self, state, depth, alpha, beta, ply):
+        """Returns the score of the position for the player to move."""
+        self.nodes += 1
+        if not self.nodes % NODES_PER_TIME_CHECK and \
+                (self.stopped or time.time() > self.deadline):
+            raise SearchTimeout()
+
+        if depth == 0:
+            return evaluate(state)
+
+        folded = depth < state.turns_til_rotation
+        if folded:
+            key = state.key(fold_mirror=True) ^ FOLDED_KEY
+            mirrored = state.is_mirrored()
+        else:
+            key = state.hash
+            mirrored = False
+        last_column = state.board.width - 1
+
+        table_move = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            entry_depth, bound, score, table_move = entry
+            if mirrored and table_move is not None:
+                table_move = last_column - table_move
+            if entry_depth >= depth:
+                score = score_from_table(score, ply)
+                if bound == EXACT:
+                    return score
+                if bound == LOWER and score > alpha:
+                    alpha = score
+                elif bound == UPPER and score < beta:
+                    beta = score
+                if alpha >= beta:
+                    return score
+
+        moves = self.ordered_moves(state, table_move)
+        if not moves:
+            # the board is full
+            return 0
+
+        original_alpha = alpha
+        best = -INFINITY
+        best_move = None
+        for x in moves:
+            score = self.search_move(state, x, depth, -beta, -alpha, ply)
+            if score > best:
+                best = score
+                best_move = x
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best <= original_alpha:
+            bound = UPPER
+        elif best >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        if mirrored:
+            best_move = last_column - best_move
+        self.table.store(key, depth, bound, score_to_table(best, ply),
+                         best_move)
+        return best
@@ -0,0 +1,243 @@
+#!/usr/bin/env python2
+"""Headless self-play: plays games between AI strategies without a display
+and writes one record per game.
+
+    $ python selfplay.py -n 1000 --players basic alphabeta -o games.jsonl
+
+Games are spread over a process pool and records are written in game order
+as they finish, as JSON lines, in a binary format with per-move timing (see
+write_binary_record), or as gamerecord.py records, a few bits per move."""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import random
+import struct
+import sys
+import time
+
+import core
+import engine
+import gamerecord
+import mcts
+import search
+
+DEFAULT_BUDGET_MS = 20
+
+# binary record: game number, seed, winner, rotate time, team 1 and team 2
+# strategy codes (indices into PLAYER_CODES), number of moves; followed by
+# one byte per move and one float32 of milliseconds per move
+BINARY_HEADER = struct.Struct('<IIBBBBH')
+
+PLAYER_CODES = gamerecord.PLAYER_CODES
+
+
+def make_ai(name, team, budget_ms, seed):
+    """Creates an AI from core.AI_STRATEGIES, set up to run inside a pool
+    worker."""
+    if name == 'mcts':
+        # pool workers can't start pools of their own
+        return mcts.MCTSAI(team, budget_ms, processes=1, seed=seed)
+    if name == 'alphabeta':
+        return search.SearchAI(team, budget_ms)
+    return core.AI_STRATEGIES[name](team)
+
+
+def play_game(args):
+    """Plays one game and returns its record as a dict.
+
+    Takes a single (game number, seed, player names, budget_ms, (board
+    size, win length, rotate time)) tuple so it can be mapped over a
+    pool."""
+    number, seed, players, budget_ms, (size, win_length, rotate_time) = args
+    # the basic AI uses the module-level random generator
+    random.seed(seed)
+    ais = [None] + [make_ai(name, team, budget_ms, seed + team)
+                    for team, name in zip((1, 2), players)]
+
+    match = engine.Match(size, size, win_length, rotate_time)
+    rotations = []
+    times_ms = []
+    while match.winner is None:
+        ai = ais[match.active_player()]
+        start = time.time()
+        move = ai.search(match.state.clone(), budget_ms)
+        times_ms.append(round((time.time() - start) * 1000.0, 3))
+        if match.play(move):
+            rotations.append(len(match.moves))
+
+    return {
+        'game': number,
+        'seed': seed,
+        'players': list(players),
+        'size': size,
+        'win_length': win_length,
+        'rotate_time': rotate_time,
+        'moves': match.moves,
+        'rotations': rotations,
+        'winner': match.winner,
+        'points': match.points[1:],
+        'times_ms': times_ms,
+    }
+
+
+def write_jsonl_record(f, record):
+    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def write_binary_record(f, record):
+    if (record['size'], record['win_length']) != (engine.BOARD_WIDTH,
+                                                  engine.WIN_LENGTH):
+        raise ValueError("binary records only hold games on the standard "
+                         "board")
+    f.write(BINARY_HEADER.pack(
+        record['game'], record['seed'] & 0xffffffff, record['winner'],
+        record['rotate_time'], PLAYER_CODES.index(record['players'][0]),
+        PLAYER_CODES.index(record['players'][1]), len(record['moves'])))
+    num_moves = len(record['moves'])
+    f.write(struct.pack('<%dB' % num_moves, *record['moves']))
+    f.write(struct.pack('<%df' % num_moves, *record['times_ms']))
+
+
+def read_binary_records(f):
+    """Yields the records of a binary self-play file, one at a time.
+
+    Points aren't stored, and rotations follow from the rotate time."""
+    while True:
+        header = f.read(BINARY_HEADER.size)
+        if len(header) < BINARY_HEADER.size:
+            return
+        (number, seed, winner, rotate_time, player1, player2,
+         num_moves) = BINARY_HEADER.unpack(header)
+        moves = struct.unpack('<%dB' % num_moves, f.read(num_moves))
+        times = struct.unpack('<%df' % num_moves, f.read(4 * num_moves))
+        yield {
+            'game': number,
+            'seed': seed,
+            'players': [PLAYER_CODES[player1], PLAYER_CODES[player2]],
+            'size': engine.BOARD_WIDTH,
+            'win_length': engine.WIN_LENGTH,
+            'rotate_time': rotate_time,
+            'moves': list(moves),
+            'rotations': list(range(rotate_time, num_moves + 1,
+                                    rotate_time)),
+            'winner': winner,
+            'times_ms': list(times),
+        }
+
+
+def write_compact_record(f, record):
+    """Writes the game as a gamerecord.py record, without the timing."""
+    gamerecord.write_game(
+        f, record['moves'], (record['size'], record['size'],
+                             record['win_length'], record['rotate_time']),
+        record['winner'], [PLAYER_CODES.index(name)
+                           for name in record['players']], record['game'])
+
+
+WRITERS = {
+    'jsonl': write_jsonl_record,
+    'binary': write_binary_record,
+    'compact': write_compact_record,
+}
+
+
+def run(num_games, players, output, output_format='jsonl',
+        budget_ms=DEFAULT_BUDGET_MS, processes=None, seed=0,
+        alternate=False, progress=None, size=engine.BOARD_WIDTH,
+        win_length=engine.WIN_LENGTH, rotate_time=engine.ROTATE_TIME):
+    """Plays num_games games and writes their records to the output file.
+
+    With alternate, the strategies swap sides every other game.  Games are
+    played on a size by size board, with win_length pieces in a row to win
+    and a rotation every rotate_time moves.  progress, if given, is called
+    as progress(games finished, elapsed seconds).  Returns the number of
+    games per second."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    write = WRITERS[output_format]
+    jobs = []
+    for number in range(num_games):
+        game_players = players
+        if alternate and number % 2:
+            game_players = players[::-1]
+        jobs.append((number, seed + number * 2, game_players, budget_ms,
+                     (size, win_length, rotate_time)))
+
+    start = time.time()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        records = pool.imap(play_game, jobs, chunksize=4)
+    else:
+        pool = None
+        records = (play_game(job) for job in jobs)
+    try:
+        for finished, record in enumerate(records, 1):
+            write(output, record)
+            if progress:
+                progress(finished, time.time() - start)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.time() - start
+    return num_games / elapsed if elapsed else float('inf')
+
+
+def main_selfplay():
+    parser = argparse.ArgumentParser(
+        description="Play Grav-Twist games between AIs without a display.")
+    parser.add_argument('-n', '--games', type=int, default=100)
+    parser.add_argument('--players', nargs=2, default=['basic', 'basic'],
+                        choices=PLAYER_CODES, metavar='STRATEGY',
+                        help="strategies for team 1 and team 2 (%s)" %
+                        ', '.join(PLAYER_CODES))
+    parser.add_argument('--alternate', action='store_true',
+                        help="swap sides every other game")
+    parser.add_argument('--budget-ms', type=int, default=DEFAULT_BUDGET_MS,
+                        help="time budget per move for searching AIs")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=engine.BOARD_WIDTH,
+                        help="width and height of the board (at most %d)" %
+                        engine.MAX_BOARD_SIZE)
+    parser.add_argument('--win-length', type=int, default=engine.WIN_LENGTH,
+                        help="pieces in a row needed to win")
+    parser.add_argument('--rotate-time', type=int, default=engine.ROTATE_TIME,
+                        help="moves between board rotations")
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file, or - for stdout")
+    args = parser.parse_args()
+    try:
+        engine.check_rules(args.size, args.win_length, args.rotate_time)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format == 'binary' and (args.size, args.win_length) != (
+            engine.BOARD_WIDTH, engine.WIN_LENGTH):
+        parser.error("binary records only hold games on the standard board")
+
+    if args.output == '-':
+        output = sys.stdout
+        if args.format != 'jsonl':
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+    else:
+        output = open(args.output, 'w' if args.format == 'jsonl' else 'wb')
+
+    def progress(finished, elapsed):
+        if finished % 100 == 0 or finished == args.games:
+            print("%d games, %.1f games/sec" % (finished, finished / elapsed),
+                  file=sys.stderr)
+
+    try:
+        rate = run(args.games, args.players, output, args.format,
+                   args.budget_ms, args.processes, args.seed, args.alternate,
+                   progress, args.size, args.win_length, args.rotate_time)
+    finally:
+        if args.output != '-':
+            output.close()
+    print("%.1f games/sec" % rate, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main_selfplay()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Hosts many Grav-Twist games at once over TCP, without a display.
+
+    $ python3 server.py --port 7477
+
+Clients speak a compact binary protocol.  Every message is one type byte
+followed by a fixed-size payload for that type (see PAYLOADS), so messages
+need no length prefix.  A client joins a game against another client or
+against an AI, and the server tells both players about every move, rotation
+and the result.  Each game is a small state machine around an engine.Match;
+AI moves are searched in a process pool so the event loop never waits on
+them.
+
+The server needs Python 3 for asyncio, like batch.py needs NumPy; the rest
+of the game does not."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import struct
+
+import engine
+import mcts
+import selfplay
+
+DEFAULT_PORT = 7477
+DEFAULT_BUDGET_MS = 100
+
+# client messages
+JOIN = 0x01  # opponent: HUMAN, or 1 + an index into selfplay.PLAYER_CODES
+MOVE = 0x02  # column
+# server messages
+JOINED = 0x81  # game id, your team
+START = 0x82
+MOVED = 0x83  # team, column
+ROTATED = 0x84
+RESULT = 0x85  # winner (engine.DRAW for a draw), points of team 1 and 2
+ERROR = 0x86  # error code
+
+PAYLOADS = {
+    JOIN: struct.Struct('<B'),
+    MOVE: struct.Struct('<B'),
+    JOINED: struct.Struct('<IB'),
+    START: struct.Struct(''),
+    MOVED: struct.Struct('<BB'),
+    ROTATED: struct.Struct(''),
+    RESULT: struct.Struct('<BBB'),
+    ERROR: struct.Struct('<B'),
+}
+
+HUMAN = 0
+
+# error codes
+NOT_PLAYING = 1
+NOT_YOUR_TURN = 2
+ILLEGAL_MOVE = 3
+BAD_OPPONENT = 4
+ALREADY_PLAYING = 5
+
+# game states
+WAITING = 'waiting'
+PLAYING = 'playing'
+FINISHED = 'finished'
+
+
+class ProtocolError(Exception):
+
+    """Raised for a message of an unknown type."""
+
+
+def encode(kind, *fields):
+    return bytes((kind,)) + PAYLOADS[kind].pack(*fields)
+
+
+async def read_message(reader):
+    """Reads one message and returns (type, payload fields)."""
+    kind = (await reader.readexactly(1))[0]
+    payload = PAYLOADS.get(kind)
+    if payload is None:
+        raise ProtocolError("unknown message type %#x" % kind)
+    if not payload.size:
+        return kind, ()
+    return kind, payload.unpack(await reader.readexactly(payload.size))
+
+
+_ais = {}
+
+
+def search_move(args):
+    """Returns an AI's move.  Runs in a pool process, and takes a single
+    (strategy name, budget_ms, mcts.state_to_args tuple) tuple."""
+    name, budget_ms, state_args = args
+    state = mcts.state_from_args(state_args)
+    key = (name, state.active_player, budget_ms)
+    ai = _ais.get(key)
+    if ai is None:
+        ai = _ais[key] = selfplay.make_ai(name, state.active_player,
+                                          budget_ms, None)
+    return ai.search(state, budget_ms)
+
+
+class Player(object):
+
+    """A connected client, and the game it is in."""
+
+    __slots__ = ('writer', 'game', 'team')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.game = None
+        self.team = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Session(object):
+
+    """One game on the server: WAITING for a second player, PLAYING, then
+    FINISHED.  players[team] is the Player on that team, or None for the
+    AI's team."""
+
+    def __init__(self, number, rules, ai=None):
+        self.number = number
+        self.match = engine.Match(*rules)
+        self.ai = ai
+        self.players = [None, None, None]
+        self.status = WAITING
+
+    def broadcast(self, data):
+        for player in self.players[1:]:
+            if player is not None:
+                player.send(data)
+
+
+class Server(object):
+
+    """Matches players up and runs their games."""
+
+    def __init__(self, budget_ms=DEFAULT_BUDGET_MS, processes=None,
+                 rules=(engine.BOARD_WIDTH, engine.BOARD_HEIGHT,
+                        engine.WIN_LENGTH, engine.ROTATE_TIME)):
+        self.budget_ms = budget_ms
+        self.rules = rules
+        # processes=0 searches in a thread instead, for tests
+        self.processes = processes
+        self.executor = None
+        self.numbers = itertools.count(1)
+        self.games = {}
+        # the game a human is waiting in for an opponent, if any
+        self.waiting = None
+        self.moves = 0
+        self.tasks = set()
+
+    def get_executor(self):
+        if self.executor is None and self.processes != 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.processes)
+        return self.executor
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def handle(self, reader, writer):
+        player = Player(writer)
+        try:
+            while True:
+                kind, fields = await read_message(reader)
+                if kind == JOIN:
+                    self.join(player, fields[0])
+                elif kind == MOVE:
+                    self.move(player, fields[0])
+                else:
+                    raise ProtocolError("unexpected message %#x" % kind)
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.leave(player)
+            writer.close()
+
+    def join(self, player, opponent):
+        if player.game is not None and player.game.status != FINISHED:
+            player.send(encode(ERROR, ALREADY_PLAYING))
+            return
+        if opponent == HUMAN:
+            game = self.waiting
+            if game is None:
+                game = self.waiting = self.new_game()
+                self.seat(player, game, 1)
+                return
+            self.waiting = None
+            self.seat(player, game, 2)
+        else:
+            if opponent - 1 >= len(selfplay.PLAYER_CODES):
+                player.send(encode(ERROR, BAD_OPPONENT))
+                return
+            game = self.new_game(selfplay.PLAYER_CODES[opponent - 1])
+            self.seat(player, game, 1)
+        game.status = PLAYING
+        game.broadcast(encode(START))
+
+    def new_game(self, ai=None):
+        game = Session(next(self.numbers), self.rules, ai)
+        self.games[game.number] = game
+        return game
+
+    def seat(self, player, game, team):
+        player.game = game
+        player.team = team
+        game.players[team] = player
+        player.send(encode(JOINED, game.number, team))
+
+    def move(self, player, column):
+        game = player.game
+        if game is None or game.status != PLAYING:
+            player.send(encode(ERROR, NOT_PLAYING))
+        elif game.match.active_player() != player.team:
+            player.send(encode(ERROR, NOT_YOUR_TURN))
+        else:
+            self.play(game, column, player)
+
+    def play(self, game, column, player=None):
+        """Plays the active team's move in the game and tells both players
+        what happened."""
+        match = game.match
+        team = match.active_player()
+        try:
+            rotated = match.play(column)
+        except ValueError:
+            if player is not None:
+                player.send(encode(ERROR, ILLEGAL_MOVE))
+            return
+        self.moves += 1
+        message = encode(MOVED, team, column)
+        if rotated:
+            message += encode(ROTATED)
+        if match.winner is not None:
+            message += encode(RESULT, match.winner, match.points[1],
+                              match.points[2])
+        game.broadcast(message)
+        if match.winner is not None:
+            self.finish(game)
+        elif game.ai is not None and \
+                game.players[match.active_player()] is None:
+            self.spawn(self.ai_turn(game))
+
+    def spawn(self, coroutine):
+        # the event loop only keeps weak references to tasks
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def ai_turn(self, game):
+        args = (game.ai, self.budget_ms,
+                mcts.state_to_args(game.match.state))
+        loop = asyncio.get_running_loop()
+        column = await loop.run_in_executor(self.get_executor(),
+                                            search_move, args)
+        if game.status == PLAYING:
+            self.play(game, column)
+
+    def finish(self, game):
+        game.status = FINISHED
+        self.games.pop(game.number, None)
+        if self.waiting is game:
+            self.waiting = None
+
+    def leave(self, player):
+        """Forfeits the game of a player who disconnected."""
+        game = player.game
+        if game is None or game.status == FINISHED:
+            return
+        game.players[player.team] = None
+        if game.status == PLAYING:
+            match = game.match
+            match.winner = 3 - player.team
+            game.broadcast(encode(RESULT, match.winner, match.points[1],
+                                  match.points[2]))
+        self.finish(game)
+
+
+def main_server():
+    parser = argparse.ArgumentParser(
+        description="Host Grav-Twist games over TCP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--budget-ms', type=int, default=DEFAULT_BUDGET_MS,
+                        help="time budget per move for searching AIs")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="processes searching AI moves")
+    parser.add_argument('--size', type=int, default=engine.BOARD_WIDTH,
+                        help="width and height of the board (at most %d)" %
+                        engine.MAX_BOARD_SIZE)
+    parser.add_argument('--win-length', type=int, default=engine.WIN_LENGTH,
+                        help="pieces in a row needed to win")
+    parser.add_argument('--rotate-time', type=int, default=engine.ROTATE_TIME,
+                        help="moves between board rotations")
+    args = parser.parse_args()
+    try:
+        engine.check_rules(args.size, args.win_length, args.rotate_time)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = Server(args.budget_ms, args.processes,
+                    (args.size, args.size, args.win_length, args.rotate_time))
+
+    async def serve():
+        tcp_server = await server.start(args.host, args.port)
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main_server()
@@ -1,13 +1,45 @@
 """For testing"""
 import main
+import aiworker
+import benchmark
+import book
+import engine
+import gamerecord
+import mcts
+import positiondb
+import profiler
+import render
+import search
+import selfplay
+import transposition
 import pygame
-pygame.init()
-pygame.display.set_mode((100, 100))
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+try:
+    import numpy
+    import batch
+except ImportError:
+    numpy = None
+
+
+def init_display():
+    """Sets up the screen that pygame needs before surfaces can be
+    converted.  Only the tests that draw call this."""
+    if pygame.display.get_surface() is None:
+        pygame.init()
+        pygame.display.set_mode((100, 100))
 
 
 def create_board_from_text(text):
-    board = main.Board(7, 7)
+    board = engine.Board(7, 7)
     for y, line in enumerate(text.split("\n")):
         line = line.strip()
         for x, char in enumerate(line):
@@ -15,88 +47,105 @@ def create_board_from_text(text):
     return board
 
 
+ROTATE_FIXTURES = {
+    board.replace(' ', '') : rotated.replace(' ', '')
+    for board, rotated in [
+        ("""0000000
+            0000000
+            0000000
+            0000000
+            0000000
+            0000000
+            1111111""",
+         """0000001
+            0000001
+            0000001
+            0000001
+            0000001
+            0000001
+            0000001"""),
+
+        ("""0000000
+            0000000
+            0000001
+            0000002
+            0000001
+            0010101
+            1111111""",
+         """0012111
+            0000001
+            0000011
+            0000001
+            0000011
+            0000001
+            0000001"""),
+    ]}
+
+FALL_FIXTURES = {
+    board.replace(' ', '') : result.replace(' ', '')
+    for board, result in [
+        ("""2020202
+            0202020
+            2020202
+            0202020
+            2020202
+            0202020
+            1111111""",
+         """0000000
+            0000000
+            0000000
+            2222222
+            2222222
+            2222222
+            1111111"""),
+
+        ("""1221122
+            2112211
+            0000001
+            0000002
+            0000001
+            0010101
+            1111111""",
+         """0000002
+            0000001
+            0000001
+            0020102
+            1211221
+            2112111
+            1111111"""),
+    ]}
+
+
+def random_game(seed, rules=(7, 7, 4, 3)):
+    """Returns the moves of a game of random moves, and the states after
+    each of them."""
+    rng = random.Random(seed)
+    width, height, win_length, rotate_time = rules
+    state = engine.GameState(engine.BitBoard(width, height, win_length), 1,
+                             rotate_time, rotate_time)
+    moves = []
+    states = [state.clone()]
+    while state.legal_moves() and not state.winners():
+        moves.append(rng.choice(state.legal_moves()))
+        state.push(moves[-1])
+        states.append(state.clone())
+    return moves, states
+
+
 class TestBoard(unittest.TestCase):
 
     def test_board_rotate(self):
-        sample_boards_rotated = {
-            board.replace(' ', '') : rotated.replace(' ', '')
-            for board, rotated in [
-                ("""0000000
-                    0000000
-                    0000000
-                    0000000
-                    0000000
-                    0000000
-                    1111111""",
-                 """0000001
-                    0000001
-                    0000001
-                    0000001
-                    0000001
-                    0000001
-                    0000001"""),
-
-                ("""0000000
-                    0000000
-                    0000001
-                    0000002
-                    0000001
-                    0010101
-                    1111111""",
-                 """0012111
-                    0000001
-                    0000011
-                    0000001
-                    0000011
-                    0000001
-                    0000001"""),
-            ]}
-
-        for text_board in sample_boards_rotated:
+        for text_board in ROTATE_FIXTURES:
             board = create_board_from_text(text_board)
             board.rotate()
             self.assertEqual(board.get_string(),
-                             sample_boards_rotated[text_board])
+                             ROTATE_FIXTURES[text_board])
 
     def test_make_pieces_fall(self):
-
-        test_boards = {
-            board.replace(' ', '') : result.replace(' ', '')
-            for board, result in [
-                ("""2020202
-                    0202020
-                    2020202
-                    0202020
-                    2020202
-                    0202020
-                    1111111""",
-                 """0000000
-                    0000000
-                    0000000
-                    2222222
-                    2222222
-                    2222222
-                    1111111"""),
-
-                ("""1221122
-                    2112211
-                    0000001
-                    0000002
-                    0000001
-                    0010101
-                    1111111""",
-                 """0000002
-                    0000001
-                    0000001
-                    0020102
-                    1211221
-                    2112111
-                    1111111"""),
-            ]}
-        for text_board in test_boards:
+        for text_board in FALL_FIXTURES:
             board = create_board_from_text(text_board)
             board.make_pieces_fall()
-            self.assertEqual(board.get_string(), test_boards[text_board])
+            self.assertEqual(board.get_string(), FALL_FIXTURES[text_board])
 
     def test_lowest_in_column(self):
         test_boards = {
@@ -115,3 +164,1234 @@ class TestBoard(unittest.TestCase):
             board = create_board_from_text(text_board)
             for col, lowest in enumerate(test_boards[text_board]):
                 self.assertEqual(board.lowest_in_column(col), lowest)
+
+    def test_check_victory(self):
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          2000100
+                                          2001000
+                                          2010000
+                                          2111120""")
+        self.assertEqual(board.check_victory(), [
+            (2, [(0, 3), (0, 4), (0, 5), (0, 6)]),
+            (1, [(1, 6), (2, 6), (3, 6), (4, 6)]),
+            (1, [(4, 3), (3, 4), (2, 5), (1, 6)]),
+        ])
+
+    def test_update_image(self):
+        init_display()
+        board = main.Board(7, 7)
+        board.update_image()
+        for column in (3, 3, 4, 2):
+            board.drop_piece(column, 1 + column % 2)
+            board.update_image()
+        board.rotate()
+        board.make_pieces_fall()
+        board.update_image()
+        # only the changed cells were redrawn, but the image should look
+        # the same as one drawn from scratch
+        fresh = main.Board(7, 7)
+        for x in range(7):
+            for y in range(7):
+                fresh.grid[x][y] = board.grid[x][y]
+        fresh.update_image()
+        self.assertEqual(pygame.image.tostring(board.image, 'RGB'),
+                         pygame.image.tostring(fresh.image, 'RGB'))
+        self.assertEqual(len(board.sprites), 3)
+
+
+class TestBitBoard(unittest.TestCase):
+
+    def test_drop(self):
+        board = engine.BitBoard()
+        self.assertEqual(board.drop(3, 1), 6)
+        self.assertEqual(board.drop(3, 2), 5)
+        self.assertEqual(board.lowest_in_column(3), 4)
+        self.assertEqual(board.cell(3, 6), 1)
+        self.assertEqual(board.cell(3, 5), 2)
+        for i in range(5):
+            board.drop(3, 1)
+        self.assertEqual(board.lowest_in_column(3), -1)
+        self.assertTrue(board.column_blocked(3))
+
+    def test_rotate_and_fall(self):
+        for text in list(ROTATE_FIXTURES) + list(FALL_FIXTURES):
+            board = create_board_from_text(text).state
+            expected = board.copy()
+            expected.rotate()
+            expected.make_pieces_fall()
+            board.rotate_and_fall()
+            self.assertEqual(board.get_string(), expected.get_string())
+            self.assertEqual(board.heights, expected.heights)
+
+    def test_fall_tables(self):
+        g = engine.get_geometry(7, 7)
+        # column 0b0101101 with team 1 at rows 0 and 5: the pieces at rows
+        # 2, 3 and 5 fall to rows 1, 2 and 3
+        key = 0b0101101 << 7 | 0b0100001
+        self.assertEqual(g.fall_team1[key], 0b1001)
+        self.assertEqual(g.fall_moves[key], ((2, 1), (3, 2), (5, 3)))
+
+    def test_winners(self):
+        board = engine.BitBoard()
+        for x in range(3):
+            board.drop(x, 2)
+        self.assertEqual(board.winners(), [])
+        board.drop(3, 2)
+        self.assertEqual(board.winners(), [2])
+
+
+class TestWinLength(unittest.TestCase):
+
+    def test_rules_limits(self):
+        engine.check_rules(engine.MAX_BOARD_SIZE, 2, engine.MAX_ROTATE_TIME)
+        for rules in ((engine.MAX_BOARD_SIZE + 1, 4, 3), (1, 1, 3),
+                      (5, 6, 3), (7, 4, 0),
+                      (7, 4, engine.MAX_ROTATE_TIME + 1)):
+            with self.assertRaises(ValueError):
+                engine.check_rules(*rules)
+        with self.assertRaises(ValueError):
+            engine.BitBoard(7, engine.MAX_BOARD_SIZE + 1)
+
+    def test_get_move_rotate_time(self):
+        board = engine.Board(7, 7)
+        for ai in (main.AI(1), search.SearchAI(1), mcts.MCTSAI(1)):
+            ai.search = lambda state, budget_ms=None: (
+                state.turns_til_rotation, state.rotate_time)
+            self.assertEqual(ai.get_move(board, 2, rotate_time=5), (2, 5))
+
+    def random_board(self, rng, size, win_length, pieces):
+        board = engine.BitBoard(size, size, win_length)
+        for i in range(pieces):
+            x = rng.randrange(size)
+            if board.heights[x] < size:
+                board.drop(x, rng.choice((1, 2)))
+        return board
+
+    def brute_force_lines(self, board):
+        g = board.geometry
+        lines = []
+        for cells in g.window_cells:
+            teams = set(board.cell(x, y) for (x, y) in cells)
+            if len(teams) == 1 and 0 not in teams:
+                lines.append((teams.pop(), cells))
+        return lines
+
+    def test_geometry_cache(self):
+        self.assertIs(engine.get_geometry(7, 7), engine.get_geometry(7, 7, 4))
+        g = engine.get_geometry(7, 7, 5)
+        self.assertIsNot(g, engine.get_geometry(7, 7))
+        self.assertIs(g, engine.get_geometry(7, 7, 5))
+        self.assertEqual(len(g.window_cells[0]), 5)
+
+    def test_lines(self):
+        rng = random.Random(11)
+        for size, win_length in ((5, 3), (6, 4), (7, 5), (9, 5), (9, 6)):
+            for n in range(30):
+                board = self.random_board(rng, size, win_length,
+                                          rng.randrange(size * size))
+                lines = self.brute_force_lines(board)
+                self.assertEqual(sorted(board.winners()),
+                                 sorted(set(team for team, cells in lines)))
+                self.assertEqual(
+                    sorted((team, sorted(line))
+                           for team, line in board.check_victory()),
+                    sorted((team, sorted(cells)) for team, cells in lines))
+                windows = engine.WindowCounts(board.geometry, board)
+                self.assertEqual(sorted(map(str, windows.lines())),
+                                 sorted(map(str, board.check_victory())))
+
+    def test_winning_cells(self):
+        rng = random.Random(12)
+        for size, win_length in ((7, 4), (6, 3), (9, 5)):
+            g = engine.get_geometry(size, size, win_length)
+            for n in range(30):
+                board = self.random_board(rng, size, win_length,
+                                          rng.randrange(size * size // 2))
+                empty = board.empty()
+                bits = board.bits[1]
+                # the empty cell of every window that is one piece short
+                expected = 0
+                for mask in g.window_masks:
+                    missing = mask & ~bits
+                    if missing & empty and engine.popcount(missing) == 1:
+                        expected |= missing
+                self.assertEqual(
+                    engine.line_completions(board.bits[1], empty, g),
+                    expected)
+                self.assertEqual(g.winning_cells(board.bits[1], empty, g),
+                                 expected)
+
+
+class TestWindowCounts(unittest.TestCase):
+
+    def count_threats(self, board, team):
+        count = 0
+        for mask in board.geometry.window_masks:
+            if engine.popcount(board.bits[team] & mask) == 3 and \
+                    not board.bits[3 - team] & mask:
+                count += 1
+        return count
+
+    def test_incremental(self):
+        rng = random.Random(4)
+        board = engine.BitBoard(7, 7)
+        for move in range(200):
+            if move % 20 == 0:
+                board = engine.BitBoard(7, 7)
+                windows = engine.WindowCounts(board.geometry)
+            columns = [x for x in range(7) if not board.column_blocked(x)]
+            x = rng.choice(columns)
+            y = board.drop(x, move % 2 + 1)
+            windows.add(board.geometry.index(x, y), move % 2 + 1)
+            if move % 3 == 2:
+                board.rotate()
+                windows.rotate()
+                moves = board.falling_moves()
+                board.make_pieces_fall()
+                windows.move(moves)
+            self.assertEqual(windows.lines(), board.check_victory())
+            for team in (1, 2):
+                self.assertEqual(windows.threats(team),
+                                 self.count_threats(board, team))
+
+    def test_board_windows(self):
+        board = engine.Board(7, 7)
+        for x in (3, 3, 4):
+            board.drop_piece(x, 1)
+        self.assertEqual(board.windows.threats(1), 0)
+        board.drop_piece(2, 1)
+        self.assertEqual(board.windows.threats(1),
+                         self.count_threats(board.state, 1))
+        self.assertIs(board.windows, board.windows)
+
+    def test_falling_moves(self):
+        board = create_board_from_text(list(FALL_FIXTURES)[1])
+        moves = [(board.state.geometry.position(source),
+                  board.state.geometry.position(destination), team)
+                 for (source, destination, team)
+                 in board.state.falling_moves()]
+        self.assertEqual(sorted(moves), sorted(
+            (pos, pos2, board.grid[pos2[0]][pos2[1]])
+            for (pos, pos2) in board.iterate_pieces_falling()))
+
+
+class TestGameState(unittest.TestCase):
+
+    def test_push_rotates(self):
+        state = engine.GameState()
+        state.push(0)
+        state.push(0)
+        self.assertEqual(state.turns_til_rotation, 1)
+        state.push(6)
+        # the left column became the bottom row, and the piece in the right
+        # column fell onto it
+        self.assertEqual(state.board.get_string().split('\n')[-2:],
+                         ['0000001', '0000021'])
+        self.assertEqual(state.turns_til_rotation, engine.ROTATE_TIME)
+        self.assertEqual(state.active_player, 2)
+
+    def test_pop_restores(self):
+        state = engine.GameState()
+        before = []
+        for column in (3, 3, 4, 2, 2, 5, 1):
+            before.append((state.board.get_string(), state.active_player,
+                           state.turns_til_rotation))
+            state.push(column)
+        while state.history:
+            state.pop()
+            self.assertEqual((state.board.get_string(), state.active_player,
+                              state.turns_til_rotation), before.pop())
+
+    def test_hash(self):
+        state = engine.GameState()
+        for column in (3, 3, 4, 2, 2, 5, 1):
+            state.push(column)
+            incremental = (state.hash, state.mirror_hash)
+            state.rehash()
+            self.assertEqual((state.hash, state.mirror_hash), incremental)
+        # the moves-until-rotation counter is part of the hash
+        other = engine.GameState(state.board.copy(), state.active_player,
+                                 state.turns_til_rotation + 1)
+        self.assertNotEqual(other.hash, state.hash)
+
+    def test_mirror_hash(self):
+        left = engine.GameState()
+        left.push(1)
+        right = engine.GameState()
+        right.push(5)
+        self.assertEqual(left.key(fold_mirror=True),
+                         right.key(fold_mirror=True))
+        self.assertNotEqual(left.hash, right.hash)
+
+    def test_clone(self):
+        state = engine.GameState()
+        state.push(3)
+        other = state.clone()
+        other.push(3)
+        self.assertEqual(state.board.lowest_in_column(3), 5)
+        self.assertEqual(other.board.lowest_in_column(3), 4)
+
+
+class TestCore(unittest.TestCase):
+
+    def run_python(self, code):
+        """Runs the code in a fresh interpreter and returns its output."""
+        return subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+
+    def test_headless_modules_skip_pygame(self):
+        self.assertEqual(self.run_python(
+            "import sys, aiworker, book, core, gamerecord, positiondb, "
+            "selfplay\n"
+            "ai = core.AI_STRATEGIES['basic'](1)\n"
+            "print(ai.search(core.engine.GameState()) in range(7), "
+            "'pygame' in sys.modules)"), 'True False')
+
+    def test_board_without_display(self):
+        self.assertEqual(self.run_python(
+            "import main\n"
+            "board = main.Board(7, 7)\n"
+            "for x in (3, 3, 4):\n"
+            "    board.drop_piece(x, 1)\n"
+            "board.rotate()\n"
+            "board.make_pieces_fall()\n"
+            "print(board.get_string().split()[-1], board._image)"),
+            '0000011 None')
+
+    def test_rules_without_pygame(self):
+        self.assertEqual(self.run_python(
+            "import sys, engine\n"
+            "board = engine.Board(7, 7)\n"
+            "for x in (3, 3, 4):\n"
+            "    board.drop_piece(x, 1)\n"
+            "board.rotate()\n"
+            "board.make_pieces_fall()\n"
+            "print(board.get_string().split()[-1], 'pygame' in sys.modules)"),
+            '0000011 False')
+
+    def test_main_skips_tool_modules(self):
+        self.assertEqual(self.run_python(
+            "import sys, main\n"
+            "print([name for name in ('aiworker', 'book', 'gamerecord', "
+            "'positiondb', 'profiler') if name in sys.modules])"), '[]')
+
+
+class TestSearchAI(unittest.TestCase):
+
+    def test_takes_win(self):
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          1112220""")
+        ai = search.SearchAI(2, budget_ms=50)
+        self.assertEqual(ai.get_move(board, 2), 6)
+
+    def test_blocks(self):
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000200
+                                          1110200""")
+        ai = search.SearchAI(2, budget_ms=50)
+        self.assertEqual(ai.get_move(board, 2), 3)
+
+    def test_more_lines_win(self):
+        # column 1 completes two lines for team 1, and team 2 has one
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          2000100
+                                          2001000
+                                          2010000
+                                          2011120""")
+        state = engine.GameState(board.state, 1, 3, 3)
+        ai = search.SearchAI(1, budget_ms=50)
+        self.assertEqual(ai.search_move(state, 1, 1, -search.WIN_SCORE,
+                                        search.WIN_SCORE, 0),
+                         search.WIN_SCORE)
+        state.push(1)
+        self.assertEqual(state.winners(), [1, 2])
+        self.assertEqual(state.winner(), 1)
+        state.board.set_cell(0, 2, 2)
+        self.assertEqual(state.winner(), engine.DRAW)
+
+    def test_time_budget(self):
+        # with no time at all, the search gives up at its first look at
+        # the clock and plays the deepest completed iteration's move
+        ai = search.SearchAI(1, budget_ms=0)
+        state = engine.GameState()
+        self.assertIn(ai.search(state), state.legal_moves())
+        self.assertEqual(ai.nodes, search.NODES_PER_TIME_CHECK)
+        self.assertGreaterEqual(ai.depth_reached, 1)
+        self.assertLess(ai.depth_reached, ai.max_depth)
+        self.assertEqual(state.history, [])
+
+
+class TestAIWorker(unittest.TestCase):
+
+    def wait_for_move(self, worker, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            move = worker.poll()
+            if move is not None:
+                return move
+            time.sleep(0.001)
+        self.fail("no move from the worker")
+
+    def test_ponder(self):
+        ai = search.SearchAI(2, budget_ms=50)
+        worker = aiworker.AIWorker(ai)
+        self.addCleanup(worker.close)
+        state = engine.GameState()
+        state.push(3)
+        worker.request_move(state)
+        state.push(self.wait_for_move(worker))
+
+        # moves that lead to the same position after a rotation share a reply
+        positions = set()
+        for x in state.legal_moves():
+            state.push(x)
+            positions.add(state.hash)
+            state.pop()
+        worker.ponder(state)
+        deadline = time.time() + 5.0
+        while len(worker.replies) < len(positions) and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(set(worker.replies), positions)
+        # the reply to a pondered move is used without searching again
+        searches = []
+        worker.search = lambda state, kind: searches.append(kind)
+        state.push(5)
+        worker.request_move(state)
+        move = self.wait_for_move(worker)
+        self.assertEqual(move, worker.replies[state.hash])
+        self.assertEqual(searches, [])
+
+    def test_stop_before_search(self):
+        state = engine.GameState()
+        state.push(3)
+        ai = search.SearchAI(2, budget_ms=60000)
+        ai.stop()
+        self.assertIn(ai.search(state), state.legal_moves())
+        self.assertLessEqual(ai.nodes, search.NODES_PER_TIME_CHECK)
+
+        # a position that wasn't pondered stops the ponder search, however
+        # long its budget, and the AI searches normally for the move
+        ai.budget_ms = 60000
+        worker = aiworker.AIWorker(ai)
+        self.addCleanup(worker.close)
+        worker.ponder(state)
+        deadline = time.time() + 5.0
+        while worker.pondering is None and time.time() < deadline:
+            time.sleep(0.001)
+        for x in state.legal_moves():
+            state.push(x)
+            if state.hash != worker.pondering:
+                break
+            state.pop()
+        searched = []
+        search_ai = ai.search
+
+        def move_search(state):
+            searched.append(ai.stopped)
+            ai.budget_ms = 20
+            return search_ai(state)
+        ai.search = move_search
+        worker.request_move(state)
+        self.assertIn(self.wait_for_move(worker, 30.0), state.legal_moves())
+        self.assertEqual(searched[-1], False)
+
+
+class TestOpeningBook(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        with open(self.path, 'wb') as f:
+            self.size = book.build(f, depth=2, budget_ms=5, processes=1)
+        self.book = book.OpeningBook(self.path)
+        self.addCleanup(self.book.close)
+
+    def test_build(self):
+        # the start and the position after each of the 7 first moves
+        self.assertEqual(self.size, 8)
+        self.assertEqual(len(self.book), 8)
+        self.assertEqual(os.path.getsize(self.path),
+                         book.HEADER.size + 8 * book.RECORD.size)
+
+    def test_lookup(self):
+        state = engine.GameState()
+        for x in (None, 3):
+            if x is not None:
+                state.push(x)
+            move = self.book.lookup(state)
+            self.assertIn(move, state.legal_moves())
+            self.assertEqual(self.book.probe(state.hash)[0], move)
+        state.push(3)
+        self.assertIsNone(self.book.lookup(state))
+        self.assertIsNone(self.book.probe(0))
+
+    def test_ai_plays_book_move(self):
+        state = engine.GameState()
+        state.push(0)
+        expected = self.book.lookup(state)
+        ai = search.SearchAI(2, budget_ms=1000, book=self.book)
+        self.assertEqual(ai.search(state), expected)
+        # the move came from the book, without searching
+        self.assertEqual(ai.nodes, 0)
+        self.assertEqual(main.AI(2, book=self.book).search(state), expected)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = profiler.Profiler(window=10)
+        self.profiler.end_frame()
+        for n in range(15):
+            self.profiler.add('board', 0.002)
+            self.profiler.add('flip', 0.001)
+            if n % 2:
+                self.profiler.add('flip', 0.001)
+            self.profiler.end_frame()
+        self.profiler.record_search('move', 0.5, 1000, 6)
+        self.profiler.record_search('ponder', 0.5, 3000, 5)
+
+    def test_summary(self):
+        summary = self.profiler.summary()
+        self.assertEqual(summary['frames'], 10)
+        self.assertEqual(summary['slowest_span'], 'board')
+        self.assertAlmostEqual(summary['spans']['board']['mean_ms'], 2.0)
+        self.assertAlmostEqual(summary['spans']['flip']['p99_ms'], 2.0)
+        self.assertEqual(summary['search'], {
+            'count': 1, 'mean_ms': 500.0, 'nodes_per_sec': 2000.0,
+            'last_depth': 6})
+
+    def test_span(self):
+        with self.profiler.span('input'):
+            pass
+        self.profiler.end_frame()
+        self.assertEqual(len(self.profiler.spans['input']), 1)
+        self.assertEqual(self.profiler.spans['board'][-1], 0.0)
+
+    def test_export(self):
+        histograms = self.profiler.histograms(bucket_ms=1.0)
+        self.assertEqual(histograms['board'], [(2.0, 10)])
+        self.assertEqual(histograms['flip'], [(1.0, 5), (2.0, 5)])
+        self.assertEqual(histograms[profiler.SEARCH], [(500.0, 1)])
+        f = io.StringIO()
+        self.profiler.export_json(f)
+        data = json.loads(f.getvalue())
+        self.assertEqual(data['histograms']['board'], [[2.0, 10]])
+        self.assertEqual(len(data['searches']), 2)
+        f = io.StringIO()
+        self.profiler.export_csv(f)
+        rows = f.getvalue().splitlines()
+        self.assertEqual(rows[0], 'series,bucket_ms,count')
+        self.assertIn('board,2.0,10', rows)
+
+    def test_worker_reports_searches(self):
+        profile = profiler.Profiler()
+        worker = aiworker.AIWorker(search.SearchAI(2, budget_ms=20), profile)
+        self.addCleanup(worker.close)
+        state = engine.GameState()
+        state.push(3)
+        worker.request_move(state)
+        deadline = time.time() + 5.0
+        while worker.poll() is None and time.time() < deadline:
+            time.sleep(0.001)
+        kind, seconds, nodes, depth = profile.searches[-1]
+        self.assertEqual(kind, 'move')
+        self.assertGreater(nodes, 0)
+        self.assertGreater(depth, 0)
+
+
+class TestMatch(unittest.TestCase):
+
+    def test_rotation_and_result(self):
+        match = engine.Match()
+        self.assertFalse(match.play(3))
+        self.assertFalse(match.play(3))
+        self.assertTrue(match.play(3))
+        for x in (3, 4, 3, 1, 4, 5):
+            self.assertIsNone(match.winner)
+            match.play(x)
+        self.assertEqual(match.points, [0, 1, 0])
+        self.assertEqual(match.winner, 1)
+        self.assertEqual(match.legal_moves(), [])
+        with self.assertRaises(ValueError):
+            match.play(4)
+
+    def test_illegal_move(self):
+        match = engine.Match(5, 5, 4, 10)
+        for i in range(5):
+            match.play(0)
+        with self.assertRaises(ValueError):
+            match.play(0)
+        with self.assertRaises(ValueError):
+            match.play(5)
+
+    def test_score_lines(self):
+        points = [0, 0, 0]
+        self.assertEqual(engine.score_lines([(2, [])], points), 2)
+        self.assertEqual(points, [0, 0, 1])
+        self.assertEqual(engine.score_lines([(1, []), (1, [])], points), 1)
+        self.assertEqual(engine.score_lines([(2, [])], points), engine.DRAW)
+        self.assertEqual(points, [0, 2, 2])
+
+
+class TestTranspositionTable(unittest.TestCase):
+
+    def test_store_and_probe(self):
+        table = transposition.TranspositionTable(1024)
+        self.assertEqual(table.probe(12345), None)
+        table.store(12345, 5, transposition.LOWER, -70, 3)
+        self.assertEqual(table.probe(12345),
+                         (5, transposition.LOWER, -70, 3))
+        stats = table.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_memory_cap(self):
+        table = transposition.TranspositionTable(1000)
+        self.assertEqual(table.size, 32)
+        self.assertTrue(table.memory_bytes() <= 1000)
+
+    def test_depth_policy(self):
+        table = transposition.TranspositionTable(1024, policy='depth')
+        table.store(1, 6, transposition.EXACT, 10, 0)
+        # 1 + 64 lands in the same slot but is a different position
+        table.store(1 + 64, 2, transposition.EXACT, 20, 1)
+        self.assertEqual(table.probe(1 + 64), None)
+        self.assertEqual(table.collisions, 1)
+        table.new_generation()
+        table.store(1 + 64, 2, transposition.EXACT, 20, 1)
+        self.assertEqual(table.probe(1 + 64)[2], 20)
+
+    def test_always_policy(self):
+        table = transposition.TranspositionTable(1024, policy='always')
+        table.store(1, 6, transposition.EXACT, 10, 0)
+        table.store(1 + 64, 2, transposition.EXACT, 20, None)
+        self.assertEqual(table.probe(1 + 64),
+                         (2, transposition.EXACT, 20, None))
+        self.assertEqual(table.overwrites, 1)
+
+
+class TestMCTSAI(unittest.TestCase):
+
+    def test_takes_win(self):
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          0000000
+                                          1112220""")
+        ai = mcts.MCTSAI(2, budget_ms=20, processes=1, seed=0)
+        self.assertEqual(ai.get_move(board, 2), 6)
+
+    def test_search(self):
+        state = engine.GameState()
+        state.push(3)
+        ai = mcts.MCTSAI(2, budget_ms=50, processes=1, seed=0)
+        move = ai.search(state)
+        self.assertIn(move, state.legal_moves())
+        self.assertEqual(sorted(ai.visits), list(range(7)))
+        self.assertEqual(sum(ai.visits.values()), ai.playouts)
+        self.assertEqual(len(state.history), 1)
+
+    def test_stop(self):
+        state = engine.GameState()
+        state.push(3)
+        ai = mcts.MCTSAI(2, budget_ms=60000, processes=1, seed=0)
+        # a stop that comes before the search starts still cuts it short
+        ai.stop()
+        self.assertIn(ai.search(state), state.legal_moves())
+        self.assertEqual(ai.playouts, mcts.ITERATIONS_PER_TIME_CHECK)
+        ai.stopped = False
+        ai.search(state, budget_ms=20)
+        self.assertGreater(ai.playouts, mcts.ITERATIONS_PER_TIME_CHECK)
+
+    def test_stop_pool(self):
+        state = engine.GameState()
+        state.push(3)
+        ai = mcts.MCTSAI(2, budget_ms=60000, processes=2, seed=0)
+        ai.stop()
+        move = ai.search(state)
+        # each worker stopped at its first check, and the most visited
+        # move of what they found is played
+        self.assertEqual(ai.playouts, 2 * mcts.ITERATIONS_PER_TIME_CHECK)
+        self.assertEqual(move, max(sorted(ai.visits),
+                                   key=lambda x: ai.visits[x]))
+
+    def test_more_lines_win(self):
+        # column 1 gives team 1 two lines to team 2's one: a win, taken
+        # without searching
+        board = create_board_from_text("""0000000
+                                          0000000
+                                          0000000
+                                          2000100
+                                          2001000
+                                          2010000
+                                          2011120""")
+        state = engine.GameState(board.state, 1, 3, 3)
+        ai = mcts.MCTSAI(1, budget_ms=20, processes=1, seed=0)
+        self.assertEqual(ai.search(state), 1)
+        self.assertEqual(ai.playouts, 0)
+        state.push(1)
+        self.assertEqual(mcts.terminal_result(state), 1)
+
+    def test_playout(self):
+        board = engine.BitBoard()
+        result = mcts.playout(board, 1, 3, 3, random.Random(0))
+        self.assertIn(result, (mcts.DRAW, 1, 2))
+        self.assertTrue(result == mcts.DRAW or board.winners())
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        names = [name for name, factory, number in benchmark.BENCHMARKS]
+        results = benchmark.run_benchmarks(names, scale=0.01)
+        self.assertEqual(sorted(results), sorted(names))
+        for result in results.values():
+            self.assertLessEqual(result['p50_us'], result['p99_us'])
+            self.assertGreater(result['ops_per_sec'], 0)
+
+    def test_positions(self):
+        positions = benchmark.random_positions(4, seed=3)
+        again = benchmark.random_positions(4, seed=3)
+        self.assertEqual([p.hash for p in positions],
+                         [p.hash for p in again])
+        for state in positions:
+            self.assertEqual(state.winners(), [])
+
+    def test_grid_board(self):
+        # the reference board the engine is measured against plays the same
+        for state in benchmark.random_positions(20, seed=5):
+            grid = benchmark.GridBoard(state.board)
+            board = state.board.copy()
+            grid.rotate()
+            grid.make_pieces_fall()
+            board.rotate_and_fall()
+            self.assertEqual(grid.grid, [[board.cell(x, y) for y in range(7)]
+                                         for x in range(7)])
+            self.assertEqual(sorted(grid.check_victory()),
+                             sorted(board.check_victory()))
+
+    def test_compare(self):
+        baseline = {'a': {'p50_us': 10.0}, 'b': {'p50_us': 10.0}}
+        results = {'a': {'p50_us': 11.0}, 'b': {'p50_us': 13.0},
+                   'c': {'p50_us': 100.0}}
+        self.assertEqual(benchmark.compare(results, baseline, 0.2),
+                         [('b', 10.0, 13.0)])
+
+
+STANDARD_RULES = (7, 4, 3)
+
+
+class TestSelfPlay(unittest.TestCase):
+
+    def test_play_game(self):
+        record = selfplay.play_game((0, 5, ('basic', 'basic'), 1,
+                                     STANDARD_RULES))
+        again = selfplay.play_game((0, 5, ('basic', 'basic'), 1,
+                                    STANDARD_RULES))
+        self.assertEqual((record['moves'], record['winner']),
+                         (again['moves'], again['winner']))
+        self.assertEqual(len(record['times_ms']), len(record['moves']))
+        self.assertEqual(record['rotations'],
+                         list(range(3, len(record['moves']) + 1, 3)))
+
+    def test_binary_records(self):
+        f = io.BytesIO()
+        selfplay.run(3, ('basic', 'basic'), f, 'binary', processes=1,
+                     seed=7)
+        f.seek(0)
+        records = list(selfplay.read_binary_records(f))
+        self.assertEqual([r['game'] for r in records], [0, 1, 2])
+        for record in records:
+            expected = selfplay.play_game(
+                (record['game'], record['seed'], ('basic', 'basic'), 1,
+                 STANDARD_RULES))
+            self.assertEqual(record['moves'], expected['moves'])
+            self.assertEqual(record['winner'], expected['winner'])
+            self.assertEqual(record['rotations'], expected['rotations'])
+
+    def test_variants(self):
+        for size, win_length, rotate_time in ((5, 4, 2), (9, 5, 4)):
+            record = selfplay.play_game(
+                (0, 3, ('alphabeta', 'mcts'), 2,
+                 (size, win_length, rotate_time)))
+            self.assertEqual((record['size'], record['win_length']),
+                             (size, win_length))
+            self.assertTrue(all(0 <= x < size for x in record['moves']))
+            self.assertEqual(record['rotations'],
+                             list(range(rotate_time, len(record['moves']) + 1,
+                                        rotate_time)))
+        with self.assertRaises(ValueError):
+            selfplay.write_binary_record(io.BytesIO(), record)
+
+    def test_compact_records(self):
+        f = io.BytesIO()
+        selfplay.run(2, ('basic', 'alphabeta'), f, 'compact', budget_ms=2,
+                     processes=1, seed=3, size=5, win_length=4,
+                     rotate_time=2)
+        f.seek(0)
+        records = list(gamerecord.read_games(f))
+        self.assertEqual([r.number for r in records], [0, 1])
+        for record in records:
+            self.assertEqual(record.rules, (5, 5, 4, 2))
+            self.assertEqual(record.players, (0, 1))
+            self.assertIn(record.winner, (0, 1, 2))
+
+
+class TestGameRecord(unittest.TestCase):
+
+    def assert_same_state(self, state, expected):
+        self.assertEqual(
+            (state.board.bits, state.board.heights, state.active_player,
+             state.turns_til_rotation, state.hash),
+            (expected.board.bits, expected.board.heights,
+             expected.active_player, expected.turns_til_rotation,
+             expected.hash))
+
+    def test_round_trip(self):
+        f = io.BytesIO()
+        games = [random_game(seed) for seed in range(5)]
+        for number, (moves, states) in enumerate(games):
+            gamerecord.write_game(f, moves, winner=gamerecord.UNFINISHED,
+                                  players=(gamerecord.HUMAN, 0),
+                                  number=number, interval=8)
+        f.seek(0)
+        records = list(gamerecord.read_games(f))
+        self.assertEqual([r.moves for r in records],
+                         [moves for moves, states in games])
+        self.assertEqual(records[0].players, (gamerecord.HUMAN, 0))
+        # 3 bits a move, and two 7 byte bitboards every 8 moves
+        moves = games[0][0]
+        self.assertEqual(len(gamerecord.pack_game(moves, interval=8)),
+                         gamerecord.GAME_HEADER.size +
+                         (len(moves) * 3 + 7) // 8 + len(moves) // 8 * 14)
+
+    def test_seek(self):
+        for rules in ((7, 7, 4, 3), (5, 5, 3, 2), (9, 9, 5, 4)):
+            moves, states = random_game(1, rules)
+            data = gamerecord.pack_game(moves, rules, interval=5)
+            record = gamerecord.unpack_game(data)
+            self.assertEqual(record.pack(), data)
+            replay = gamerecord.Replay(record)
+            rng = random.Random(2)
+            for ply in [len(moves), 0, 3] + [rng.randint(0, len(moves))
+                                             for i in range(30)]:
+                self.assert_same_state(replay.seek(ply), states[ply])
+                if ply:
+                    self.assert_same_state(replay.back(), states[ply - 1])
+                    self.assert_same_state(replay.step(), states[ply])
+            with self.assertRaises(IndexError):
+                replay.seek(len(moves) + 1)
+
+    def test_streaming(self):
+        f = io.BytesIO()
+        for number in range(4):
+            moves, states = random_game(number)
+            gamerecord.write_game(f, moves, winner=number % 3,
+                                  players=(1, 2), number=number)
+        f.seek(0)
+        headers = list(gamerecord.read_games(f, headers_only=True))
+        self.assertEqual([r.number for r in headers], [0, 1, 2, 3])
+        self.assertIsNone(headers[0].data)
+        offsets = gamerecord.index_games(f)
+        record = gamerecord.read_game_at(f, offsets[2])
+        self.assertEqual(record.moves, random_game(2)[0])
+        f.seek(0)
+        totals = gamerecord.summarize(f)
+        self.assertEqual((totals['games'], totals['wins'], totals['draws']),
+                         (4, [1, 1], 2))
+        self.assertEqual(totals['players'], {('alphabeta', 'mcts'): 4})
+
+    def test_bad_records(self):
+        with self.assertRaises(ValueError):
+            gamerecord.pack_game([3, 7])
+        with self.assertRaises(ValueError):
+            list(gamerecord.read_games(io.BytesIO(b'GTBOOK1\0' + b'\0' * 30)))
+        data = gamerecord.pack_game(random_game(0)[0])
+        with self.assertRaises(ValueError):
+            list(gamerecord.read_games(io.BytesIO(data[:-1])))
+
+
+class TestPositionDB(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        # small enough that ingesting has to grow it
+        self.db = positiondb.create(self.path, capacity=16)
+        self.addCleanup(lambda: self.db.close())
+
+    def records(self, games):
+        """Returns gamerecord.GameRecords of (moves, winner) pairs."""
+        f = io.BytesIO()
+        for moves, winner in games:
+            gamerecord.write_game(f, moves, winner=winner)
+        f.seek(0)
+        return gamerecord.read_games(f)
+
+    def test_ingest(self):
+        games = []
+        for seed in range(30):
+            moves, states = random_game(seed)
+            games.append((moves, seed % 3))
+        games.append(([3, 3], gamerecord.UNFINISHED))
+        self.assertEqual(self.db.ingest(self.records(games)),
+                         (30, sum(len(moves) + 1
+                                  for moves, winner in games[:30])))
+
+        expected = {}
+        g = self.db.geometry
+        for moves, winner in games[:30]:
+            state = engine.GameState()
+            for ply in range(len(moves) + 1):
+                key = positiondb.canonical(state.board.bits[1],
+                                           state.board.bits[2],
+                                           state.turns_til_rotation, g)
+                counts = expected.setdefault(key, [0, 0, 0])
+                if winner == 0:
+                    counts[1] += 1
+                else:
+                    counts[0 if winner == state.active_player else 2] += 1
+                if ply < len(moves):
+                    state.push(moves[ply])
+        self.assertEqual(len(self.db), len(expected))
+        self.assertGreater(self.db.capacity, 16)
+        self.db.close()
+        self.db = positiondb.PositionDB(self.path)
+        for key, counts in expected.items():
+            self.assertEqual(self.db.probe(key), tuple(counts))
+        self.assertEqual(self.db.lookup(engine.GameState()),
+                         tuple(expected[(0, 0, 3)]))
+        with self.assertRaises(ValueError):
+            self.db.add_counts({(0, 0, 3): [1, 0, 0]})
+
+    def test_mirror_images(self):
+        self.db.ingest(self.records([([0, 1], 1)]))
+        state = engine.GameState()
+        for x in (0, 1):
+            state.push(x)
+        self.assertEqual(self.db.lookup(state), (1, 0, 0))
+        # the board turns the same way whichever side the pieces are on, so
+        # mirror images are different positions
+        state = engine.GameState()
+        for x in (6, 5):
+            state.push(x)
+        self.assertIsNone(self.db.lookup(state))
+        state.pop()
+        state.push(3)
+        self.assertIsNone(self.db.lookup(state))
+        self.assertIsNone(self.db.lookup(
+            engine.GameState(engine.BitBoard(5, 5), 1, 3, 3)))
+
+    def test_canonical(self):
+        g = engine.get_geometry(3, 2, 3)
+        left = g.bit(0, 1) | g.bit(0, 0)
+        right = g.bit(2, 1) | g.bit(2, 0)
+        # the four empty cells are enough to reach a rotation in four moves
+        self.assertEqual(positiondb.canonical(right, 0, 4, g), (right, 0, 4))
+        self.assertEqual(positiondb.canonical(left, 0, 4, g), (left, 0, 4))
+        # but not in five, so the game ends before the board turns
+        self.assertEqual(positiondb.canonical(right, 0, 5, g),
+                         positiondb.canonical(left, 0, 5, g))
+
+    def test_best_move(self):
+        self.db.ingest(self.records([([1], 1)] * 10 + [([3], 2)] * 10 +
+                                    [([0], 1)] * 5))
+        state = engine.GameState()
+        self.assertEqual(self.db.move_scores(state),
+                         {1: (1.0, 10), 3: (0.0, 10)})
+        self.assertEqual(self.db.best_move(state), 1)
+        self.assertEqual(main.AI(1, positions=self.db).search(state), 1)
+        state.push(1)
+        self.assertIsNone(self.db.best_move(state))
+
+
+class TestRender(unittest.TestCase):
+
+    def render(self, record, moves_per_job):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        frames = render.render([(4, record)], directory, fps=5, processes=1,
+                               moves_per_job=moves_per_job)
+        directory = os.path.join(directory, 'game00004')
+        names = sorted(os.listdir(directory))
+        self.assertEqual(names, [render.FRAME_NAME % i
+                                 for i in range(frames)])
+        return [pygame.image.tostring(pygame.image.load(
+            os.path.join(directory, name)), 'RGB') for name in names]
+
+    def test_runs_match_whole_game(self):
+        # rotates three times, and team 1 wins
+        record = gamerecord.unpack_game(gamerecord.pack_game(
+            [3, 3, 3, 3, 4, 3, 1, 4, 5], winner=1))
+        whole = self.render(record, 100)
+        in_runs = self.render(record, 2)
+        self.assertEqual(len(in_runs), len(whole))
+        self.assertTrue(in_runs == whole)
+        # the piece waits over the column, and the end is held
+        self.assertEqual(whole[0], whole[1])
+        self.assertEqual(whole[-1], whole[-2])
+        self.assertNotEqual(whole[0], whole[-1])
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestBoardBatch(unittest.TestCase):
+
+    def batch_and_boards(self, texts):
+        boards = [create_board_from_text(text) for text in texts]
+        return (batch.BoardBatch.from_bitboards(b.state for b in boards),
+                boards)
+
+    def get_strings(self, boards):
+        return [b.get_string() for b in boards]
+
+    def test_rotate(self):
+        boards_batch, boards = self.batch_and_boards(ROTATE_FIXTURES)
+        boards_batch.rotate()
+        self.assertEqual(self.get_strings(boards_batch.to_bitboards()),
+                         [ROTATE_FIXTURES[text] for text in ROTATE_FIXTURES])
+
+    def test_make_pieces_fall(self):
+        boards_batch, boards = self.batch_and_boards(FALL_FIXTURES)
+        boards_batch.make_pieces_fall()
+        self.assertEqual(self.get_strings(boards_batch.to_bitboards()),
+                         [FALL_FIXTURES[text] for text in FALL_FIXTURES])
+
+    def test_check_victory(self):
+        texts = list(ROTATE_FIXTURES) + list(FALL_FIXTURES)
+        boards_batch, boards = self.batch_and_boards(texts)
+        for rotate in (False, True):
+            winners, lines = boards_batch.check_victory()
+            self.assertEqual(lines, [b.check_victory() for b in boards])
+            self.assertEqual(winners[:, 1:].tolist(),
+                             [[1 in b.state.winners(), 2 in b.state.winners()]
+                              for b in boards])
+            boards_batch.rotate()
+            boards_batch.make_pieces_fall()
+            for b in boards:
+                b.rotate()
+                b.make_pieces_fall()
+
+    def test_drop(self):
+        boards_batch, boards = self.batch_and_boards(FALL_FIXTURES)
+        rows = boards_batch.drop([0, 6], [2, 1])
+        self.assertEqual(rows.tolist(), [5, -1])
+        self.assertEqual(boards_batch.cells[0, 0, 5], 2)
+
+
+class RecordingRegions(main.DirtyRegions):
+
+    """DirtyRegions that remembers what each update pushed."""
+
+    def __init__(self):
+        main.DirtyRegions.__init__(self)
+        self.pushed = []
+
+    def update(self):
+        self.pushed.append((self.everything, list(self.rects)))
+        main.DirtyRegions.update(self)
+
+
+class TestTimeline(unittest.TestCase):
+
+    def test_order(self):
+        timeline = main.Timeline()
+        log = []
+
+        def animation(name, seconds):
+            elapsed = timeline.clock()
+            while elapsed() < seconds:
+                log.append(name)
+                yield
+
+        def logic():
+            log.append('logic')
+            # runs before the task that was already waiting
+            timeline.add(animation('inner', 0.25))
+
+        timeline.add(animation('first', 0.5))
+        timeline.add(logic)
+        timeline.add(animation('last', 0.25))
+        frames = 0
+        while timeline.update(0.125):
+            frames += 1
+        self.assertEqual(log, ['first'] * 4 + ['logic'] + ['inner'] * 2 +
+                         ['last'] * 2)
+        self.assertEqual(frames, 8)
+        self.assertFalse(timeline.busy())
+
+    def test_dropped_frames(self):
+        timeline = main.Timeline()
+        timeline.add(animation_task(timeline, 0.5))
+        # a slow frame skips ahead instead of stretching the animation
+        self.assertTrue(timeline.update(0))
+        self.assertTrue(timeline.update(0.4))
+        self.assertFalse(timeline.update(0.2))
+
+
+def animation_task(timeline, seconds):
+    elapsed = timeline.clock()
+    while elapsed() < seconds:
+        yield
+
+
+class TestGame(unittest.TestCase):
+
+    def setUp(self):
+        init_display()
+        self.screen = pygame.Surface((main.WINDOW_WIDTH, main.WINDOW_HEIGHT))
+        self.game = main.Game(self.screen, ai=False)
+
+    def test_profile_overlay(self):
+        self.game.render_all()
+        self.game.profiler.end_frame()
+        self.game.show_profile = True
+        self.game.render_all()
+        self.game.profiler.end_frame()
+        summary = self.game.profiler.summary()
+        self.assertEqual(summary['frames'], 1)
+        self.assertEqual(sorted(summary['spans']),
+                         ['background', 'board', 'flip', 'overlay'])
+        self.assertEqual(len(self.game.overlay_rects), 3)
+
+    def test_background_cached(self):
+        self.game.render_background()
+        background = self.game.background
+        self.game.render_background()
+        self.assertIs(self.game.background, background)
+        self.game.screen = pygame.Surface((320, 240))
+        self.game.render_background()
+        self.assertEqual(self.game.background.get_size(), (320, 240))
+
+    def test_dirty_rendering(self):
+        self.game.dirty = RecordingRegions()
+        self.game.render_all()
+        self.game.column_selected = 4
+        self.game.render_all()
+        (first, rects), (second, rects) = self.game.dirty.pushed
+        self.assertTrue(first)
+        self.assertFalse(second)
+        area = sum(rect.width * rect.height for rect in rects)
+        self.assertLess(area, main.WINDOW_WIDTH * main.WINDOW_HEIGHT / 10)
+
+    def test_restart_keeps_settings(self):
+        self.game.rotation_steps = 3
+        self.game.rotation_easing = 'ease-in'
+        self.game.smooth_rotation = True
+        self.game.show_profile = True
+        self.game.profile_path = 'profile.csv'
+        self.game.column_selected = 3
+        self.game.drop_piece()
+        self.game.timeline.finish()
+        self.game.handle_input([pygame.event.Event(pygame.KEYDOWN,
+                                                   key=pygame.K_SPACE)])
+        self.assertEqual(self.game.num_pieces_dropped, 0)
+        self.assertEqual((self.game.rotation_steps,
+                          self.game.rotation_easing,
+                          self.game.smooth_rotation), (3, 'ease-in', True))
+        self.assertTrue(self.game.show_profile)
+        self.assertEqual(self.game.profile_path, 'profile.csv')
+
+    def test_idle_frames(self):
+        self.assertTrue(self.game.needs_frame())
+        self.game.render_all()
+        self.assertFalse(self.game.needs_frame())
+        # the mouse moving inside the selected column changes nothing (with
+        # no window, the mouse stays over the first column)
+        pygame.event.clear()
+        pygame.event.post(pygame.event.Event(
+            pygame.MOUSEMOTION, pos=(0, 0), rel=(1, 0), buttons=(0, 0, 0)))
+        self.game.handle_input()
+        self.assertEqual(self.game.column_selected, 0)
+        self.assertFalse(self.game.needs_frame())
+        self.game.handle_input([pygame.event.Event(pygame.KEYDOWN,
+                                                   key=pygame.K_RIGHT)])
+        self.assertEqual(self.game.column_selected, 1)
+        self.assertTrue(self.game.needs_frame())
+        self.game.render_all()
+        self.assertFalse(self.game.needs_frame())
+
+        # frames are drawn until the drop animation is over
+        self.game.handle_input([pygame.event.Event(pygame.KEYDOWN,
+                                                   key=pygame.K_RETURN)])
+        self.game.render_all()
+        self.assertTrue(self.game.needs_frame())
+        self.game.render_all(1.0)
+        self.game.render_all()
+        self.assertEqual(self.game.board.grid[1][6], 1)
+        self.assertFalse(self.game.needs_frame())
+
+        self.game.handle_input([pygame.event.Event(pygame.VIDEOEXPOSE)])
+        self.assertTrue(self.game.dirty.everything)
+        self.assertTrue(self.game.needs_frame())
+
+    def test_wait_for_events(self):
+        self.game.render_all()
+        pygame.event.clear()
+        start = time.time()
+        self.assertEqual(self.game.wait_for_events(50), [])
+        self.assertGreater(time.time() - start, 0.04)
+        self.assertFalse(self.game.changed)
+        # the profile overlay is refreshed when the wait times out
+        self.game.show_profile = True
+        self.game.wait_for_events(1)
+        self.assertTrue(self.game.changed)
+
+        event = pygame.event.Event(pygame.KEYDOWN, key=pygame.K_LEFT)
+        pygame.event.post(event)
+        events = self.game.wait_for_events(1000)
+        self.assertEqual([(e.type, e.key) for e in events],
+                         [(pygame.KEYDOWN, pygame.K_LEFT)])
+
+    def test_rotation_frames(self):
+        self.assertEqual(main.rotation_angles(), list(range(1, 90, 10)))
+        eased = main.rotation_angles(5, 'ease-in-out')
+        self.assertEqual((eased[0], eased[-1]), (1, 81))
+        self.assertEqual(eased, sorted(eased))
+
+        frames = self.game.get_rotation_frames()
+        self.assertEqual(len(frames), main.ROTATION_STEPS)
+        self.assertIs(self.game.get_rotation_frames(), frames)
+        image, (dx, dy) = frames[-1]
+        self.assertEqual((dx, dy), (-image.get_width() / 2,
+                                    -image.get_height() / 2))
+        # the frames are rendered again once the board changes
+        self.game.board.drop_piece(3, 1)
+        self.game.board.update_image()
+        self.assertIsNot(self.game.get_rotation_frames(), frames)
+
+        self.game.smooth_rotation = True
+        self.game.rotation_steps = 3
+        frames = self.game.get_rotation_frames()
+        self.assertEqual(len(frames), 3)
+        self.assertTrue(frames[0][0].get_flags() & pygame.SRCALPHA)
+
+    def test_drop_animation(self):
+        self.game.column_selected = 3
+        self.game.drop_piece()
+        self.assertTrue(self.game.timeline.busy())
+        self.game.render_all()
+        # the piece is only put on the board once it has finished falling
+        self.assertEqual(self.game.board.grid[3][6], 0)
+        self.game.render_all(1.0)
+        self.game.render_all()
+        self.assertEqual(self.game.board.grid[3][6], 1)
+        self.assertEqual(self.game.active_player, 2)
+        self.assertFalse(self.game.timeline.busy())
@@ -0,0 +1,94 @@
+"""Tests for the server and load generator, which need Python 3.  They use
+async syntax Python 2 can't parse, so they live apart from
+test_gravtwist.py and are only collected on Python 3 (see conftest.py)."""
+import asyncio
+import unittest
+
+import loadgen
+import selfplay
+import server
+
+
+class TestServer(unittest.TestCase):
+
+    def run_with_server(self, test, rules=loadgen.DEFAULT_RULES):
+        async def run():
+            game_server = server.Server(budget_ms=10, processes=0,
+                                        rules=rules)
+            tcp_server = await game_server.start(port=0)
+            port = tcp_server.sockets[0].getsockname()[1]
+            try:
+                await test(game_server, port)
+            finally:
+                tcp_server.close()
+                await tcp_server.wait_closed()
+                game_server.close()
+        asyncio.run(run())
+
+    async def join(self, port, opponent=0):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(server.encode(server.JOIN, opponent))
+        return reader, writer
+
+    def test_encode(self):
+        self.assertEqual(server.encode(server.MOVE, 3), b'\x02\x03')
+        self.assertEqual(server.encode(server.ROTATED), b'\x84')
+
+    def test_human_game(self):
+        async def test(game_server, port):
+            reader1, writer1 = await self.join(port)
+            self.assertEqual(await server.read_message(reader1),
+                             (server.JOINED, (1, 1)))
+            reader2, writer2 = await self.join(port)
+            self.assertEqual(await server.read_message(reader2),
+                             (server.JOINED, (1, 2)))
+            for reader in (reader1, reader2):
+                self.assertEqual(await server.read_message(reader),
+                                 (server.START, ()))
+            writer2.write(server.encode(server.MOVE, 0))
+            self.assertEqual(await server.read_message(reader2),
+                             (server.ERROR, (server.NOT_YOUR_TURN,)))
+            for x, writer in ((3, writer1), (3, writer2), (3, writer1)):
+                writer.write(server.encode(server.MOVE, x))
+                await writer.drain()
+                await asyncio.sleep(0.01)
+            for reader in (reader1, reader2):
+                for team in (1, 2, 1):
+                    self.assertEqual(await server.read_message(reader),
+                                     (server.MOVED, (team, 3)))
+                self.assertEqual(await server.read_message(reader),
+                                 (server.ROTATED, ()))
+            # leaving forfeits the game
+            writer1.close()
+            self.assertEqual(await server.read_message(reader2),
+                             (server.RESULT, (2, 0, 0)))
+            self.assertEqual(game_server.games, {})
+            writer2.close()
+        self.run_with_server(test)
+
+    def test_ai_game(self):
+        async def test(game_server, port):
+            basic = 1 + selfplay.PLAYER_CODES.index('basic')
+            reader, writer = await self.join(port, basic)
+            self.assertEqual(await server.read_message(reader),
+                             (server.JOINED, (1, 1)))
+            self.assertEqual(await server.read_message(reader),
+                             (server.START, ()))
+            writer.write(server.encode(server.MOVE, 3))
+            self.assertEqual(await server.read_message(reader),
+                             (server.MOVED, (1, 3)))
+            kind, (team, column) = await server.read_message(reader)
+            self.assertEqual((kind, team), (server.MOVED, 2))
+            self.assertEqual(game_server.moves, 2)
+            writer.close()
+        self.run_with_server(test)
+
+    def test_loadgen_rules(self):
+        rules = (5, 5, 3, 2)
+
+        async def test(game_server, port):
+            stats = await loadgen.run('127.0.0.1', port, 4, 0, server.HUMAN,
+                                      0.5, rules=rules)
+            self.assertGreater(stats.games, 0)
+            self.assertEqual(stats.errors, 0)
+        self.run_with_server(test, rules)
@@ -0,0 +1,131 @@
+"""Fixed-size transposition table for the search AI.
+
+Entries live in two preallocated arrays of 64-bit integers, one for the
+position keys and one for the packed entry data, so a table never grows past
+the memory cap it was created with."""
+
+from array import array
+
+
+def _typecodes():
+    """Returns the (unsigned, signed) array typecodes of 64-bit integers.
+    Python 2 has no 'Q' and 'q', but its 'L' and 'l' are 64 bits on most
+    platforms."""
+    for codes in (('Q', 'q'), ('L', 'l')):
+        try:
+            if array(codes[0]).itemsize == array(codes[1]).itemsize == 8:
+                return codes
+        except ValueError:
+            pass
+    raise ImportError("no 64-bit array typecode on this platform")
+
+
+KEY_TYPECODE, DATA_TYPECODE = _typecodes()
+
+EMPTY = 0
+EXACT = 1
+LOWER = 2  # the score is a lower bound (the search failed high)
+UPPER = 3  # the score is an upper bound (the search failed low)
+
+# bytes used by one slot: a key and a packed entry, 8 bytes each
+SLOT_BYTES = 16
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+# How an occupied slot is handled when another position hashes to it.
+# 'always' overwrites it; 'depth' keeps the old entry if it came from a
+# deeper search during the current generation (get_move call).
+REPLACEMENT_POLICIES = ('always', 'depth')
+
+NO_MOVE = 0xf
+
+# packed entry layout, from the lowest bits up:
+# 4 bits bound type, 4 bits best move, 8 bits depth, 8 bits generation,
+# and the (signed) score in the remaining high bits
+_MOVE_SHIFT = 4
+_DEPTH_SHIFT = 8
+_GENERATION_SHIFT = 16
+_SCORE_SHIFT = 24
+
+
+class TranspositionTable(object):
+
+    """Maps position keys to (depth, bound type, score, best move)."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, policy='depth'):
+        if policy not in REPLACEMENT_POLICIES:
+            raise ValueError("unknown replacement policy %r" % (policy,))
+        # use the largest power of two number of slots that fits
+        slots = 1
+        while slots * 2 * SLOT_BYTES <= max_bytes:
+            slots *= 2
+        self.size = slots
+        self.mask = slots - 1
+        self.policy = policy
+        self.keys = array(KEY_TYPECODE, [0]) * slots
+        self.data = array(DATA_TYPECODE, [0]) * slots
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def memory_bytes(self):
+        return self.size * SLOT_BYTES
+
+    def new_generation(self):
+        """Marks the entries stored so far as belonging to an older search,
+        so the 'depth' policy lets newer results replace them."""
+        self.generation = (self.generation + 1) & 0xff
+
+    def clear(self):
+        slots = self.size
+        self.keys = array(KEY_TYPECODE, [0]) * slots
+        self.data = array(DATA_TYPECODE, [0]) * slots
+
+    def probe(self, key):
+        """Returns (depth, bound type, score, best move) for the key, or None
+        if the table doesn't hold it.  The best move is None if unknown."""
+        i = key & self.mask
+        data = self.data[i]
+        if data & 0xf == EMPTY:
+            self.misses += 1
+            return None
+        if self.keys[i] != key:
+            self.misses += 1
+            self.collisions += 1
+            return None
+        self.hits += 1
+        move = (data >> _MOVE_SHIFT) & 0xf
+        return ((data >> _DEPTH_SHIFT) & 0xff, data & 0xf,
+                data >> _SCORE_SHIFT, None if move == NO_MOVE else move)
+
+    def store(self, key, depth, bound, score, move=None):
+        i = key & self.mask
+        old = self.data[i]
+        if old & 0xf != EMPTY and self.keys[i] != key:
+            if self.policy == 'depth' and \
+                    (old >> _GENERATION_SHIFT) & 0xff == self.generation and \
+                    (old >> _DEPTH_SHIFT) & 0xff > depth:
+                return
+            self.overwrites += 1
+        if move is None:
+            move = NO_MOVE
+        self.keys[i] = key
+        self.data[i] = (score << _SCORE_SHIFT |
+                        self.generation << _GENERATION_SHIFT |
+                        depth << _DEPTH_SHIFT | move << _MOVE_SHIFT | bound)
+        self.stores += 1
+
+    def stats(self):
+        """Returns the table's counters as a dict."""
+        return {
+            'size': self.size,
+            'bytes': self.memory_bytes(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'collisions': self.collisions,
+            'stores': self.stores,
+            'overwrites': self.overwrites,
+        }